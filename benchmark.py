@@ -0,0 +1,251 @@
+"""
+Benchmark of the datacard pipeline on synthetic inputs, to compare its throughput between versions.
+Generates, in a work directory, histogram files with the same key naming scheme as the real ones
+(A_SUEP_nconst_Cluster70, A_SUEP_nconst_Cluster70_sys_JES_up, ..., F_..., I_...), and the
+config/SUEP_inputs_<era>.yaml and config/xsections_*.json pointing to them. The cards are then made by
+running makeOfflineDataCard.py, with the same command line as runcards.py, and timed:
+    card          : one card, Bin1Sig of one era, python startup included
+    sample        : all the 16 bins x 3 eras of a sample, one command per card
+    sample_build  : the same with one command per era, --signal, for the versions that have it
+Only the command line of makeOfflineDataCard.py is used, such that any checkout can be benchmarked with
+--repo, e.g. an older commit in a git worktree. Versions using np.float need numpy<2.
+The results are written to a .json file, with the version of the code they were made with.
+
+Example usage:
+    python benchmark.py -o bench_before.json --repo ../SUEPLimits-before
+    python benchmark.py -o bench_after.json --compare bench_before.json
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import platform
+import subprocess
+import numpy as np
+import yaml
+import uproot
+import boost_histogram as bh
+
+eras = ['2016', '2017', '2018']
+observable = "SUEP_nconst_Cluster70"
+regions = "ABCDEFGHI"
+# the variations of the signal read by makeOfflineDataCard.make_card
+systematics = ["sys_JES", "JER", "puweights", "trigSF", "PSWeight_ISR", "PSWeight_FSR", "track", "prefire", "higgs_weights"]
+signal_template = "GluGluToSUEP_HT1000_T1p00_mS{}.000_mPhi2.000_T1.000_modehadronic_TuneCP5_13TeV-pythia8"
+config_file = "config/SUEP_inputs_{}.yaml"
+
+# region observable and bin edges of each channel, as passed by runcards.py
+channels = {
+    "cat_crA" : ("A_" + observable, [0, 2000]),
+    "cat_crB" : ("B_" + observable, [0, 2000]),
+    "cat_crC" : ("C_" + observable, [0, 2000]),
+    "cat_crD" : ("D_" + observable, [0, 2000]),
+    "cat_crE" : ("E_" + observable, [0, 2000]),
+    "Bin0crF" : ("F_" + observable, [70, 90]),
+    "Bin1crF" : ("F_" + observable, [90, 110]),
+    "Bin2crF" : ("F_" + observable, [110, 130]),
+    "Bin3crF" : ("F_" + observable, [130, 170]),
+    "Bin4crF" : ("F_" + observable, [170, 2000]),
+    "cat_crG" : ("G_" + observable, [0, 2000]),
+    "cat_crH" : ("H_" + observable, [0, 2000]),
+    "Bin1Sig" : ("I_" + observable, [90, 110]),
+    "Bin2Sig" : ("I_" + observable, [110, 130]),
+    "Bin3Sig" : ("I_" + observable, [130, 170]),
+    "Bin4Sig" : ("I_" + observable, [170, 2000]),
+}
+
+def make_histogram(rng, edges, events, slope):
+    """ Falling weighted histogram of about events entries, with variances as for unit weights. """
+    centers = 0.5 * (edges[1:] + edges[:-1])
+    values = rng.poisson(events * np.exp(-centers / slope) / np.exp(-centers / slope).sum()).astype(float)
+    h = bh.Histogram(bh.axis.Variable(edges), storage=bh.storage.Weight())
+    h[:] = np.stack([values, values], axis=-1)
+    return h
+
+def write_file(path, rng, edges, events, slope, with_systematics):
+    """ One input file: the histograms of all the regions, and a few that the datagroups do not use. """
+    histograms = {}
+    for region in regions:
+        histograms["{}_{}".format(region, observable)] = make_histogram(rng, edges, events, slope)
+        histograms["2D_{}_{}_vs_SUEP_S1_Cluster70".format(region, observable)] = make_histogram(rng, edges, events, slope)
+        if with_systematics:
+            for syst in systematics:
+                for direction, scale in [("up", 1.05), ("down", 0.95)]:
+                    histograms["{}_{}_{}_{}".format(region, observable, syst, direction)] = make_histogram(rng, edges, events * scale, slope)
+    histograms["ht"] = make_histogram(rng, edges, events, slope)
+    with uproot.recreate(path) as f:
+        f.update(histograms)
+
+def make_inputs(workdir, n_bins, n_data, n_samples, seed=0):
+    """
+    Write the synthetic inputs in workdir, returns the names of the signal samples.
+    The files of the eras have the era in their name, as the real ones, for the 2016 luminosity.
+    """
+    rng = np.random.default_rng(seed)
+    edges = np.arange(n_bins + 1, dtype=float)
+    samples = [signal_template.format(mass) for mass in [125, 400, 750, 1000, 1500][:n_samples]]
+    os.makedirs(os.path.join(workdir, "inputs"), exist_ok=True)
+    os.makedirs(os.path.join(workdir, "config"), exist_ok=True)
+
+    for era in eras:
+        data = [os.path.join(workdir, "inputs", "JetHT_Run{}{}.root".format(era, "ABCD"[i % 4] * (1 + i // 4))) for i in range(n_data)]
+        for path in data:
+            write_file(path, rng, edges, 1e6, 60.0, False)
+        inputs = {
+            "expected": {"files": data, "type": "data"},
+            "data": {"files": data, "type": "data"},
+        }
+        for sample in samples:
+            path = os.path.join(workdir, "inputs", "{}_{}.root".format(sample, era))
+            write_file(path, rng, edges, 1e4, 150.0, True)
+            inputs[sample] = {"files": [path], "type": "signal"}
+        with open(os.path.join(workdir, config_file.format(era)), "w") as f:
+            yaml.safe_dump(inputs, f)
+        with open(os.path.join(workdir, "config", "xsections_{}.json".format(era)), "w") as f:
+            json.dump({"QCD": {"xsec": 1.0, "kr": 1.0, "br": 1.0}}, f, indent=2)
+
+    with open(os.path.join(workdir, "config", "xsections_SUEP.json"), "w") as f:
+        json.dump({sample: {"xsec": 1.0, "kr": 0.01, "br": 1.0} for sample in samples}, f, indent=2)
+    return samples
+
+def card_command(script, tag, sample, channel, era):
+    """ Command making one card, as runcards.py does. """
+    variable, bins = channels[channel]
+    return [sys.executable, script, "--tag", tag, "--channel", channel, "--variable", variable,
+            "--stack", sample, "expected", "data", "--bins"] + [str(b) for b in bins] + [
+            "--input=" + config_file.format(era), "--era=" + era]
+
+def build_command(script, tag, sample, era):
+    """ Command making all the cards of a sample and era in one process. """
+    return [sys.executable, script, "--tag", tag, "--signal", sample, "--force",
+            "--input=" + config_file.format(era), "--era=" + era]
+
+def call(commands, workdir, extra):
+    """ Run the commands one after the other in workdir, raises with the error of the first that fails. """
+    for command in commands:
+        p = subprocess.run(command + extra, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if p.returncode != 0:
+            raise RuntimeError("{} failed:\n{}".format(" ".join(command + extra), p.stderr))
+
+def run(commands, workdir, repeat, extra):
+    """ Wall times of repeat runs of the commands. """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call(commands, workdir, extra)
+        times.append(time.perf_counter() - start)
+    return times
+
+def summary(times, **extra):
+    result = {"unit": "s", "runs": times, "min": min(times), "median": float(np.median(times))}
+    result.update(extra)
+    return result
+
+def run_benchmarks(script, workdir, samples, repeat, profile=None):
+    results = {}
+    tag = "cards"
+    os.makedirs(os.path.join(workdir, tag), exist_ok=True)
+    extra = ["--profile", profile] if profile else []
+    n_cards = len(channels) * len(eras)
+
+    results["card"] = summary(run([card_command(script, tag, samples[0], "Bin1Sig", eras[-1])], workdir, repeat, extra))
+
+    commands = [card_command(script, tag, samples[0], channel, era) for era in eras for channel in channels]
+    times = run(commands, workdir, repeat, extra)
+    results["sample"] = summary(times, cards=n_cards, cards_per_s=n_cards / float(np.median(times)))
+
+    # older versions only make one card per command
+    commands = [build_command(script, tag, samples[0], era) for era in eras]
+    try:
+        times = run(commands, workdir, repeat, extra)
+        results["sample_build"] = summary(times, cards=n_cards, cards_per_s=n_cards / float(np.median(times)))
+    except RuntimeError:
+        print("Skipping sample_build, makeOfflineDataCard.py --signal failed, e.g. not supported by this version")
+    return results
+
+def get_version(repo):
+    """ Commit of the code, with a + if it has uncommitted changes, None if not in a git repository. """
+    try:
+        git = ["git", "-C", repo]
+        commit = subprocess.run(git + ["rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(git + ["status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout.strip()
+        return commit + ("+" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, reference):
+    print("{:<22}{:>14}{:>14}{:>10}".format("benchmark", "before [s]", "after [s]", "speedup"))
+    for name, result in results.items():
+        if name not in reference:
+            continue
+        before, after = reference[name]["median"], result["median"]
+        print("{:<22}{:>14.4f}{:>14.4f}{:>10.2f}".format(name, before, after, before / after if after > 0 else float("inf")))
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the datacard pipeline on synthetic inputs.")
+    parser.add_argument("-o", "--output", type=str, default="benchmark.json", help="Output .json with the results.")
+    parser.add_argument("-w", "--workdir", type=str, default=None, help="Directory of the synthetic inputs and cards, kept after the benchmark. Defaults to a temporary directory, removed at the end.")
+    parser.add_argument("--repo", type=str, default=os.path.dirname(os.path.abspath(__file__)), help="Checkout whose makeOfflineDataCard.py is benchmarked, defaults to this one.")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Number of times each benchmark is run.")
+    parser.add_argument("--nBins", type=int, default=500, help="Number of bins of the input histograms.")
+    parser.add_argument("--nData", type=int, default=4, help="Number of data files per era.")
+    parser.add_argument("--profile", action="store_true", help="Also record the stages of making the cards, with makeOfflineDataCard.py --profile, for the versions that have it.")
+    parser.add_argument("--compare", type=str, default=None, help="Results of a previous run to compare to.")
+    options = parser.parse_args()
+
+    output = os.path.abspath(options.output)
+    repo = os.path.abspath(options.repo)
+    script = os.path.join(repo, "makeOfflineDataCard.py")
+    reference = None
+    if options.compare:
+        with open(options.compare) as f:
+            reference = json.load(f)["results"]
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix="suep_benchmark_")
+    workdir = os.path.abspath(workdir)
+    profile = os.path.join(workdir, "profile") if options.profile else None
+    stages = None
+    try:
+        print("Writing the synthetic inputs to", workdir)
+        start = time.perf_counter()
+        samples = make_inputs(workdir, options.nBins, options.nData, 1)
+        print("Made the inputs in {:.1f} s".format(time.perf_counter() - start))
+
+        # the inputs and cross sections are read from config/, relative to the working directory
+        results = run_benchmarks(script, workdir, samples, options.repeat, profile)
+        if profile is not None and os.path.isfile(os.path.join(profile, "report.json")):
+            with open(os.path.join(profile, "report.json")) as f:
+                stages = json.load(f)["stages"]
+    finally:
+        if options.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "version": get_version(repo),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "host": socket.gethostname(),
+        "python": platform.python_version(),
+        "packages": {"numpy": np.__version__, "uproot": uproot.__version__, "boost_histogram": bh.__version__},
+        "parameters": {"repeat": options.repeat, "n_bins": options.nBins, "n_data": options.nData},
+        "results": results,
+    }
+    if stages is not None:
+        report["stages"] = stages
+    with open(output, "w") as f:
+        json.dump(report, f, indent=1)
+
+    print("{:<22}{:>12}{:>12}".format("benchmark", "min [s]", "median [s]"))
+    for name, result in results.items():
+        print("{:<22}{:>12.4f}{:>12.4f}".format(name, result["min"], result["median"]))
+    print("Results written to", output)
+    if reference is not None:
+        compare(results, reference)
+
+if __name__ == "__main__":
+    main()
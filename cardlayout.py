@@ -0,0 +1,20 @@
+"""
+Bins of the offline datacards and where their manifests are, shared by makeOfflineDataCard.py, runcombine.py and monitor.py.
+Kept free of any dependency, since runcombine.py runs within cmsenv where e.g. uproot and hist are missing.
+"""
+
+bins = ['Bin1Sig','Bin2Sig',
+        'Bin3Sig','Bin4Sig',
+        'Bin0crF','Bin1crF','Bin2crF',
+        'Bin3crF','Bin4crF',
+        'cat_crA','cat_crB','cat_crC','cat_crD','cat_crE','cat_crG','cat_crH']
+
+def get_bins():
+    return list(bins)
+
+def get_manifest_path(tag, sample, era):
+    """
+    Manifest of the cards of a sample and era, written by makeOfflineDataCard.build_cards: for each
+    channel, what its card was made from and the summary of the card read by ftool.combinecards.
+    """
+    return "{}/cards-{}/manifest-{}.json".format(tag, sample, era)
@@ -5,12 +5,57 @@ import uproot
 import json
 import os
 import re
+import functools
 from . import methods
+from . import cache
+from . import xsec as xsec_registry
+from . import rebin
+from . import profiling
+from . import combinecards
+from .stack import HistStack, StackCache, read_stack
+from .shapes import ShapesWriter
+from .render import get_skeleton
+from .store import HistStore, build_store, open_store
+from .index import KeyIndex, split_observable
 import hist
 import boost_histogram as bh
 from sympy import symbols, diff, sqrt
 
-__all__ = ['datacard', 'datagroup', "plot", "methods"]
+__all__ = ['datacard', 'datagroup', 'cached_datagroup', 'multi_datagroup', "plot", "methods", "cache", "xsec", "shapes", "render", "profiling", "combinecards", "rebin", "stack", "store", "open_file", "close_files", "file_index"]
+
+# ROOT files opened by this process, shared by all the datagroups reading them
+_open_files = {}
+
+def open_file(fn):
+     """
+     Open a ROOT file with uproot, reusing the handle if this process already opened it.
+     """
+     if fn not in _open_files:
+          _open_files[fn] = uproot.open(fn)
+     return _open_files[fn]
+
+def close_files(files=None):
+     """
+     Close the given ROOT files opened via open_file, or all of them if files is None.
+     """
+     if files is None:
+          files = list(_open_files.keys())
+     for fn in files:
+          _file = _open_files.pop(fn, None)
+          if _file is not None:
+               _file.close()
+
+def file_index(fn):
+     """
+     Index of the histograms of a ROOT file, parsed from its keys once per file version
+     and kept in the cache, see ftool.index.
+     """
+     key = cache.make_key("index", cache.file_stamp(fn))
+     index = cache.load(key)
+     if index is None:
+          index = KeyIndex(open_file(fn).keys(cycle=False))
+          cache.store(key, index)
+     return index
 
 def draw_ratio(nom, uph, dwh, name):
      import matplotlib.pyplot as plt
@@ -43,7 +88,7 @@ class datagroup:
      def __init__(self, files, observable="SUEP_nconst_Cluster ", era = 2018,  
                   name = "QCD", channel="", kfactor=1.0, ptype="background",
                   luminosity= 1.0, rebin=1, bins=[], normalise=True,
-                  xsections=None, mergecat=True, binrange=None):
+                  xsections=None, mergecat=True, binrange=None, store=None, stacks=None):
           self._files  = files
           self.observable = observable
           self.era     = era
@@ -53,18 +98,34 @@ class datagroup:
           self.xsec    = xsections
           self.outfile = None
           self.channel = channel
-          self.nominal = {}
+          self.stack = None # HistStack of all the histograms of the group, one row per variation
+          self.variations = {} # (systematic, direction) -> row of the stack, both None for the nominal
           self.systvar = set()
+          self._lookup = {} # systvar -> row(s) returned by get
+          self._boost = {} # row -> boost histogram, made when first asked for
           self.rebin   = rebin
-          self.bins = np.array(bins).astype(np.float)
+          self.bins = np.array(bins).astype(float)
           self.binrange= binrange # dropping bins the same way as droping elements in numpy arrays a[1:3]
 
           for fn in self._files:
 
                _proc = os.path.basename(fn).replace(".root","")
-               _file = uproot.open(fn)
-               if not _file:
-                    raise ValueError("%s is not a valid rootfile" % self.name)
+               if store is not None and store.has(fn, self.era):
+                    # read from the columnar store, see ftool.store, without opening the ROOT file
+                    with self._stage("index"):
+                         index = store.index(fn, self.era)
+                    read = functools.partial(store.read_stack, fn, self.era)
+               else:
+                    with self._stage("open"):
+                         _file = open_file(fn)
+                    if not _file:
+                         raise ValueError("%s is not a valid rootfile" % self.name)
+                    with self._stage("index"):
+                         index = file_index(fn)
+                    read = functools.partial(read_stack, _file)
+               if stacks is not None:
+                    # share the histograms already read by other datagroups of the same files
+                    read = functools.partial(stacks.read, fn, read)
 
                histograms = None
 
@@ -77,104 +138,107 @@ class datagroup:
                    else:
                     _scale = self.lumi * self.xs_scale(proc=self.name)
 
+               entries = [] # (name, systematic, direction, key) of the histograms to read from this file
+
                if self.name == "expected" and "I_" in self.observable:
                     sum_var = 'x' #Change this to a y to look at the sphericity instead of nconst
-                    systs = [] 
-                    F = {}
-                    H = {}
-                    for name in _file.keys():
-                        name = name.replace(";1","")
-                        ABCD_obs = self.observable.split("I_")[1]
-                        if "2D" in name: continue
-                        if ABCD_obs not in name: continue
-                        if "Inverted" in name: continue
-                        if "up" in name:
-                            if "Cluster70_" in name:
-                                sys = name.split("Cluster70_")[1]
-                            else:
-                                sys = name.split("Cluster_")[1]
-                            systs.append(sys)
-                        elif "down" in name:
-                            if "Cluster70_" in name:
-                                sys = name.split("Cluster70_")[1]
-                            else:
-                                sys = name.split("Cluster_")[1]
-                            systs.append(sys)
-                        else:
-                            sys = ""
-                            if "I_" in name: systs.append("nom")
-
-                        if sum_var == 'x':
-                            if "F_"+ABCD_obs == name: F["nom"] = _file["F_"+ABCD_obs].to_boost()
-                            if "F_"+ABCD_obs+"_"+sys == name: F[sys] = _file["F_"+ABCD_obs+"_"+sys].to_boost()
-
-                        elif sum_var == 'y': 
-                            if "H_"+ABCD_obs == name: H["nom"] = _file["H_"+ABCD_obs].to_boost()
-                            if "H_"+ABCD_obs+"_"+sys == name: H[sys] = _file["H_"+ABCD_obs+"_"+sys].to_boost()
-                        else:
-                            raise ValueError('ERROR: Appropriate variable not chosen!')
-                            
-                    for syst in systs:
-                        name = ABCD_obs+"_"+syst
-                        if sum_var == 'x':
-                            newhist=F[syst].copy()
-                        elif sum_var == 'y':
-                            newhist=H[syst].copy()
-                        else:
+                    if sum_var == 'x':
+                        cr = "F"
+                    elif sum_var == 'y':
+                        cr = "H"
+                    else:
+                        raise ValueError('ERROR: Appropriate variable not chosen!')
+
+                    # the shapes of the signal region variations are taken from the control region
+                    ABCD_obs = self.observable.split("I_")[1]
+                    if ("I", ABCD_obs, None, None) not in index:
+                        raise ValueError("No histogram I_{} in {}, see ftool.index for the names of the histograms".format(ABCD_obs, fn))
+                    for syst, direction in index.variations("I", ABCD_obs):
+                        if (cr, ABCD_obs, syst, direction) not in index:
                             raise ValueError('ERROR: Systematic plots not found for expected!')
-
-                        #### merge bins
-                        if self.rebin >= 1 and newhist.values().ndim == 1:#written only for 1D right now
-                            newhist = newhist[::bh.rebin(self.rebin)]
-                        
-                        ####merge bins to specified array
-                        if len(self.bins)!=0 and newhist.values().ndim == 1:#written only for 1D right now
-                            newhist = self.rebin_piecewise(newhist, self.bins, 'bh')
-                        
-                        name = self.channel + "_" + name
-                        newhist.name = name
-                        if name in self.nominal.keys():
-                             self.nominal[name] += newhist# * 0.0 + 1.0
-                        else:
-                             self.nominal[name] = newhist#  * 0.0 + 1.0
-
-                        try:
-                             self.systvar.add(re.search("sys_[\w.]+", name).group())
-                        except:
-                             pass
-
+                        name = ABCD_obs + "_" + (syst + "_" + direction if syst is not None else "nom")
+                        entries.append((name, syst, direction, index.get(cr, ABCD_obs, syst, direction)))
+                    with self._stage("read"):
+                         stack = read([key for _, _, _, key in entries])
 
                else:
-                    for name in _file.keys():
-                        name = name.replace(";1", "")
-                        if self.observable not in name: continue
-                        roothist = _file[name]
-                        newhist = roothist.to_boost() * _scale
-                    
-                        #### merge bins
-                        if self.rebin >= 1 and newhist.values().ndim == 1:#written only for 1D right now
-                            newhist = newhist[::bh.rebin(self.rebin)]
-                        
-                        ####merge bins to specified array
-                        if len(self.bins)!=0 and newhist.values().ndim == 1:#written only for 1D right now
-                            newhist = self.rebin_piecewise(newhist, self.bins, 'bh')
-                        
-                        name = self.channel + "_" + name
-                        newhist.name = name
-                        if name in self.nominal.keys():
-                             self.nominal[name] += newhist
-                        else:
-                             self.nominal[name] = newhist
-
-                        try:
-                             self.systvar.add(re.search("sys_[\w.]+", name).group())
-                        except:
-                             pass
-
-          self.merged = {}
-          self.merged = {i: (i, c) for i,c  in self.nominal.items()}
-
-
+                    region, obs = split_observable(self.observable)
+                    if (region, obs, None, None) not in index:
+                        raise ValueError("No histogram {}_{} in {}, see ftool.index for the names of the histograms".format(region, obs, fn))
+                    for syst, direction in index.variations(region, obs):
+                        name = index.get(region, obs, syst, direction)
+                        entries.append((name, syst, direction, name))
+                    with self._stage("read"):
+                         stack = read([key for _, _, _, key in entries]) * _scale
+
+               self.add_stack(entries, stack)
+
+
+
+     def _stage(self, name):
+          """ Records the time spent in a stage of making this group, if profiling, see ftool.profiling. """
+          return profiling.stage(name, era=self.era, channel=self.channel, process=self.name)
+
+     def add_stack(self, entries, stack):
+          """ Rebin and add to the group the histograms of a stack, one per (name, systematic, direction, key). """
+          with self._stage("rebin"):
+               #### merge bins
+               if self.rebin > 1:
+                   # the last edges would be dropped with their bins
+                   if (len(stack.edges) - 1) % self.rebin != 0:
+                       raise ValueError("Cannot merge the {} bins of {} by {}, rebin must divide the number of bins".format(
+                           len(stack.edges) - 1, self.observable, self.rebin))
+                   stack = stack.rebin(stack.edges[::self.rebin], keep_flow=True)
+
+               ####merge bins to specified array, all the variations at once
+               if len(self.bins)!=0:
+                   stack = stack.rebin(self.bins)
+
+          if len(entries) == 0:
+               return
+
+          # rows of the group for each histogram, adding the variations not seen yet
+          rows = []
+          new_keys = []
+          for name, syst, direction, _ in entries:
+               if (syst, direction) not in self.variations:
+                    self.variations[(syst, direction)] = len(self.variations)
+                    new_keys.append(self.channel + "_" + name)
+               rows.append(self.variations[(syst, direction)])
+               if syst is not None:
+                    self.systvar.add(syst)
+          self._lookup = {}
+          self._boost = {}
+
+          if self.stack is None:
+               self.stack = HistStack(new_keys, stack.edges, np.zeros((len(new_keys),) + stack.contents.shape[1:]))
+          elif len(new_keys) > 0:
+               contents = np.concatenate([self.stack.contents, np.zeros((len(new_keys),) + self.stack.contents.shape[1:])])
+               self.stack = HistStack(self.stack.keys + new_keys, self.stack.edges, contents)
+          if not np.array_equal(self.stack.edges, stack.edges):
+               raise ValueError("The histograms of {} do not have the same binning in all the files".format(self.name))
+
+          # all the variations of the file at once
+          self.stack.contents[rows] += stack.contents
+
+     def _to_boost(self, row):
+          if row not in self._boost:
+               with self._stage("to_boost"):
+                    h = self.stack.to_boost(row)
+               h.name = self.stack.keys[row]
+               self._boost[row] = h
+          return self._boost[row]
+
+     @property
+     def nominal(self):
+          """ Dict of the name of each histogram of the group to its boost histogram, made when asked for. """
+          if self.stack is None:
+               return {}
+          return {name: self._to_boost(row) for row, name in enumerate(self.stack.keys)}
+
+     @property
+     def merged(self):
+          return {name: (name, h) for name, h in self.nominal.items()}
      
      def check_shape(self, histogram):
           for ibin in range(histogram.numbins+1):
@@ -183,17 +247,28 @@ class datagroup:
           return histogram
 
      def get(self, systvar, merged=True):
-          shapeUp, shapeDown= None, None
-          for n, hist in self.merged.items():
-               if "Inverted" in n: continue
-               if "up" not in n and "down" not in n and systvar=="nom":
-                    return hist[1]
-               elif systvar in n:
-                    if "up" in n:
-                         shapeUp = hist[1]
-                    if "down" in n:
-                         shapeDown= hist[1]
-          return (shapeUp, shapeDown)
+          """
+          The nominal boost histogram for systvar 'nom', otherwise the (up, down) boost histograms
+          of the systematic containing systvar, None if not found.
+          The rows are looked up once per systvar, and the histograms made the first time they are asked for.
+          """
+          if systvar not in self._lookup:
+               shapeUp, shapeDown = None, None
+               for (syst, direction), row in self.variations.items():
+                    if syst is None and systvar=="nom":
+                         self._lookup[systvar] = row
+                         break
+                    elif syst is not None and systvar in syst:
+                         if direction == "up":
+                              shapeUp = row
+                         if direction == "down":
+                              shapeDown = row
+               else:
+                    self._lookup[systvar] = (shapeUp, shapeDown)
+          rows = self._lookup[systvar]
+          if isinstance(rows, tuple):
+               return tuple(None if row is None else self._to_boost(row) for row in rows)
+          return self._to_boost(rows)
      
      def rebin_piecewise(self, h_in, bins, histtype='hist'):
          """
@@ -219,47 +294,74 @@ class datagroup:
          if any([x.imag != 0 for x in bins]):
              raise Exception("Only pass real-valued bins")
      
-         # split the histogram by the bins
-         # and for each bin, calculate total amount of events and variance
-         z_vals, z_vars = [], []
-         for iBin in range(len(bins)-1): 
-             
-             if histtype == 'hist':
-                 bin_lo = bins[iBin]*1.0j
-                 bin_hi = bins[iBin+1]*1.0j            
-             elif histtype == 'bh':
-                 bin_lo = bh.loc(bins[iBin])
-                 bin_hi = bh.loc(bins[iBin+1])
-             h_fragment = h_in[bin_lo:bin_hi]    
-             z_vals.append(h_fragment.sum().value)
-             z_vars.append(h_fragment.sum().variance)
+         # for each bin, calculate total amount of events and variance
+         contents = np.stack([h_in.values(), h_in.variances()], axis=-1)
+         contents = rebin.rebin(contents, h_in.axes[0].edges, bins, axis=0)
      
          # fill the histograms
          if histtype == 'hist':
              h_out = hist.Hist(hist.axis.Variable(bins), storage=hist.storage.Weight())
-             h_out[:] = np.stack([z_vals, z_vars], axis=-1)
+             h_out[:] = contents
      
          elif histtype == 'bh':
              h_out = bh.Histogram(bh.axis.Variable(bins), storage=bh.storage.Weight())
-             h_out[:] = np.stack([z_vals, z_vars], axis=-1)
+             h_out[:] = contents
      
          return h_out
 
      def xs_scale(self, proc):
-         xsec = 1.0
-         xsec_file = "config/xsections_{self.era}.json"
+         xsec_file = "config/xsections_{}.json".format(self.era)
          if 'SUEP' in proc: xsec_file = "config/xsections_SUEP.json"
-         with open(xsec_file) as file:
-            MC_xsecs = json.load(file)
-         xsec  = MC_xsecs[proc]["xsec"]
-         xsec *= MC_xsecs[proc]["kr"]
-         xsec *= MC_xsecs[proc]["br"]
+         with self._stage("xsec"):
+             xsec = xsec_registry.get_xsec(proc, xsec_file)
          xsec *= 1000.0
          assert xsec > 0, "{} has a null cross section!".format(proc)
          return xsec
 
+def cached_datagroup(files, stacks=None, **kwargs):
+     """
+     Make a datagroup, or reuse the one already made from the same files (path, modification
+     time and size) with the same options, by this process or by any process sharing cache.cache_dir.
+     Meant for groups that are the same for every signal sample, e.g. data and expected.
+     """
+     key = cache.make_key("datagroup", [cache.file_stamp(fn) for fn in files], sorted(kwargs.items()))
+     group = cache.load(key)
+     if group is None:
+          group = datagroup(files, stacks=stacks, **kwargs)
+          cache.store(key, group)
+     return group
+
+def multi_datagroup(files, channels, cached=False, stacks=None, **kwargs):
+     """
+     Make the datagroups of several channels from the same files in one pass: each histogram
+     of the files is decoded once, e.g. those of the F region for Bin0crF to Bin4crF and for
+     the shapes of expected in Bin1Sig to Bin4Sig.
+
+     Inputs:
+          files: as for datagroup
+          channels: dict of channel to its (observable, bins)
+          cached: reuse the datagroups already made, see cached_datagroup
+          stacks: StackCache to share with other groups of the same files, e.g. data and expected
+          kwargs: the other options of datagroup, the same for all the channels
+
+     Returns:
+          dict of channel to its datagroup
+     """
+     make_group = cached_datagroup if cached else datagroup
+     if stacks is None:
+          stacks = StackCache()
+     groups = {}
+     for channel, (observable, bins) in channels.items():
+          groups[channel] = make_group(files, observable=observable, bins=bins, channel=channel, stacks=stacks, **kwargs)
+     return groups
+
 class datacard:
-     def __init__(self, name, channel="ch1", tag="."):
+     def __init__(self, name, channel="ch1", tag=".", shapes=None):
+          """
+          shapes: ShapesWriter shared by the cards of a sample, the shapes of this card are then written
+                  in its channel directory of that file, which is closed by its owner. By default, each
+                  card has its own shapes-<channel>.root, written when the card is dumped.
+          """
           self.dc_file = []
           self.name = []
           self.nsignal = 1
@@ -275,24 +377,34 @@ class datacard:
           self.rates = []
           self.nuisances = {}
           self.extras = set()
+          # the same as the lines of the card, kept to write its summary, see ftool.combinecards
+          self.shape_lines = []
+          self.observed = None
+          self.params = {}
           self.dc_name = "{}/cards-{}/shapes-{}.dat".format(self.tag, name, channel)
           if not os.path.isdir(os.path.dirname(self.dc_name)):
                os.mkdir(os.path.dirname(self.dc_name))
-          self.shape_file = uproot.recreate(
-               "{}/cards-{}/shapes-{}.root".format(self.tag, name, channel)
-          )
+          self.own_shapes = shapes is None
+          if self.own_shapes:
+               self.shape_file = ShapesWriter("{}/cards-{}/shapes-{}.root".format(self.tag, name, channel))
+               self.shape_dir = ""
+          else:
+               self.shape_file = shapes
+               self.shape_dir = channel + "/"
 
      def shapes_headers(self):
-          filename = self.dc_name.replace("dat", "root")
-          lines = "shapes * * {file:<20} $PROCESS $PROCESS_$SYSTEMATIC"
-          lines = lines.format(file = os.path.basename(filename))
+          filename = self.shape_file.path
+          lines = "shapes * * {file:<20} {dir}$PROCESS {dir}$PROCESS_$SYSTEMATIC"
+          lines = lines.format(file = os.path.basename(filename), dir = self.shape_dir)
           self.dc_file.append(lines)
+          self.shape_lines.append(["*", "*", os.path.basename(filename), self.shape_dir + "$PROCESS", self.shape_dir + "$PROCESS_$SYSTEMATIC"])
 
      def add_observation(self, shape):
           value = shape.sum()
           self.dc_file.append("bin          {0:>10}".format(self.channel))
           self.dc_file.append("observation  {0:>10}".format(value["value"]))
-          self.shape_file["data_obs"] = shape
+          self.observed = "{}".format(value["value"])
+          self.shape_file[self.shape_dir + "data_obs"] = shape
 
      def add_nuisance(self, process, name, value):
           if name not in self.nuisances:
@@ -305,7 +417,7 @@ class datacard:
                shape.view().variance = shape.variances() * 0.0
           value = shape.values(flow=False).sum()
           self.rates.append((process, value))
-          self.shape_file[process] = shape
+          self.shape_file[self.shape_dir + process] = shape
           self.nominal_hist = shape
 
      def add_shape_nuisance(self, process, cardname, shape, symmetric=False):
@@ -329,8 +441,8 @@ class datacard:
           if shape[1].values().sum() != 0 and shape[0].values().sum() != 0:
                     
                self.add_nuisance(process, nuisance, 1.0)
-               self.shape_file[process + "_" + cardname + "Up"  ] = shape[0]
-               self.shape_file[process + "_" + cardname + "Down"] = shape[1]
+               self.shape_file[self.shape_dir + process + "_" + cardname + "Up"  ] = shape[0]
+               self.shape_file[self.shape_dir + process + "_" + cardname + "Down"] = shape[1]
 
      def add_rate_param(self, name, channel, process, rate=1.0, vmin=0.1, vmax=10):
           # name rateParam bin process initial_value [min,max]
@@ -344,6 +456,7 @@ class datacard:
                vmax = vmax
           )
           self.extras.add(template)
+          self.params[template] = ["rateParam", name, channel, process, "{}".format(rate), "[{},{}]".format(vmin, vmax)]
      def add_ABCD_rate_param(self, name, channel, process, era, F):
           # name rateParam bin process initial_value [min,max]
           rera = "r" + era
@@ -356,45 +469,49 @@ class datacard:
                F = F
           )
           self.extras.add(template)
+          self.params[template] = ["rateParam"] + template.split()[:1] + template.split()[2:]
 
      def add_auto_stat(self):
-          self.extras.add(
-               "{} autoMCStats 0 0 1".format(self.channel)
-          )
+          template = "{} autoMCStats 0 0 1".format(self.channel)
+          self.extras.add(template)
+          self.params[template] = ["autoMCStats", self.channel, "0", "0", "1"]
+
+     def summary(self):
+          """
+          What the card says, as written in it, for ftool.combinecards to combine the cards without
+          parsing them: the shapes lines, the observation, the processes with their rates, the
+          nuisances and the rateParam and autoMCStats lines. Kept in the manifest of the sample
+          and era by makeOfflineDataCard.build_cards.
+          """
+          processes = [process for process, _ in self.rates]
+          return {
+               "version": combinecards.SUMMARY_VERSION,
+               "bin": self.channel,
+               "shapes": self.shape_lines,
+               "observation": self.observed,
+               "processes": [[process, i - self.nsignal + 1, "%.3f" % rate] for i, (process, rate) in enumerate(self.rates)],
+               "nuisances": [[nuisance.split()[0], nuisance.split()[1], {p: "%.3f" % scale[p] for p in processes if p in scale}]
+                             for nuisance, scale in sorted(self.nuisances.items())],
+               "params": sorted(self.params.values()),
+          }
 
      def dump(self):
-          # adding shapes
-          for line in self.shapes:
-               self.dc_file.append(line)
-          self.dc_file.append("-"*30)
-          # adding observation
-          for line in self.observation:
-               self.dc_file.append(line)
-          self.dc_file.append("-"*30)
-          # bin lines
-          bins_line = "{0:<8}".format("bin")
-          proc_line = "{0:<8}".format("process")
-          indx_line = "{0:<8}".format("process")
-          rate_line = "{0:<8}".format("rate")
-          for i, tup in enumerate(self.rates):
-               bins_line += "{0:>15}".format(self.channel)
-               proc_line += "{0:>15}".format(tup[0])
-               indx_line += "{0:>15}".format(i - self.nsignal + 1)
-               rate_line += "{0:>15}".format("%.3f" % tup[1])
-          self.dc_file.append(bins_line)
-          self.dc_file.append(proc_line)
-          self.dc_file.append(indx_line)
-          self.dc_file.append(rate_line)
-          self.dc_file.append("-"*30)
-          for nuisance in sorted(self.nuisances.keys()):
-               scale = self.nuisances[nuisance]
-               line_ = "{0:<8}".format(nuisance)
-               for process, _ in self.rates:
-                    if process in scale:
-                         line_ += "{0:>15}".format("%.3f" % scale[process])
-                    else:
-                         line_ += "{0:>15}".format("-")
-               self.dc_file.append(line_)
-          self.dc_file += self.extras
-          with open(self.dc_name, "w") as fout:
-               fout.write("\n".join(self.dc_file))
+          # the layout of the card is compiled once per channel, processes and nuisances, see ftool.render
+          skeleton = get_skeleton(
+               self.channel,
+               [process for process, _ in self.rates],
+               self.nsignal,
+               sorted(self.nuisances.keys()),
+               list(self.extras),
+               shapes = self.shapes,
+               observation = self.observation
+          )
+          with profiling.stage("write_card"):
+               with open(self.dc_name, "w") as fout:
+                    for line in self.dc_file:
+                         fout.write(line)
+                         fout.write("\n")
+                    fout.write(skeleton.render([rate for _, rate in self.rates], self.nuisances))
+          # write all the shapes of the card at once
+          if self.own_shapes:
+               self.shape_file.close()
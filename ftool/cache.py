@@ -0,0 +1,63 @@
+"""
+Cache for objects that are expensive to build and do not change between signal samples,
+e.g. the data and expected datagroups, kept in this process and, if cache_dir is set,
+also pickled on local disk so that other processes and jobs can reuse them.
+"""
+
+import os
+import hashlib
+import pickle
+import tempfile
+
+# bump when the layout of the cached objects changes, so old entries are not picked up
+CACHE_VERSION = 5
+
+# directory where the cached objects are written, None to only keep them in this process
+cache_dir = None
+
+_memory = {}
+
+def file_stamp(fn):
+    """ Identifies the state of an input file: any change to it will give a different key. """
+    if not os.path.isfile(fn):
+        # e.g. only available through a store, see ftool.store
+        return (os.path.abspath(fn), None, None)
+    st = os.stat(fn)
+    return (os.path.abspath(fn), st.st_mtime, st.st_size)
+
+def make_key(*parts):
+    """ Hash of the repr of all the parts, which must have a stable repr (str, numbers, lists, tuples). """
+    return hashlib.sha1(repr((CACHE_VERSION,) + parts).encode()).hexdigest()
+
+def _path(key):
+    return os.path.join(cache_dir, key + ".pkl")
+
+def load(key):
+    """ Returns the cached object, or None if it was never stored. """
+    if key in _memory:
+        return _memory[key]
+    if cache_dir is not None and os.path.isfile(_path(key)):
+        try:
+            with open(_path(key), "rb") as f:
+                obj = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        _memory[key] = obj
+        return obj
+    return None
+
+def store(key, obj):
+    """ Keep the object in memory and, if cache_dir is set, write it to disk atomically. """
+    _memory[key] = obj
+    if cache_dir is None:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    # write under a temporary name so that concurrent jobs never read a partial file
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, _path(key))
+
+def clear():
+    """ Forget everything cached in this process, the files on disk are left untouched. """
+    _memory.clear()
@@ -0,0 +1,155 @@
+"""
+Combination of the datacards of a sample into a single card, laid out as combineCards.py -S does.
+The manifest of each sample and era, written by makeOfflineDataCard.build_cards, has a summary of each
+of its cards, with what the card says as written in it, see ftool.datacard.summary, and the cards are
+combined from these summaries instead of parsing them, such that the cards of many samples can be
+combined in one process, without CMSSW. Only needs the standard library, such that runcombine.py can
+load this file on its own within cmsenv.
+"""
+
+import os
+import json
+import tempfile
+import multiprocessing
+
+# bump when the layout of the summaries changes, older summaries are then not used
+SUMMARY_VERSION = 1
+
+def load_summaries(manifest):
+    """ Summary of the card of each channel in the manifest, leaving out the ones made by an older version. """
+    try:
+        with open(manifest) as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {channel: entry["summary"] for channel, entry in entries.items()
+            if (entry.get("summary") or {}).get("version") == SUMMARY_VERSION}
+
+def _nuisance_type(types):
+    # as combineCards.py, a nuisance that is a shape in some bins and lnN in others is a shape?
+    if len(types) == 1:
+        return types.pop()
+    if types == {"shape", "lnN"}:
+        return "shape?"
+    raise ValueError("Nuisance with incompatible types: {}".format(", ".join(sorted(types))))
+
+def combine(cards):
+    """
+    Inputs:
+        cards: list of (label, path of the card, path of its manifest, channel of the card in the manifest),
+               the bin of each card is renamed to its label, and the paths of its shapes files are made
+               relative to where the cards are combined, e.g.
+               [('catcrA2016', 'cards-<sample>/shapes-cat_crA2016.dat', 'cards-<sample>/manifest-2016.json', 'cat_crA'), ...]
+
+    Returns:
+        the text of the combined card, None if any of the cards has no summary, or one older than the card
+    """
+    manifests = {}
+    summaries = []
+    for label, card, manifest, channel in cards:
+        if manifest not in manifests:
+            manifests[manifest] = load_summaries(manifest)
+        summary = manifests[manifest].get(channel)
+        if summary is None or not os.path.isfile(card) or os.path.getmtime(manifest) < os.path.getmtime(card):
+            return None
+        summaries.append(summary)
+
+    bins, observations, shapes, columns, params, stats = [], [], [], [], [], []
+    signals, backgrounds = [], []
+    nuisances = {} # name -> (types, {(bin, process): value})
+    for (label, card, _, _), summary in zip(cards, summaries):
+        rename = {summary["bin"]: label}
+        directory = os.path.dirname(card)
+        bins.append(label)
+        observations.append(summary["observation"])
+        for process, channel, fname, *hists in summary["shapes"]:
+            channel = label if channel == "*" else rename.get(channel, channel)
+            shapes.append([process, channel, os.path.join(directory, fname) if directory else fname] + hists)
+        for process, index, rate in summary["processes"]:
+            processes = signals if index <= 0 else backgrounds
+            if process not in processes:
+                processes.append(process)
+            columns.append((label, process, rate))
+        for name, pdf, values in summary["nuisances"]:
+            types, cells = nuisances.setdefault(name, (set(), {}))
+            types.add(pdf)
+            cells.update({(label, process): value for process, value in values.items()})
+        for kind, *tokens in summary["params"]:
+            if kind == "rateParam":
+                name, channel, process, *rest = tokens
+                params.append(" ".join([name, kind, rename.get(channel, channel), process] + rest))
+            elif kind == "autoMCStats":
+                channel, *rest = tokens
+                stats.append(" ".join([rename.get(channel, channel), kind] + rest))
+
+    # signals are numbered from 0 down, backgrounds from 1 up, in the order they first appear
+    indices = {process: i - len(signals) + 1 for i, process in enumerate(signals)}
+    indices.update({process: i + 1 for i, process in enumerate(backgrounds)})
+    rows = [("{} {}".format(name, _nuisance_type(types)), cells) for name, (types, cells) in sorted(nuisances.items())]
+
+    cmax = max([5] + [len(label) for label in bins] + [len(process) for process in indices] + [len(rate) for _, _, rate in columns])
+    hmax = max([10] + [len(row) for row, _ in rows])
+    pmax = max([1] + [len(shape[0]) for shape in shapes])
+    line = "-" * 130
+
+    lines = ["Combination of " + "  ".join("{}={}".format(label, card) for label, card, _, _ in cards)]
+    lines.append("imax {} number of bins".format(len(bins)))
+    lines.append("jmax {} number of processes minus 1".format(len(indices) - 1))
+    lines.append("kmax {} number of nuisance parameters".format(len(rows)))
+    lines.append(line)
+    for process, channel, *files in shapes:
+        lines.append("shapes {:<{p}} {:<{c}} {}".format(process, channel, " ".join(files), p=pmax, c=cmax))
+    lines.append(line)
+    lines.append("bin          " + "  ".join("{:<{c}}".format(label, c=cmax) for label in bins))
+    lines.append("observation  " + "  ".join("{:<{c}}".format(obs, c=cmax) for obs in observations))
+    lines.append(line)
+    lines.append("{:<{h}}  ".format("bin", h=hmax) + "  ".join("{:<{c}}".format(label, c=cmax) for label, _, _ in columns))
+    lines.append("{:<{h}}  ".format("process", h=hmax) + "  ".join("{:<{c}}".format(process, c=cmax) for _, process, _ in columns))
+    lines.append("{:<{h}}  ".format("process", h=hmax) + "  ".join("{:<{c}}".format(indices[process], c=cmax) for _, process, _ in columns))
+    lines.append("{:<{h}}  ".format("rate", h=hmax) + "  ".join("{:<{c}}".format(rate, c=cmax) for _, _, rate in columns))
+    lines.append(line)
+    for row, cells in rows:
+        lines.append("{:<{h}}  ".format(row, h=hmax) + "  ".join("{:<{c}}".format(cells.get((label, process), "-"), c=cmax)
+                                                           for label, process, _ in columns))
+    lines += params + stats
+    return "\n".join(lines) + "\n"
+
+def write(cards, output):
+    """
+    Combine the cards into output, written under a temporary name such that it is always complete.
+    An output with the same text is left as it is, such that its mtime only changes with the cards.
+
+    Returns:
+        whether the cards were combined, False if any of them has no summary
+    """
+    text = combine(cards)
+    if text is None:
+        return False
+    if os.path.isfile(output):
+        with open(output) as f:
+            if f.read() == text:
+                return True
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output)), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
+    os.replace(tmp, output)
+    return True
+
+def _write(args):
+    return write(*args)
+
+def write_many(tasks, processes=None):
+    """
+    Combine the cards of many samples in a pool of processes, by default one per core.
+
+    Inputs:
+        tasks: list of (cards, output), see write()
+
+    Returns:
+        list of whether the cards of each task were combined
+    """
+    if len(tasks) <= 1:
+        return [write(*task) for task in tasks]
+    processes = processes or multiprocessing.cpu_count()
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(_write, tasks, chunksize=max(1, len(tasks) // (4 * processes)))
@@ -0,0 +1,69 @@
+"""
+Index of the histograms in a ROOT file, parsed once from the key names, e.g.
+    A_SUEP_nconst_Cluster70                 -> region A, observable SUEP_nconst_Cluster70, nominal
+    A_SUEP_nconst_Cluster70_sys_JES_up      -> region A, observable SUEP_nconst_Cluster70, systematic sys_JES, up
+    I_nCleaned_Cands_puweights_down         -> region I, observable nCleaned_Cands, systematic puweights, down
+The observables are the names of the nominal histograms of each region, and a variation belongs to the
+longest of them its name starts with. Keys that do not follow this scheme (2D, Inverted, variations
+without a nominal, histograms without a region) are not indexed.
+"""
+
+import re
+
+_nominal_pattern = re.compile(r"^(?P<region>[A-Z])_(?P<observable>\w+)$")
+_variation_pattern = re.compile(r"^(?P<region>[A-Z])_(?P<name>\w+)_(?P<direction>up|down)$")
+
+def split_observable(observable):
+    """ Split e.g. 'A_SUEP_nconst_Cluster70' into the region 'A' and the observable 'SUEP_nconst_Cluster70'. """
+    m = re.match(r"^([A-Z])_(\w+)$", observable.strip())
+    if m is None:
+        raise ValueError("Observable {} is not of the form <region>_<observable>".format(observable))
+    return m.group(1), m.group(2)
+
+class KeyIndex:
+    """
+    Maps (region, observable, systematic, direction) to the name of the histogram in the file.
+    The nominal histogram has systematic and direction None.
+    """
+    def __init__(self, keys):
+        self._keys = {}
+        self._variations = {}
+        keys = [key for key in keys if "Inverted" not in key and "2D" not in key]
+        observables = {} # region -> observables, longest first
+        for key in keys:
+            m = _nominal_pattern.match(key)
+            if m is None or _variation_pattern.match(key): continue
+            region, observable = m.group("region", "observable")
+            self._keys[(region, observable, None, None)] = key
+            self._variations.setdefault((region, observable), []).append((None, None))
+            observables.setdefault(region, []).append(observable)
+        for region in observables:
+            observables[region].sort(key=len, reverse=True)
+        for key in keys:
+            m = _variation_pattern.match(key)
+            if m is None: continue
+            region, name, direction = m.group("region", "name", "direction")
+            for observable in observables.get(region, []):
+                if name.startswith(observable + "_"):
+                    syst = name[len(observable) + 1:]
+                    self._keys[(region, observable, syst, direction)] = key
+                    self._variations[(region, observable)].append((syst, direction))
+                    break
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, item):
+        return item in self._keys
+
+    def get(self, region, observable, syst=None, direction=None):
+        """ Name of the histogram, raises KeyError if it is not in the file. """
+        return self._keys[(region, observable, syst, direction)]
+
+    def observables(self):
+        """ List of the (region, observable) in the file. """
+        return list(self._variations.keys())
+
+    def variations(self, region, observable):
+        """ List of the (systematic, direction) available for the observable in the region, nominal included. """
+        return self._variations.get((region, observable), [])
@@ -0,0 +1,223 @@
+"""
+Opt-in instrumentation of the card pipeline: wall time, CPU time and peak RSS of each stage
+(opening the files, scanning their keys, reading, rebinning, writing, ...), per sample, era,
+channel and process. Nothing is recorded unless enabled is set, e.g. by --profile.
+
+Each process keeps its own records, writes them to a partial file with dump(directory), and
+write_report(directory) adds up the partial files of all the processes into report.json and report.csv.
+Stages can be nested, e.g. 'read' within 'datagroups' within 'build_cards', and their times include
+those of the stages they contain.
+
+Two memory figures are kept: peak_rss_mb, the peak resident memory of the process so far when the stage
+ended, and stage_peak_rss_mb, the peak during the stage itself. The latter is only taken for the coarse
+stages, stage(name, memory=True), e.g. making the datagroups or a card, and is None for the others and
+off linux. It needs the peak of the process to be reset at the start and end of these stages, through
+/proc/self/clear_refs, which also resets the VmHWM of /proc/self/status and the ru_maxrss of getrusage:
+while profiling, anything else reading them in the process only sees the peak since the last reset.
+The time spent sampling the memory is left out of the times of the stages.
+"""
+
+import os
+import csv
+import json
+import time
+import socket
+import tempfile
+import contextlib
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# record the stages, set e.g. by --profile
+enabled = False
+
+LABELS = ["sample", "era", "channel", "process"]
+FIELDS = ["stage"] + LABELS + ["calls", "wall_s", "cpu_s", "peak_rss_mb", "stage_peak_rss_mb"]
+
+_context = {}
+_records = {} # (stage, sample, era, channel, process) -> [calls, wall, cpu, peak rss, stage peak rss]
+_open = [] # the stages being recorded, innermost last
+_can_reset = None # whether the peak of the process can be reset, known once tried
+_process_peak = None # peak of the process across the resets
+_sampling = [0.0, 0.0] # wall and CPU time spent sampling the memory, left out of the stages
+_null = contextlib.nullcontext()
+
+def peak_rss_mb():
+    """ Peak resident memory of this process so far, None if it is not known on this platform. """
+    if resource is None:
+        return _process_peak
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # in kB on linux, in bytes on mac. On linux it is reset with the peak of the stages, see _sample_peak
+    return _max(_process_peak, rss / (1024.0 * 1024.0 if os.uname().sysname == "Darwin" else 1024.0))
+
+def _high_water_mb():
+    """ Peak resident memory of this process since it was last reset, None if not on linux. """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+def _sample_peak():
+    """ Add the peak since the last sample to the stages being recorded, and reset it for the next sample. """
+    global _can_reset, _process_peak
+    if _can_reset is False:
+        return
+    wall, cpu = time.perf_counter(), time.process_time()
+    peak = _high_water_mb()
+    if peak is None:
+        _can_reset = False
+        return
+    _process_peak = _max(_process_peak, peak)
+    for stage in _open:
+        stage.peak = max(stage.peak, peak)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        _can_reset = True
+    except OSError:
+        _can_reset = False
+    _sampling[0] += time.perf_counter() - wall
+    _sampling[1] += time.process_time() - cpu
+
+def _max(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+class _Stage:
+    def __init__(self, name, labels, memory):
+        self.key = (name,) + tuple(str(labels[label]) if labels.get(label) is not None else "" for label in LABELS)
+        self.memory = memory
+        self.peak = 0.0
+
+    def __enter__(self):
+        if self.memory:
+            _sample_peak()
+        _open.append(self)
+        self.sampling = list(_sampling)
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *args):
+        # without the memory samples of the stages within
+        wall = time.perf_counter() - self.wall - (_sampling[0] - self.sampling[0])
+        cpu = time.process_time() - self.cpu - (_sampling[1] - self.sampling[1])
+        if self.memory:
+            _sample_peak()
+        _open.remove(self)
+        record = _records.setdefault(self.key, [0, 0.0, 0.0, None, None])
+        record[0] += 1
+        record[1] += wall
+        record[2] += cpu
+        record[3] = _max(record[3], peak_rss_mb())
+        if self.memory and _can_reset:
+            record[4] = _max(record[4], self.peak)
+
+def stage(name, memory=False, **labels):
+    """
+    Context manager recording the time spent in it under the stage name, for the labels
+    (sample, era, channel, process) passed or, if not, set by the enclosing context().
+    With memory, also records the peak memory during the stage, meant for the coarse stages only.
+    Does nothing if profiling is not enabled.
+    """
+    if not enabled:
+        return _null
+    return _Stage(name, dict(_context, **labels), memory)
+
+@contextlib.contextmanager
+def context(**labels):
+    """ Labels of all the stages recorded within, e.g. context(sample=sample, era=era). """
+    previous = dict(_context)
+    _context.update(labels)
+    try:
+        yield
+    finally:
+        _context.clear()
+        _context.update(previous)
+
+def records():
+    """ List of the records of this process, one dict of FIELDS per stage and labels. """
+    return [dict(zip(FIELDS, key + tuple(record))) for key, record in _records.items()]
+
+def reset():
+    """ Forget the records of this process. """
+    _records.clear()
+
+def _write(path, write, mode="w"):
+    # written under a temporary name, such that the file is always complete
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    with os.fdopen(fd, mode, newline="") as f:
+        write(f)
+    os.replace(tmp, path)
+
+def dump(directory):
+    """ Write the records of this process to its partial file in directory, replacing the previous one. """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "profile-{}-{}.json".format(socket.gethostname(), os.getpid()))
+    _write(path, lambda f: json.dump(records(), f))
+    return path
+
+def clear(directory):
+    """ Remove the partial files and reports left in directory by a previous run. """
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name.startswith("profile-") and name.endswith(".json") or name in ["report.json", "report.csv"]:
+            os.remove(os.path.join(directory, name))
+
+def merge(rows):
+    """ Add up the rows with the same stage and labels, the peak RSS are the largest ones. """
+    merged = {}
+    for row in rows:
+        key = tuple(row[field] for field in ["stage"] + LABELS)
+        if key not in merged:
+            merged[key] = dict(row)
+            continue
+        total = merged[key]
+        for field in ["calls", "wall_s", "cpu_s"]:
+            total[field] += row[field]
+        for field in ["peak_rss_mb", "stage_peak_rss_mb"]:
+            total[field] = _max(total.get(field), row.get(field))
+    return sorted(merged.values(), key=lambda row: -row["wall_s"])
+
+def write_report(directory):
+    """
+    Add up the partial files of all the processes in directory, and write them to report.json,
+    with the totals of each stage, and to report.csv, one row per stage and labels.
+
+    Returns:
+        the rows of the report
+    """
+    rows = []
+    for name in sorted(os.listdir(directory)):
+        if name.startswith("profile-") and name.endswith(".json"):
+            with open(os.path.join(directory, name)) as f:
+                rows += json.load(f)
+    rows = merge(rows)
+    stages = merge([dict(row, **{label: "" for label in LABELS}) for row in rows])
+
+    def write_json(f):
+        json.dump({"stages": [{field: row[field] for field in FIELDS if field not in LABELS} for row in stages],
+                   "rows": rows}, f, indent=1)
+
+    def write_csv(f):
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    _write(os.path.join(directory, "report.json"), write_json)
+    _write(os.path.join(directory, "report.csv"), write_csv)
+    return rows
+
+def print_summary(rows, n=15):
+    """ Print the stages taking the most wall time. """
+    stages = merge([dict(row, **{label: "" for label in LABELS}) for row in rows])
+    print("{:<16}{:>8}{:>12}{:>12}{:>16}{:>18}".format("stage", "calls", "wall [s]", "cpu [s]", "stage peak [MB]", "process peak [MB]"))
+    for row in stages[:n]:
+        stage_rss = "-" if row.get("stage_peak_rss_mb") is None else "%.0f" % row["stage_peak_rss_mb"]
+        rss = "-" if row["peak_rss_mb"] is None else "%.0f" % row["peak_rss_mb"]
+        print("{:<16}{:>8}{:>12.3f}{:>12.3f}{:>16}{:>18}".format(row["stage"], row["calls"], row["wall_s"], row["cpu_s"], stage_rss, rss))
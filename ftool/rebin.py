@@ -0,0 +1,50 @@
+"""
+Piecewise rebinning of histogram contents onto new bin edges.
+The map from source to target bins is computed once per (source edges, target edges)
+and the contents are summed with a single np.add.reduceat, for any number of
+histograms stacked along the other dimensions, e.g. all the systematic variations.
+"""
+
+import functools
+import numpy as np
+
+@functools.lru_cache(maxsize=None)
+def edge_indices(src_edges, dst_edges):
+    """
+    Index of the source bin each target edge falls in, such that the target bin i
+    is the sum of the source bins [idx[i], idx[i+1]), as when slicing with bh.loc.
+    Edges outside the source axis are clipped to it.
+    Inputs must be hashable, e.g. tuples.
+    """
+    src = np.asarray(src_edges, dtype=float)
+    dst = np.asarray(dst_edges, dtype=float)
+    if np.any(np.diff(dst) <= 0):
+        raise ValueError("Target bin edges must be strictly increasing")
+    idx = np.searchsorted(src, dst, side="right") - 1
+    return np.clip(idx, 0, len(src) - 1)
+
+def rebin(contents, src_edges, dst_edges, axis=-1):
+    """
+    Inputs:
+        contents: array of values and/or variances, binned as src_edges along axis
+        src_edges: bin edges of the contents along axis
+        dst_edges: bin edges to rebin to
+        axis: dimension to rebin, N-D histograms can be rebinned one axis at a time
+
+    Returns:
+        array with the same dimensions as contents, binned as dst_edges along axis
+    """
+    idx = edge_indices(tuple(src_edges), tuple(dst_edges))
+    contents = np.moveaxis(np.asarray(contents, dtype=float), axis, -1)
+    if contents.shape[-1] != len(src_edges) - 1:
+        raise ValueError("Contents do not match the source bin edges")
+
+    # pad with an empty bin, such that the target edges at the end of the axis are valid indices,
+    # and drop the last output, which sums from the last target edge to the end
+    padded = np.concatenate([contents, np.zeros(contents.shape[:-1] + (1,))], axis=-1)
+    out = np.add.reduceat(padded, idx, axis=-1)[..., :-1]
+
+    # reduceat returns the element at the index, instead of zero, for empty ranges
+    out[..., idx[:-1] == idx[1:]] = 0
+
+    return np.moveaxis(out, -1, axis)
@@ -0,0 +1,53 @@
+"""
+Rendering of the body of the datacards: the bin, process and rate lines, the nuisances and the
+extra lines (rateParams, autoMCStats). Their layout only depends on the channel, the processes and
+which nuisances are there, so it is compiled once into a format string, the skeleton, and making
+a card only formats its rates and nuisance values into it.
+"""
+
+_skeletons = {}
+
+def _escape(text):
+    return text.replace("{", "{{").replace("}", "}}")
+
+class CardSkeleton:
+    def __init__(self, channel, processes, nsignal, nuisances, extras, shapes=(), observation=()):
+        self.processes = list(processes)
+        self.nuisances = list(nuisances)
+        cells = "{:>15}" * len(self.processes)
+
+        lines = [_escape(line) for line in shapes]
+        lines.append("-"*30)
+        lines += [_escape(line) for line in observation]
+        lines.append("-"*30)
+        lines.append(_escape("{0:<8}".format("bin") + "".join("{0:>15}".format(channel) for _ in self.processes)))
+        lines.append(_escape("{0:<8}".format("process") + "".join("{0:>15}".format(p) for p in self.processes)))
+        lines.append(_escape("{0:<8}".format("process") + "".join("{0:>15}".format(i - nsignal + 1) for i in range(len(self.processes)))))
+        lines.append(_escape("{0:<8}".format("rate")) + cells)
+        lines.append("-"*30)
+        for nuisance in self.nuisances:
+            lines.append(_escape("{0:<8}".format(nuisance)) + cells)
+        lines += [_escape(line) for line in extras]
+        self.template = "\n".join(lines)
+
+    def render(self, rates, nuisances):
+        """
+        Inputs:
+            rates: list of the rate of each process
+            nuisances: dict of nuisance to a dict of process to its value, processes without one get '-'
+
+        Returns:
+            the body of the card
+        """
+        cells = ["%.3f" % rate for rate in rates]
+        for nuisance in self.nuisances:
+            scale = nuisances[nuisance]
+            cells += ["%.3f" % scale[p] if p in scale else "-" for p in self.processes]
+        return self.template.format(*cells)
+
+def get_skeleton(channel, processes, nsignal, nuisances, extras, shapes=(), observation=()):
+    """ CardSkeleton of this layout, compiled the first time it is asked for in this process. """
+    key = (channel, tuple(processes), nsignal, tuple(nuisances), tuple(extras), tuple(shapes), tuple(observation))
+    if key not in _skeletons:
+        _skeletons[key] = CardSkeleton(*key)
+    return _skeletons[key]
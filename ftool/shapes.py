@@ -0,0 +1,63 @@
+"""
+Shapes ROOT files of the datacards, written in one go instead of one histogram at a time.
+A writer can hold the shapes of a single card, or of all the cards of a sample, each in
+its own directory, such that there is one file per sample instead of one per card.
+The file is written under a temporary name and only replaces the one at path once closed,
+such that a card failing part-way never leaves an incomplete shapes file behind.
+"""
+
+import os
+import tempfile
+import uproot
+from . import profiling
+
+class ShapesWriter:
+    def __init__(self, path):
+        self.path = path
+        self._pending = {}
+        self._file = None
+        self._tmp = None
+
+    def __setitem__(self, key, hist):
+        """ Histogram to write at key, which can be in a directory, e.g. 'Bin1Sig2018/data_obs'. """
+        self._pending[key] = hist
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def flush(self):
+        """ Write all the histograms added since the last flush in one batch. """
+        with profiling.stage("write_shapes"):
+            if self._file is None:
+                directory = os.path.dirname(os.path.abspath(self.path))
+                os.makedirs(directory, exist_ok=True)
+                fd, self._tmp = tempfile.mkstemp(dir=directory, suffix=".root.tmp")
+                os.close(fd)
+                self._file = uproot.recreate(self._tmp)
+            if len(self._pending) > 0:
+                self._file.update(self._pending)
+                self._pending = {}
+
+    def close(self):
+        """ Write what is left, close the file and move it to path, where it is then complete. """
+        self.flush()
+        self._file.close()
+        os.replace(self._tmp, self.path)
+        self._file, self._tmp = None, None
+
+    def discard(self):
+        """ Drop what was written, leaving the file at path, if any, as it was. """
+        self._pending = {}
+        if self._file is not None:
+            self._file.close()
+            os.remove(self._tmp)
+            self._file, self._tmp = None, None
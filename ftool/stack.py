@@ -0,0 +1,104 @@
+"""
+Stacks of 1D histograms sharing the same binning, e.g. all the systematic variations
+of an observable, held as a single (n_hists x n_bins+2 x [value, variance]) array.
+The under/overflow bins are kept at the two ends of the bin dimension.
+Boost histograms are only made when asked for, e.g. when writing the shapes.
+"""
+
+import numpy as np
+import boost_histogram as bh
+from . import rebin as _rebin
+
+class HistStack:
+    def __init__(self, keys, edges, contents):
+        self.keys = list(keys)
+        self.edges = np.asarray(edges, dtype=float)
+        self.contents = contents
+        self._rows = {k: i for i, k in enumerate(self.keys)}
+        if contents.shape != (len(self.keys), len(self.edges) + 1, 2):
+            raise ValueError("Contents do not match the keys and bin edges")
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __mul__(self, scale):
+        """ Scale all the histograms as a weighted histogram is: values by scale, variances by scale**2. """
+        contents = self.contents * np.array([scale, scale**2])
+        return HistStack(self.keys, self.edges, contents)
+
+    def row(self, key):
+        return self._rows[key]
+
+    def values(self, flow=False):
+        return self.contents[:, :, 0] if flow else self.contents[:, 1:-1, 0]
+
+    def variances(self, flow=False):
+        return self.contents[:, :, 1] if flow else self.contents[:, 1:-1, 1]
+
+    def rebin(self, bins, keep_flow=False):
+        """
+        Rebin all the histograms at once to the bin edges bins, see ftool.rebin.
+        The under/overflow bins are emptied unless keep_flow, as for rebin_piecewise.
+        """
+        contents = np.zeros((len(self), len(bins) + 1, 2))
+        contents[:, 1:-1] = _rebin.rebin(self.contents[:, 1:-1], self.edges, bins, axis=1)
+        if keep_flow:
+            contents[:, [0, -1]] = self.contents[:, [0, -1]]
+        return HistStack(self.keys, bins, contents)
+
+    def to_boost(self, key):
+        """ Make the boost histogram of one of the histograms, by key or row. """
+        i = key if isinstance(key, (int, np.integer)) else self._rows[key]
+        h = bh.Histogram(bh.axis.Variable(self.edges), storage=bh.storage.Weight())
+        h.view(flow=True)["value"] = self.contents[i, :, 0]
+        h.view(flow=True)["variance"] = self.contents[i, :, 1]
+        return h
+
+def read_stack(_file, keys):
+    """
+    Read the 1D histograms keys of an uproot file into a HistStack, in the order they are
+    stored in the file and without making any intermediate boost histogram.
+    All the histograms must have the same binning.
+    """
+    keys = list(keys)
+    order = sorted(range(len(keys)), key=lambda i: _file.key(keys[i]).fSeekKey)
+    contents = None
+    edges = None
+    for i in order:
+        h = _file[keys[i]]
+        if edges is None:
+            edges = h.axis().edges()
+            contents = np.empty((len(keys), len(edges) + 1, 2))
+        elif not np.array_equal(edges, h.axis().edges()):
+            raise ValueError("{} does not have the same binning as the other histograms".format(keys[i]))
+        contents[i, :, 0] = h.values(flow=True)
+        contents[i, :, 1] = h.variances(flow=True)
+    if edges is None:
+        edges = np.array([0.0, 1.0])
+        contents = np.empty((0, len(edges) + 1, 2))
+    return HistStack(keys, edges, contents)
+
+class StackCache:
+    """
+    Histograms already read from each file, such that the datagroups made from the same files,
+    e.g. for several channels (see ftool.multi_datagroup), decode each histogram only once.
+    """
+    def __init__(self):
+        self._rows = {}
+
+    def read(self, source, read, keys):
+        """ HistStack of the keys of source, calling read(keys) only for the keys not read yet. """
+        keys = list(keys)
+        missing = [key for key in keys if (source, key) not in self._rows]
+        if len(missing) > 0:
+            stack = read(missing)
+            for i, key in enumerate(missing):
+                self._rows[(source, key)] = (stack.edges, stack.contents[i])
+        if len(keys) == 0:
+            return read(keys)
+        edges = self._rows[(source, keys[0])][0]
+        for key in keys[1:]:
+            if not np.array_equal(edges, self._rows[(source, key)][0]):
+                raise ValueError("{} does not have the same binning as the other histograms".format(key))
+        contents = np.stack([self._rows[(source, key)][1] for key in keys])
+        return HistStack(keys, edges, contents)
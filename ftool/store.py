@@ -0,0 +1,190 @@
+"""
+Columnar store of the input histograms, converted once from the ROOT files and then
+memory-mapped, such that making the datagroups does not need to open any ROOT file.
+
+A store is a directory with:
+    index.json  : one row per (source, era, histogram key) with the offsets of its bins and edges,
+                  and the state (source, era, path, mtime, size) of each source ROOT file
+    contents.f8 : float64 (n_bins_total x [value, variance]) of all the histograms, flow bins included
+    edges.f8    : float64 bin edges of all the histograms
+The source is the path of the ROOT file as listed in the inputs, such that files with the same
+name in different directories, e.g. of different eras or tags, are kept apart.
+"""
+
+import os
+import json
+import shutil
+import functools
+import numpy as np
+from . import cache
+from .index import KeyIndex
+from .stack import HistStack, read_stack
+
+STORE_VERSION = 2
+
+def source_key(fn):
+    return os.path.normpath(fn)
+
+class HistStore:
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        with open(os.path.join(self.path, "index.json")) as f:
+            index = json.load(f)
+        if index["version"] != STORE_VERSION:
+            raise ValueError("{} was written with a different version of the store".format(self.path))
+        self.mtime = os.path.getmtime(os.path.join(self.path, "index.json"))
+        self.sources = {(source, era): [path, mtime, size] for source, era, path, mtime, size in index["sources"]}
+        self.rows = {}
+        self._keys = {}
+        for source, era, key, bin_offset, edge_offset, nbins in index["rows"]:
+            self.rows[(source, era, key)] = (bin_offset, edge_offset, nbins)
+            self._keys.setdefault((source, era), []).append(key)
+        self._indices = {}
+        self.contents = self._map("contents.f8", (index["n_bins"], 2))
+        self.edges = self._map("edges.f8", (index["n_edges"],))
+
+    def _map(self, name, shape):
+        if shape[0] == 0:
+            return np.zeros(shape)
+        return np.memmap(os.path.join(self.path, name), dtype=np.float64, mode="r", shape=shape)
+
+    def __repr__(self):
+        # stable across processes, used in the cache keys of the datagroups
+        return "HistStore({}, {})".format(self.path, self.mtime)
+
+    def __reduce__(self):
+        return (HistStore, (self.path,))
+
+    def has(self, fn, era):
+        """
+        Whether the store holds the histograms of the file for this era, and they are up to date,
+        i.e. the file was not modified since, or is not available on this machine.
+        """
+        source = self.sources.get((source_key(fn), str(era)))
+        if source is None:
+            return False
+        if not os.path.isfile(fn):
+            return True
+        return list(cache.file_stamp(fn)[1:]) == source[1:]
+
+    def stamp(self, fn, era):
+        """ State (path, mtime, size) of the file when it was converted, None if it is not in the store. """
+        source = self.sources.get((source_key(fn), str(era)))
+        return tuple(source) if source is not None else None
+
+    def index(self, fn, era):
+        """ KeyIndex of the histograms stored for the file. """
+        source = (source_key(fn), str(era))
+        if source not in self._indices:
+            self._indices[source] = KeyIndex(self._keys.get(source, []))
+        return self._indices[source]
+
+    def read_stack(self, fn, era, keys):
+        """ HistStack of the stored histograms keys of the file, which must have the same binning. """
+        keys = list(keys)
+        rows = [self.rows[(source_key(fn), str(era), key)] for key in keys]
+        if len(rows) == 0:
+            return HistStack(keys, np.array([0.0, 1.0]), np.empty((0, 3, 2)))
+        _, edge_offset, nbins = rows[0]
+        edges = np.array(self.edges[edge_offset:edge_offset + nbins + 1])
+        contents = np.empty((len(keys), nbins + 2, 2))
+        for i, (bin_offset, edge_offset, n) in enumerate(rows):
+            if n != nbins or not np.array_equal(edges, self.edges[edge_offset:edge_offset + n + 1]):
+                raise ValueError("{} does not have the same binning as the other histograms".format(keys[i]))
+            contents[i] = self.contents[bin_offset:bin_offset + nbins + 2]
+        return HistStack(keys, edges, contents)
+
+_stores = {}
+
+def open_store(path):
+    """ HistStore at path, opened once per process and again only if it was rebuilt since. """
+    path = os.path.abspath(path)
+    mtime = os.path.getmtime(os.path.join(path, "index.json"))
+    if path not in _stores or _stores[path].mtime != mtime:
+        _stores[path] = HistStore(path)
+    return _stores[path]
+
+def build_store(path, files, update=True, verbose=False):
+    """
+    Convert the histograms of the ROOT files into a store at path.
+    Only the histograms that the datagroups can use, i.e. indexed by KeyIndex, are converted.
+
+    Inputs:
+        path: directory of the store, written next to it and swapped in once the conversion is done
+        files: dict of era to the list of ROOT files of that era
+        update: copy over from the existing store at path the files that did not change,
+                instead of converting them again
+
+    Returns:
+        the HistStore
+    """
+    import uproot
+
+    previous = path.rstrip("/") + ".old"
+    if not os.path.isdir(path) and os.path.isdir(previous):
+        os.rename(previous, path)
+
+    old = None
+    if update and os.path.isfile(os.path.join(path, "index.json")):
+        try:
+            old = HistStore(path)
+        except ValueError:
+            old = None
+
+    tmp = path.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    rows = []
+    sources = {}
+    n_bins, n_edges = 0, 0
+    with open(os.path.join(tmp, "contents.f8"), "wb") as fcontents, open(os.path.join(tmp, "edges.f8"), "wb") as fedges:
+        for era, era_files in files.items():
+            for fn in sorted(set(era_files)):
+                era = str(era)
+                source = source_key(fn)
+                if (source, era) in sources: continue
+                _file = None
+
+                if old is not None and old.has(fn, era):
+                    if verbose: print(" ---- unchanged :", fn)
+                    index = old.index(fn, era)
+                    read = functools.partial(old.read_stack, fn, era)
+                    stamp = old.sources[(source, era)]
+                else:
+                    if verbose: print(" ---- converting :", fn)
+                    _file = uproot.open(fn)
+                    index = KeyIndex(_file.keys(cycle=False))
+                    read = functools.partial(read_stack, _file)
+                    stamp = list(cache.file_stamp(fn))
+
+                # the variations of an observable have the same binning, read them in one go
+                for region, observable in index.observables():
+                    stack = read([index.get(region, observable, syst, direction)
+                                  for syst, direction in index.variations(region, observable)])
+                    nbins = len(stack.edges) - 1
+                    for i, key in enumerate(stack.keys):
+                        rows.append([source, era, key, n_bins, n_edges, nbins])
+                        fcontents.write(np.ascontiguousarray(stack.contents[i], dtype=np.float64).tobytes())
+                        fedges.write(np.ascontiguousarray(stack.edges, dtype=np.float64).tobytes())
+                        n_bins += nbins + 2
+                        n_edges += nbins + 1
+
+                sources[(source, era)] = stamp
+                if _file is not None: _file.close()
+
+    with open(os.path.join(tmp, "index.json"), "w") as f:
+        json.dump({"version": STORE_VERSION, "n_bins": n_bins, "n_edges": n_edges,
+                   "sources": [[source, era] + stamp for (source, era), stamp in sources.items()],
+                   "rows": rows}, f)
+
+    # swap in the new store: the old one is moved aside and only removed once the new one is in place,
+    # such that there is always a complete store on disk, the old one being put back by the next build
+    # if it stopped in between
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.isdir(path):
+        os.rename(path, previous)
+    os.replace(tmp, path)
+    shutil.rmtree(previous, ignore_errors=True)
+
+    return HistStore(path)
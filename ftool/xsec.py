@@ -0,0 +1,31 @@
+"""
+Registry of the cross section tables in config/xsections_*.json. Only needs the standard library,
+such that notebook_tools/plot_utils.py can load this file on its own.
+Each table is read once per process, kept as a read-only mapping, and read again
+only if the file is modified on disk.
+"""
+
+import os
+import json
+from types import MappingProxyType
+
+_tables = {}
+
+def get_table(xsec_file):
+    """ Read-only mapping of process name to its {"xsec", "kr", "br"} entry. """
+    path = os.path.abspath(xsec_file)
+    mtime = os.path.getmtime(path)
+    if path not in _tables or _tables[path][0] != mtime:
+        with open(path) as f:
+            entries = json.load(f)
+        table = MappingProxyType({proc: MappingProxyType(entry) for proc, entry in entries.items()})
+        _tables[path] = (mtime, table)
+    return _tables[path][1]
+
+def get_xsec(proc, xsec_file, kr=True, br=True):
+    """ Cross section of the process, times its k-factor and branching ratio unless disabled. """
+    entry = get_table(xsec_file)[proc]
+    xsec = entry["xsec"]
+    if kr: xsec *= entry["kr"]
+    if br: xsec *= entry["br"]
+    return xsec
@@ -0,0 +1,38 @@
+"""
+Convert the input histograms of all the samples in config/SUEP_inputs_<era>.yaml into a single
+columnar store (see ftool/store.py), which can then be used by runcards.py and makeOfflineDataCard.py
+via --store instead of opening the ROOT files for every card.
+Files that did not change since the last conversion are copied over from the existing store.
+
+Example usage:
+    python makeHistStore.py -o /data/submit/$USER/SUEP/hist_store
+    python runcards.py -m multithread -t my_tag -channel ggf-offline --store /data/submit/$USER/SUEP/hist_store
+"""
+
+import argparse
+import yaml
+import ftool
+import makeOfflineDataCard
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Convert the input histograms into a columnar store.")
+    parser.add_argument("-o", "--output", type=str, required=True, help="Directory of the store.")
+    parser.add_argument("-e", "--eras", type=str, nargs='+', default=['2016', '2017', '2018'], help="Eras to convert.")
+    parser.add_argument("-c", "--config", type=str, default=makeOfflineDataCard.get_config_file(), help="Inputs .yaml, formatted with the era.")
+    parser.add_argument("-f", "--force", action="store_true", help="Convert all the files again, even if they did not change.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Print out more information.")
+    options = parser.parse_args()
+
+    files = {}
+    for era in options.eras:
+        with open(options.config.format(era)) as f:
+            inputs = yaml.safe_load(f.read())
+        files[era] = [fn for sample in inputs.values() for fn in sample["files"]]
+        print("Found", len(set(files[era])), "files for", era)
+
+    store = ftool.build_store(options.output, files, update=not options.force, verbose=options.verbose)
+    print("Wrote", len(store.rows), "histograms from", len(store.sources), "files to", store.path)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,13 @@
 import yaml
 import uproot
 import os, sys
+import tempfile
+import json
 import argparse
 import ftool
 import numpy as np
 from termcolor import colored
+from cardlayout import get_bins, get_manifest_path
 
 # from: https://twiki.cern.ch/twiki/bin/viewauth/CMS/LumiRecommendationsRun2#Combination_and_correlations
 lumis = {
@@ -69,206 +72,146 @@ closure_systs = {
     "2018": 1.08
 }
 
+# region observable and bin edges of each channel, one card per channel per sample and era
+channel_definitions = {
+    "cat_crA" : ("A_SUEP_nconst_Cluster70", [0, 2000]),
+    "cat_crB" : ("B_SUEP_nconst_Cluster70", [0, 2000]),
+    "cat_crC" : ("C_SUEP_nconst_Cluster70", [0, 2000]),
+    "cat_crD" : ("D_SUEP_nconst_Cluster70", [0, 2000]),
+    "cat_crE" : ("E_SUEP_nconst_Cluster70", [0, 2000]),
+    "Bin0crF" : ("F_SUEP_nconst_Cluster70", [70, 90]),
+    "Bin1crF" : ("F_SUEP_nconst_Cluster70", [90, 110]),
+    "Bin2crF" : ("F_SUEP_nconst_Cluster70", [110, 130]),
+    "Bin3crF" : ("F_SUEP_nconst_Cluster70", [130, 170]),
+    "Bin4crF" : ("F_SUEP_nconst_Cluster70", [170, 2000]),
+    "cat_crG" : ("G_SUEP_nconst_Cluster70", [0, 2000]),
+    "cat_crH" : ("H_SUEP_nconst_Cluster70", [0, 2000]),
+    "Bin1Sig" : ("I_SUEP_nconst_Cluster70", [90, 110]),
+    "Bin2Sig" : ("I_SUEP_nconst_Cluster70", [110, 130]),
+    "Bin3Sig" : ("I_SUEP_nconst_Cluster70", [130, 170]),
+    "Bin4Sig" : ("I_SUEP_nconst_Cluster70", [170, 2000]),
+}
+
 def get_commands(options, n, year):
 
-    cmd_crA = "python3 makeOfflineDataCard.py --tag {tag} --channel cat_crA "
-    cmd_crA += "--variable A_SUEP_nconst_Cluster70 "
-    cmd_crA += "--stack {signal} expected data "
-    cmd_crA += "--bins 0 2000 "
-    cmd_crA += "--input=config/SUEP_inputs_{era}.yaml --era={era}"
-    cmd_crA = cmd_crA.format(tag=options.tag, signal=n, era=year)
-
-    cmd_crB = "python3 makeOfflineDataCard.py --tag {tag} --channel cat_crB "
-    cmd_crB += "--variable B_SUEP_nconst_Cluster70 "
-    cmd_crB += "--stack {signal} expected data "
-    cmd_crB += "--bins 0 2000 "
-    cmd_crB += "--input=config/SUEP_inputs_{era}.yaml --era={era}"
-    cmd_crB = cmd_crB.format(tag=options.tag, signal=n, era=year)
-
-    cmd_crC = "python3 makeOfflineDataCard.py --tag {tag} --channel cat_crC "
-    cmd_crC += "--variable C_SUEP_nconst_Cluster70 "
-    cmd_crC += "--stack {signal} expected data "
-    cmd_crC += "--bins 0 2000 "
-    cmd_crC += "--input=config/SUEP_inputs_{era}.yaml --era={era}"
-    cmd_crC = cmd_crC.format(tag=options.tag, signal=n, era=year)
-
-    cmd_crD = "python3 makeOfflineDataCard.py --tag {tag} --channel cat_crD "
-    cmd_crD += "--variable D_SUEP_nconst_Cluster70 "
-    cmd_crD += "--stack {signal} expected data "
-    cmd_crD += "--bins 0 2000 "
-    cmd_crD += "--input=config/SUEP_inputs_{era}.yaml --era={era}"
-    cmd_crD = cmd_crD.format(tag=options.tag, signal=n, era=year)
-
-    cmd_crE = "python3 makeOfflineDataCard.py --tag {tag} --channel cat_crE "
-    cmd_crE += "--variable E_SUEP_nconst_Cluster70 "
-    cmd_crE += "--stack {signal} expected data "
-    cmd_crE += "--bins 0 2000 "
-    cmd_crE += "--input=config/SUEP_inputs_{era}.yaml --era={era}"
-    cmd_crE = cmd_crE.format(tag=options.tag, signal=n, era=year)
-
-    cmd_crF0 = "python3 makeOfflineDataCard.py --tag {tag} --channel Bin0crF "
-    cmd_crF0 += "--variable F_SUEP_nconst_Cluster70 "
-    cmd_crF0 += "--stack {signal} expected data "
-    cmd_crF0 += "--bins 70 90 "
-    cmd_crF0 += "--input=config/SUEP_inputs_{era}.yaml --era={era}"
-    cmd_crF0 = cmd_crF0.format(tag=options.tag, signal=n, era=year)
-
-    cmd_crF1 = "python3 makeOfflineDataCard.py --tag {tag} --channel Bin1crF "
-    cmd_crF1 += "--variable F_SUEP_nconst_Cluster70 "
-    cmd_crF1 += "--stack {signal} expected data "
-    cmd_crF1 += "--bins 90 110 "
-    cmd_crF1 += "--input=config/SUEP_inputs_{era}.yaml --era={era}"
-    cmd_crF1 = cmd_crF1.format(tag=options.tag, signal=n, era=year)
-
-    cmd_crF2 = "python3 makeOfflineDataCard.py --tag {tag} --channel Bin2crF "
-    cmd_crF2 += "--variable F_SUEP_nconst_Cluster70 "
-    cmd_crF2 += "--stack {signal} expected data "
-    cmd_crF2 += "--bins 110 130 "
-    cmd_crF2 += "--input=config/SUEP_inputs_{era}.yaml --era={era}"
-    cmd_crF2 = cmd_crF2.format(tag=options.tag, signal=n, era=year)
-
-    cmd_crF3 = "python3 makeOfflineDataCard.py --tag {tag} --channel Bin3crF "
-    cmd_crF3 += "--variable F_SUEP_nconst_Cluster70 "
-    cmd_crF3 += "--stack {signal} expected data "
-    cmd_crF3 += "--bins 130 170 "
-    cmd_crF3 += "--input=config/SUEP_inputs_{era}.yaml --era={era}"
-    cmd_crF3 = cmd_crF3.format(tag=options.tag, signal=n, era=year)
-
-    cmd_crF4 = "python3 makeOfflineDataCard.py --tag {tag} --channel Bin4crF "
-    cmd_crF4 += "--variable F_SUEP_nconst_Cluster70 "
-    cmd_crF4 += "--stack {signal} expected data "
-    cmd_crF4 += "--bins 170 2000 "
-    cmd_crF4 += "--input=config/SUEP_inputs_{era}.yaml --era={era}"
-    cmd_crF4 = cmd_crF4.format(tag=options.tag, signal=n, era=year)
-
-    cmd_crG = "python3 makeOfflineDataCard.py --tag {tag} --channel cat_crG "
-    cmd_crG += "--variable G_SUEP_nconst_Cluster70 "
-    cmd_crG += "--stack {signal} expected data "
-    cmd_crG += "--bins 0 2000 "
-    cmd_crG += "--input=config/SUEP_inputs_{era}.yaml --era={era}"
-    cmd_crG = cmd_crG.format(tag=options.tag, signal=n, era=year)
-
-    cmd_crH = "python3 makeOfflineDataCard.py --tag {tag} --channel cat_crH "
-    cmd_crH += "--variable H_SUEP_nconst_Cluster70 "
-    cmd_crH += "--stack {signal} expected data "
-    cmd_crH += "--bins 0 2000 "
-    cmd_crH += "--input=config/SUEP_inputs_{era}.yaml --era={era}"
-    cmd_crH = cmd_crH.format(tag=options.tag, signal=n, era=year)
-
-    cmd_sr1 = "python3 makeOfflineDataCard.py --tag {tag} --channel Bin1Sig "
-    cmd_sr1 += "--variable I_SUEP_nconst_Cluster70 "
-    cmd_sr1 += "--stack {signal} expected data "
-    cmd_sr1 += "--bins 90 110 "
-    cmd_sr1 += "--input=config/SUEP_inputs_{era}.yaml --era={era}"
-    cmd_sr1 = cmd_sr1.format(tag=options.tag, signal=n, era=year)
-
-    cmd_sr2 = "python3 makeOfflineDataCard.py --tag {tag} --channel Bin2Sig "
-    cmd_sr2 += "--variable I_SUEP_nconst_Cluster70 "
-    cmd_sr2 += "--stack {signal} expected data "
-    cmd_sr2 += "--bins 110 130 "
-    cmd_sr2 += "--input=config/SUEP_inputs_{era}.yaml --era={era}"
-    cmd_sr2 = cmd_sr2.format(tag=options.tag, signal=n, era=year)
-
-    cmd_sr3 = "python3 makeOfflineDataCard.py --tag {tag} --channel Bin3Sig "
-    cmd_sr3 += "--variable I_SUEP_nconst_Cluster70 "
-    cmd_sr3 += "--stack {signal} expected data "
-    cmd_sr3 += "--bins 130 170 "
-    cmd_sr3 += "--input=config/SUEP_inputs_{era}.yaml --era={era}"
-    cmd_sr3 = cmd_sr3.format(tag=options.tag, signal=n, era=year)
-
-    cmd_sr4 = "python3 makeOfflineDataCard.py --tag {tag} --channel Bin4Sig "
-    cmd_sr4 += "--variable I_SUEP_nconst_Cluster70 "
-    cmd_sr4 += "--stack {signal} expected data "
-    cmd_sr4 += "--bins 170 2000 "
-    cmd_sr4 += "--input=config/SUEP_inputs_{era}.yaml --era={era}"
-    cmd_sr4 = cmd_sr4.format(tag=options.tag, signal=n, era=year) 
-
-    commands = [cmd_crA, cmd_crB, cmd_crC, cmd_crD, cmd_crE, cmd_crF0, cmd_crF1, cmd_crF2, cmd_crF3, cmd_crF4, cmd_crG, cmd_crH, cmd_sr1, cmd_sr2, cmd_sr3, cmd_sr4]
+    commands = []
+    for channel, (variable, bins) in channel_definitions.items():
+        cmd = "python3 makeOfflineDataCard.py --tag {tag} --channel {channel} "
+        cmd += "--variable {variable} "
+        cmd += "--stack {signal} expected data "
+        cmd += "--bins {bins} "
+        cmd += "--input=config/SUEP_inputs_{era}.yaml --era={era}"
+        cmd = cmd.format(tag=options.tag, channel=channel, variable=variable, signal=n,
+                         bins=" ".join(str(b) for b in bins), era=year)
+        if getattr(options, "profile", None):
+            cmd += " --profile " + options.profile
+        commands.append(cmd)
 
     return commands
 
-def get_bins():
-    bins  = ['Bin1Sig','Bin2Sig',
-            'Bin3Sig','Bin4Sig',
-            'Bin0crF','Bin1crF','Bin2crF',
-            'Bin3crF','Bin4crF',
-            'cat_crA','cat_crB','cat_crC','cat_crD','cat_crE','cat_crG','cat_crH']
-    return bins
+def get_build_command(options, n, year):
+    """
+    Single command making the cards of all the channels of a sample and era, see build_cards.
+    n can also be a list of samples, which are then made one after the other by the same process.
+    """
+    cmd = "python3 makeOfflineDataCard.py --tag {tag} --signal {signal} "
+    cmd += "--input=config/SUEP_inputs_{era}.yaml --era={era}"
+    cmd = cmd.format(tag=options.tag, signal=n if isinstance(n, str) else " ".join(n), era=year)
+    if getattr(options, "cacheDir", None):
+        cmd += " --cacheDir " + options.cacheDir
+    if getattr(options, "store", None):
+        cmd += " --store " + options.store
+    if getattr(options, "force", False):
+        cmd += " --force"
+    if getattr(options, "shapesPerSample", False):
+        cmd += " --shapesPerSample"
+    if getattr(options, "profile", None):
+        cmd += " --profile " + options.profile
+    return cmd
 
 def get_config_file():
     return "config/SUEP_inputs_{}.yaml"
 
-def main():
-    parser = argparse.ArgumentParser(description='The Creator of Combinators')
-    parser.add_argument("-i"  , "--input"   , type=str, default="config/SUEP_inputs_2018.yaml")
-    parser.add_argument("-tag"  , "--tag"   , type=str, default=".")
-    parser.add_argument("-v"  , "--variable", type=str, default="nCleaned_Cands")
-    parser.add_argument("-c"  , "--channel" , nargs='+', type=str)
-    parser.add_argument("-s"  , "--signal"  , nargs='+', type=str)
-    parser.add_argument("-t"  , "--stack"   , nargs='+', type=str)
-    parser.add_argument("-era", "--era"     , type=str, default="2017")
-    parser.add_argument("-f"  , "--force"   , action="store_true")
-    parser.add_argument("-ns" , "--nostatuncert", action="store_false")
-    parser.add_argument("--binrange" ,nargs='+', type=int, default=100)
-    parser.add_argument("--rebin" ,type=int, default=1)
-    parser.add_argument("--bins",'--list', nargs='*', help='<Required> Set flag', required=False,default=[])
-
-    options = parser.parse_args()
-    
-    print("range =", options.binrange)
-    
-    inputs = None
-    with open(options.input) as f:
-        try:
-            inputs = yaml.safe_load(f.read())
-        except yaml.YAMLError as exc:
-            print (exc)
-
-    xsections = None
-
-    if len(options.channel) == 1:
-        options.channel = options.channel[0]
-    
+def load_datasets(inputs, stack, variable, era, channel, bins=[], rebin=1, binrange=100, store=None):
+    """ Make the datagroups of each process of the stack for one channel, reading from the ftool.HistStore store if passed. """
     xsections = 1.0
-    # make datasets per process
     datasets = {}
-    nsignals = 0
-    signal = ""
-    for dg in options.stack:
-        print('dg',dg)
-                
-        p = ftool.datagroup( 
+    for dg in stack:
+        # data-driven groups are the same for every signal sample, build them once
+        make_group = ftool.cached_datagroup if inputs[dg]["type"] == "data" else ftool.datagroup
+        p = make_group( 
             inputs[dg]["files"],
             ptype      = inputs[dg]["type"], 
-            observable = options.variable,
-            era        = options.era,
+            observable = variable,
+            era        = era,
             name       = dg,
             kfactor    = inputs[dg].get("kfactor", 1.0),
             xsections  = xsections,
-            channel    = options.channel,
-            rebin      = options.rebin,
-            bins = options.bins,
-            binrange   = options.binrange,
-            luminosity = lumis[options.era]
+            channel    = channel,
+            rebin      = rebin,
+            bins       = bins,
+            binrange   = binrange,
+            luminosity = lumis[era],
+            store      = store
         )
-        #p.save()
         datasets[p.name] = p
+    return datasets
+
+def load_all_datasets(inputs, stack, era, channels, rebin=1, binrange=100, store=None):
+    """
+    Make the datagroups of each process of the stack for several channels, reading each
+    input file once for all of them, see ftool.multi_datagroup.
+    Returns a dict of channel to its datasets, as made by load_datasets.
+    """
+    xsections = 1.0
+    datasets = {channel: {} for channel in channels}
+    stacks = ftool.stack.StackCache() # e.g. data and expected are made from the same files
+    for dg in stack:
+        groups = ftool.multi_datagroup(
+            inputs[dg]["files"],
+            {channel: channel_definitions[channel] for channel in channels},
+            # data-driven groups are the same for every signal sample, build them once
+            cached     = inputs[dg]["type"] == "data",
+            stacks     = stacks,
+            ptype      = inputs[dg]["type"],
+            era        = era,
+            name       = dg,
+            kfactor    = inputs[dg].get("kfactor", 1.0),
+            xsections  = xsections,
+            rebin      = rebin,
+            binrange   = binrange,
+            luminosity = lumis[era],
+            store      = store
+        )
+        for channel, p in groups.items():
+            datasets[channel][p.name] = p
+    return datasets
+
+def make_card(datasets, channel, era, tag=".", shapes=None, summaries=None):
+    """
+    Write the datacard and shapes of one channel from its datagroups, returns the path of the datacard.
+    The shapes are written in their own file, or in the ftool.ShapesWriter shapes if passed.
+    The summary of the card, see ftool.datacard.summary, is added to the summaries dict if passed.
+    """
+
+    signal = ""
+    for p in datasets.values():
         if p.ptype == "signal":
             signal = p.name
-    print('datasets!',datasets['data'].get("nom")) #Empty already
 
-    card_name = "ch"+options.era
-    if isinstance(options.channel, str):
-        card_name = options.channel+options.era 
+    card_name = "ch"+era
+    if isinstance(channel, str):
+        card_name = channel+era 
 
-    elif isinstance(options.channel, list):
-        if np.all(["signal" in c.lower() for c in options.channel]):
-            card_name = "catSig"+options.era
+    elif isinstance(channel, list):
+        if np.all(["signal" in c.lower() for c in channel]):
+            card_name = "catSig"+era
 
     card = ftool.datacard(
         name = signal,
         channel= card_name,
-        tag = options.tag
+        tag = tag,
+        shapes = shapes
     )
     card.shapes_headers()
 
@@ -280,35 +223,35 @@ def main():
         if p.ptype=="data" and p.name == "data": continue #Skip the data_obs
 
         #Look at expected and add in the rate_params
-        card.add_nominal(name,options.channel, p.get("nom"))
-        if "Sig" in options.channel:
+        card.add_nominal(name,channel, p.get("nom"))
+        if "Sig" in channel:
             if p.name == "expected" and p.ptype == "data" :
                 
-                if "Bin1" in options.channel:
+                if "Bin1" in channel:
                     Bin_cr = "Bin1crF"
-                    shape_syst = shape_extrapolated_Bin1[options.era]
-                if "Bin2" in options.channel:
+                    shape_syst = shape_extrapolated_Bin1[era]
+                if "Bin2" in channel:
                     Bin_cr = "Bin2crF"
-                    shape_syst = shape_extrapolated_Bin2[options.era]
-                if "Bin3" in options.channel:
+                    shape_syst = shape_extrapolated_Bin2[era]
+                if "Bin3" in channel:
                     Bin_cr = "Bin3crF"
-                    shape_syst = shape_extrapolated_Bin3[options.era]
-                if "Bin4" in options.channel:
+                    shape_syst = shape_extrapolated_Bin3[era]
+                if "Bin4" in channel:
                     Bin_cr = "Bin4crF"
-                    shape_syst = shape_extrapolated_Bin4[options.era]
+                    shape_syst = shape_extrapolated_Bin4[era]
                     
                 # real
-                closure_syst = closure_systs[options.era]
+                closure_syst = closure_systs[era]
                 
                 # correlated between years, bins
                 #N/A
                 
                 # correlated between the bins, uncorrelated between years
-                card.add_nuisance(name, "{:<21}  lnN".format("Closure_{}".format(options.era)), closure_syst)
-                card.add_nuisance(name, "{:<21}  lnN".format("Shape_{}".format(options.era)), shape_syst)
+                card.add_nuisance(name, "{:<21}  lnN".format("Closure_{}".format(era)), closure_syst)
+                card.add_nuisance(name, "{:<21}  lnN".format("Shape_{}".format(era)), shape_syst)
 
                 # uncorrelated systematics between the bins
-                card.add_ABCD_rate_param("r" + options.era + "_" + options.channel, options.channel + options.era, name, options.era, Bin_cr )
+                card.add_ABCD_rate_param("r" + era + "_" + channel, channel + era, name, era, Bin_cr )
 
         else:
             rate_nom = p.get("nom").values().sum()
@@ -319,32 +262,279 @@ def main():
                 rate_up = 20
                 rate_down = 0
             if p.name == "expected" and p.ptype == "data" :
-                card.add_rate_param("r" + options.era + "_" + options.channel, options.channel + options.era, name, rate=rate_nom, vmin=rate_down, vmax=rate_up )
+                card.add_rate_param("r" + era + "_" + channel, channel + era, name, rate=rate_nom, vmin=rate_down, vmax=rate_up )
 
         if p.ptype=="data": continue #Now that we have expected nom we skip data
 
         # add rate param
         
         #Add lnN nuisances
-        card.add_nuisance(name, "{:<21}  lnN".format("CMS_lumi_uncorr_{}".format(options.era)), lumi_uncorr[options.era])
-        card.add_nuisance(name, "{:<21}  lnN".format("CMS_lumi_corr"), lumi_corr[options.era])
-        if options.era in ["2017","2018"]:
-            card.add_nuisance(name, "{:<21}  lnN".format("CMS_lumi_corr1718"), lumi_corr1718[options.era])
+        card.add_nuisance(name, "{:<21}  lnN".format("CMS_lumi_uncorr_{}".format(era)), lumi_uncorr[era])
+        card.add_nuisance(name, "{:<21}  lnN".format("CMS_lumi_corr"), lumi_corr[era])
+        if era in ["2017","2018"]:
+            card.add_nuisance(name, "{:<21}  lnN".format("CMS_lumi_corr1718"), lumi_corr1718[era])
 
         #Shape based uncertainties
-        card.add_shape_nuisance(name, "CMS_JES_{}".format(options.era), p.get("JES"))
+        card.add_shape_nuisance(name, "CMS_JES_{}".format(era), p.get("JES"))
         card.add_shape_nuisance(name, "CMS_JER", p.get("JER"))
         card.add_shape_nuisance(name, "CMS_PU", p.get("puweights"))
-        card.add_shape_nuisance(name, "CMS_trigSF_{}".format(options.era), p.get("trigSF"))
-        card.add_shape_nuisance(name, "CMS_PS_ISR_{}".format(options.era), p.get("PSWeight_ISR"))
-        card.add_shape_nuisance(name, "CMS_PS_FSR_{}".format(options.era), p.get("PSWeight_FSR"))
-        card.add_shape_nuisance(name, "CMS_trk_kill_{}".format(options.era), p.get("track"))
-        if options.era == "2016" or options.era == "2017":
+        card.add_shape_nuisance(name, "CMS_trigSF_{}".format(era), p.get("trigSF"))
+        card.add_shape_nuisance(name, "CMS_PS_ISR_{}".format(era), p.get("PSWeight_ISR"))
+        card.add_shape_nuisance(name, "CMS_PS_FSR_{}".format(era), p.get("PSWeight_FSR"))
+        card.add_shape_nuisance(name, "CMS_trk_kill_{}".format(era), p.get("track"))
+        if era == "2016" or era == "2017":
              card.add_shape_nuisance(name, "CMS_Prefire", p.get("prefire"))
         if "mS125" in p.name:
              card.add_shape_nuisance(name, "CMS_Higgs", p.get("higgs_weights"))
         card.add_auto_stat()
     card.dump()
+    if summaries is not None:
+        summaries[channel] = card.summary()
+
+    return card.dc_name
+
+# tables the cards are made from, any change to them makes all the cards out of date
+systematics_tables = {
+    "lumis": lumis,
+    "lumi_uncorr": lumi_uncorr,
+    "lumi_corr": lumi_corr,
+    "lumi_corr1718": lumi_corr1718,
+    "shape_extrapolated_Bin0": shape_extrapolated_Bin0,
+    "shape_extrapolated_Bin1": shape_extrapolated_Bin1,
+    "shape_extrapolated_Bin2": shape_extrapolated_Bin2,
+    "shape_extrapolated_Bin3": shape_extrapolated_Bin3,
+    "shape_extrapolated_Bin4": shape_extrapolated_Bin4,
+    "closure_systs": closure_systs,
+}
+
+def load_manifest(tag, sample, era):
+    """ Entries of the manifest of a sample and era per channel, see build_cards, {} if it has none. """
+    try:
+        with open(get_manifest_path(tag, sample, era)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_manifest(tag, sample, era, manifest):
+    # under a temporary name, such that a failed job never leaves half a manifest
+    path = get_manifest_path(tag, sample, era)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+def get_sample_shapes_path(tag, sample, era):
+    """ Shapes file of all the channels of a sample and era, see build_cards(shapes_per_sample=True). """
+    return "{}/cards-{}/shapes-{}_{}.root".format(tag, sample, sample, era)
+
+def get_card_inputs(sample, era, channel, inputs, rebin=1, store=None, shapes_per_sample=False):
+    """
+    Everything the card of a sample, era and channel is made from: the state (path, mtime, size) of
+    the input files, their entries in the inputs .yaml and cross section tables, and the parameters.
+    """
+    stack = [sample, "expected", "data"]
+
+    files = []
+    for dg in stack:
+        for fn in inputs[dg]["files"]:
+            stamp = ftool.cache.file_stamp(fn)
+            if stamp[1] is None and store is not None and store.stamp(fn, era) is not None:
+                stamp = store.stamp(fn, era)
+            files.append(list(stamp))
+
+    xsections = {}
+    for dg in stack:
+        if inputs[dg]["type"] == "data": continue
+        xsec_file = "config/xsections_SUEP.json" if "SUEP" in dg else "config/xsections_{}.json".format(era)
+        if os.path.isfile(xsec_file):
+            xsections[dg] = dict(ftool.xsec_registry.get_table(xsec_file).get(dg, {}))
+
+    return {
+        "files": files,
+        "inputs": {dg: inputs[dg] for dg in stack},
+        "xsections": xsections,
+        "parameters": {
+            "channel": channel_definitions[channel],
+            "rebin": rebin,
+            "shapes_per_sample": shapes_per_sample,
+            "systematics": {name: table.get(era) for name, table in systematics_tables.items()},
+        },
+    }
+
+def get_card_hash(card_inputs):
+    return ftool.cache.make_key("card", json.dumps(card_inputs, sort_keys=True))
+
+def stale_cards(sample, era, channels=None, tag=".", inputs=None, rebin=1, store=None, shapes_per_sample=False):
+    """
+    Channels whose card is missing, empty, or was made from inputs that changed since,
+    according to the manifest of the sample and era written by build_cards.
+    Takes the same inputs as build_cards.
+    """
+    if channels is None:
+        channels = get_bins()
+    if inputs is None:
+        with open(get_config_file().format(era)) as f:
+            inputs = yaml.safe_load(f.read())
+
+    manifest = load_manifest(tag, sample, era)
+    stale = []
+    for channel in channels:
+        card_files = ['{}/cards-{}/shapes-{}{}.{}'.format(tag, sample, channel, era, eof) for eof in ['dat', 'root']]
+        if shapes_per_sample:
+            card_files[1] = get_sample_shapes_path(tag, sample, era)
+        if any(not os.path.exists(path) or os.path.getsize(path) == 0 for path in card_files):
+            stale.append(channel)
+            continue
+        if manifest.get(channel, {}).get("hash") != get_card_hash(get_card_inputs(sample, era, channel, inputs, rebin=rebin, store=store,
+                                                                 shapes_per_sample=shapes_per_sample)):
+            stale.append(channel)
+
+    return stale
+
+def build_cards(sample, era, channels=None, tag=".", inputs=None, rebin=1, store=None, force=True, shapes_per_sample=False):
+    """
+    Make the cards of a signal sample for all the channels of an era in this process.
+    The input files are opened and read once for the datagroups of all the channels,
+    instead of running the command line interface once per channel.
+
+    Inputs:
+        sample: name of the signal sample, as in the inputs .yaml
+        era: one of '2016', '2017', '2018'
+        channels: list of channels to make the cards for, defaults to get_bins()
+        tag: output directory of the cards
+        inputs: the loaded inputs .yaml, read from get_config_file() if not passed
+        store: ftool.HistStore to read the histograms from instead of the ROOT files, see makeHistStore.py
+        force: make all the cards, otherwise only the stale_cards
+        shapes_per_sample: write the shapes of all the channels in one file per sample and era,
+                           get_sample_shapes_path, with a directory per channel, instead of one file per card
+
+    Returns:
+        cards: list of the datacards written
+    """
+    if channels is None:
+        channels = get_bins()
+    if inputs is None:
+        with open(get_config_file().format(era)) as f:
+            inputs = yaml.safe_load(f.read())
+    with ftool.profiling.context(sample=sample, era=era), ftool.profiling.stage("build_cards", memory=True):
+        if not force:
+            with ftool.profiling.stage("stale_check"):
+                stale = stale_cards(sample, era, channels, tag=tag, inputs=inputs, rebin=rebin, store=store, shapes_per_sample=shapes_per_sample)
+            # the shapes file of the sample is rewritten with all the channels
+            if not shapes_per_sample or len(stale) == 0:
+                channels = stale
+
+        # the channels made again lose their entries first, such that a job that fails or is killed leaves them stale
+        manifest = load_manifest(tag, sample, era)
+        if any(channel in manifest for channel in channels):
+            manifest = {channel: entry for channel, entry in manifest.items() if channel not in channels}
+            write_manifest(tag, sample, era, manifest)
+
+        cards = []
+        summaries = {}
+        shapes = None
+        try:
+            shapes = ftool.ShapesWriter(get_sample_shapes_path(tag, sample, era)) if shapes_per_sample and len(channels) > 0 else None
+            with ftool.profiling.stage("datagroups", memory=True):
+                datasets = load_all_datasets(inputs, [sample, "expected", "data"], era, channels, rebin=rebin, store=store)
+            for channel in channels:
+                with ftool.profiling.context(channel=channel), ftool.profiling.stage("make_card", memory=True):
+                    cards.append(make_card(datasets[channel], channel, era, tag=tag, shapes=shapes, summaries=summaries))
+            if shapes is not None:
+                shapes.close()
+                shapes = None
+
+            # record what the cards were made from, see stale_cards, and what they say, see ftool.combinecards.
+            # Written after the cards, the channels not made again keep their entries
+            if len(channels) > 0:
+                with ftool.profiling.stage("manifests"):
+                    for channel in channels:
+                        card_inputs = get_card_inputs(sample, era, channel, inputs, rebin=rebin, store=store, shapes_per_sample=shapes_per_sample)
+                        manifest[channel] = {"hash": get_card_hash(card_inputs), "inputs": card_inputs, "summary": summaries[channel]}
+                    write_manifest(tag, sample, era, manifest)
+        finally:
+            # if a card failed, the shapes file of the sample is left as it was
+            if shapes is not None:
+                shapes.discard()
+            # the data files are kept open for the next sample, the signal ones are not needed anymore
+            ftool.close_files(inputs[sample]["files"])
+
+    return cards
+
+def warm_up(era, channels=None, inputs=None, rebin=1, store=None):
+    """
+    Make the data-driven datagroups of all the channels of an era, and read the cross section table,
+    such that build_cards only has to make the signal ones in this process.
+    Meant to be called once per worker process, see runcards.py -m processpool.
+    Takes the same inputs as build_cards.
+    """
+    if channels is None:
+        channels = get_bins()
+    if inputs is None:
+        with open(get_config_file().format(era)) as f:
+            inputs = yaml.safe_load(f.read())
+
+    with ftool.profiling.context(era=era), ftool.profiling.stage("warm_up", memory=True):
+        ftool.xsec_registry.get_table("config/xsections_SUEP.json")
+        load_all_datasets(inputs, ["expected", "data"], era, channels, rebin=rebin, store=store)
+
+def main():
+    parser = argparse.ArgumentParser(description='The Creator of Combinators')
+    parser.add_argument("-i"  , "--input"   , type=str, default="config/SUEP_inputs_2018.yaml")
+    parser.add_argument("-tag"  , "--tag"   , type=str, default=".")
+    parser.add_argument("-v"  , "--variable", type=str, default="nCleaned_Cands")
+    parser.add_argument("-c"  , "--channel" , nargs='+', type=str, help="Channel to make the card for. If not passed, makes the cards of all the channels for each of --signal.")
+    parser.add_argument("-s"  , "--signal"  , nargs='+', type=str)
+    parser.add_argument("-t"  , "--stack"   , nargs='+', type=str)
+    parser.add_argument("-era", "--era"     , type=str, default="2017")
+    parser.add_argument("-f"  , "--force"   , action="store_true", help="Make all the cards of --signal, instead of only the ones whose inputs changed.")
+    parser.add_argument("--shapesPerSample", action="store_true", help="Write the shapes of all the channels of each of --signal in one file, instead of one file per card.")
+    parser.add_argument("-ns" , "--nostatuncert", action="store_false")
+    parser.add_argument("--binrange" ,nargs='+', type=int, default=100)
+    parser.add_argument("--rebin" ,type=int, default=1)
+    parser.add_argument("--bins",'--list', nargs='*', help='<Required> Set flag', required=False,default=[])
+    parser.add_argument("--cacheDir", type=str, default=None, help="Directory where the data-driven datagroups are cached, to share them between jobs.")
+    parser.add_argument("--store", type=str, default=None, help="Read the histograms from this store, made with makeHistStore.py, instead of the ROOT files.")
+    parser.add_argument("--profile", type=str, default=None, help="Record the time and memory of each stage, and add them to the report in this directory, see ftool.profiling.")
+
+    options = parser.parse_args()
+
+    ftool.cache.cache_dir = options.cacheDir
+    ftool.profiling.enabled = options.profile is not None
+    store = ftool.open_store(options.store) if options.store else None
+    
+    print("range =", options.binrange)
+    
+    inputs = None
+    with open(options.input) as f:
+        try:
+            inputs = yaml.safe_load(f.read())
+        except yaml.YAMLError as exc:
+            print (exc)
+
+    if options.channel is None:
+        for sample in options.signal:
+            build_cards(sample, options.era, tag=options.tag, inputs=inputs, rebin=options.rebin, store=store, force=options.force,
+                        shapes_per_sample=options.shapesPerSample)
+    else:
+        if len(options.channel) == 1:
+            options.channel = options.channel[0]
+
+        # the signal is the first of the stack, see get_commands
+        with ftool.profiling.context(sample=options.stack[0], era=options.era, channel=options.channel):
+            # make datasets per process
+            with ftool.profiling.stage("datagroups", memory=True):
+                datasets = load_datasets(inputs, options.stack, options.variable, options.era, options.channel,
+                                         bins=options.bins, rebin=options.rebin, binrange=options.binrange, store=store)
+            print('datasets!',datasets['data'].get("nom")) #Empty already
+
+            with ftool.profiling.stage("make_card", memory=True):
+                make_card(datasets, options.channel, options.era, tag=options.tag)
+
+    if options.profile:
+        # the report adds up the records of all the jobs writing to the same directory
+        ftool.profiling.dump(options.profile)
+        ftool.profiling.write_report(options.profile)
 
 if __name__ == "__main__":
     main()
@@ -10,19 +10,39 @@ Script to do any of the following:
     limit files have been produced successfully.
 
 3. Move the limit files from the remote directory, where condor places the outputs, to the local directory/tag.
+    The files are checked and copied by a pool of threads, and the files already checked are recorded
+    in <tag>/.moveLimits.json, such that they are not opened again by the next runs.
+
+The status of the cards and limit files found by each run is kept in <tag>/.monitor.db (sqlite), see
+MonitorIndex, such that the next runs only check the files that are new or changed since.
+
+With --watch, keeps running after that, and checks the limit files as they are written, moving them
+from the remote directory with --moveLimits, until all the limits are done. The directories are watched
+with inotify if inotify_simple is installed, and otherwise, or with --poll, listed every --pollInterval seconds.
 
 Author: Luca Lavezzo
 Date: November, 2023
 """
 
 import os
+import re
 import json
+import zlib
+import time
+import sqlite3
 import uproot
 import datetime
 import argparse
+import tempfile
 import yaml
 import logging
+import concurrent.futures
 from tqdm import tqdm
+from cardlayout import get_bins
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
 
 def getExpectedLength(fname):
     """
@@ -32,11 +52,357 @@ def getExpectedLength(fname):
     elif 'HybridNew' in fname: return 1
     else: raise ValueError("Cannot determine expected length of limit tree from file name.")
 
+def get_quantiles(method):
+    """ Suffixes of the limit files of a sample, the quantiles are only needed for running toys with HybridNew. """
+    if method == 'AsymptoticLimits':
+        return [""]
+    elif method == 'HybridNew':
+        return ['', '.quant0.500', '.quant0.160', '.quant0.840', '.quant0.975', '.quant0.025']
+
 def find_recompute_indices(numbers):
     sorted_indices = sorted(range(len(numbers)), key=lambda k: numbers[k])
     wrong_indices = [i for i, j in enumerate(sorted_indices) if i != j]
     return [i for i in wrong_indices]
 
+class MonitorIndex:
+    """
+    Status of the cards and limit files of a tag, as found by the previous runs:
+        limits : one row per limit file, with its size and mtime when it was checked, its status
+                 ('valid', 'corrupted', or NULL if only its existence was checked) and limit values
+        card_stamps : one row per sample and era whose cards were all found, with the size and mtime
+                 of each of its cards then
+    A limit file is only opened again if its size or mtime changed, and the cards of a sample are only
+    checked again if any of them changed, e.g. was rewritten in place by a job that died writing it.
+    """
+    # statements bringing the index from each version of its schema, kept in PRAGMA user_version, to the next.
+    # A new index and those made before the version was kept are at 0, the latter with a cards table
+    migrations = [
+        # 0 -> 1: the complete cards are kept with the size and mtime of each card, instead of the newest mtime
+        """
+        CREATE TABLE IF NOT EXISTS limits (
+            file TEXT PRIMARY KEY, sample TEXT, method TEXT, quantile TEXT,
+            size INTEGER, mtime REAL, status TEXT, limits TEXT);
+        DROP TABLE IF EXISTS cards;
+        CREATE TABLE IF NOT EXISTS card_stamps (
+            sample TEXT, era TEXT, stamp TEXT, PRIMARY KEY (sample, era));
+        """,
+    ]
+    file_pattern = re.compile(r"^higgsCombine(?P<sample>.+)\.(?P<method>\w+)\.mH125(?:\.quant(?P<quantile>[0-9.]+))?\.root$")
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version > len(self.migrations):
+            raise RuntimeError("{} was made by a newer version of monitor.py (schema {}, this one knows up to {})".format(
+                path, version, len(self.migrations)))
+        for i in range(version, len(self.migrations)):
+            self.db.executescript(self.migrations[i] + "PRAGMA user_version = {};".format(i + 1))
+
+    def limit(self, fname, stat):
+        """
+        (status, limit values) of the limit file, with its os.stat stat.
+        The file is only opened if it was never checked or changed since.
+        """
+        f = os.path.basename(fname)
+        row = self.db.execute("SELECT size, mtime, status, limits FROM limits WHERE file = ?", (f,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime and row[2] is not None:
+            return row[2], json.loads(row[3])
+        try:
+            values = [float(v) for v in read_limits(fname)]
+            status = 'valid'
+        except Exception:
+            values = []
+            status = 'corrupted'
+        self.record_limit(fname, stat, status, values)
+        return status, values
+
+    def record_limit(self, fname, stat, status=None, values=()):
+        f = os.path.basename(fname)
+        m = self.file_pattern.match(f)
+        sample, method, quantile = m.group('sample', 'method', 'quantile') if m else (None, None, None)
+        self.db.execute("INSERT OR REPLACE INTO limits VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (f, sample, method, quantile, stat.st_size, stat.st_mtime, status, json.dumps(list(values))))
+
+    def forget_limit(self, fname):
+        self.db.execute("DELETE FROM limits WHERE file = ?", (os.path.basename(fname),))
+
+    def cards_complete(self, sample, era, stamp):
+        """ Whether all the cards of the sample and era were found, with the same stamp, the (size, mtime) of each card. """
+        row = self.db.execute("SELECT stamp FROM card_stamps WHERE sample = ? AND era = ?", (sample, era)).fetchone()
+        return row is not None and row[0] == json.dumps(stamp)
+
+    def set_cards_complete(self, sample, era, stamp):
+        self.db.execute("INSERT OR REPLACE INTO card_stamps VALUES (?, ?, ?)", (sample, era, json.dumps(stamp)))
+
+    def forget_cards(self, sample, era):
+        self.db.execute("DELETE FROM card_stamps WHERE sample = ? AND era = ?", (sample, era))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+def read_limits(fname):
+    """
+    Values of the limit tree of a limit file.
+    Raises an exception if the file is corrupted or does not have the expected number of limits.
+    """
+    with uproot.open(fname) as f:
+        values = f['limit']['limit'].array(library='np')
+    if len(values) != getExpectedLength(fname):
+        raise ValueError(f"{fname} has {len(values)} limits instead of {getExpectedLength(fname)}")
+    return values
+
+def file_checksum(fname, chunk_size=1 << 20):
+    checksum = 1
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            checksum = zlib.adler32(chunk, checksum)
+    return checksum
+
+def copy_file(src, dst_dir, chunk_size=1 << 20):
+    """
+    Copy src to dst_dir, under the same name. The copy is written to a temporary file, checked against
+    the adler32 checksum of src, and only then renamed, such that dst_dir never has a partial file.
+    Returns the checksum.
+    """
+    dst = os.path.join(dst_dir, os.path.basename(src))
+    fd, tmp = tempfile.mkstemp(dir=dst_dir, prefix='.' + os.path.basename(src), suffix='.tmp')
+    try:
+        checksum = 1
+        with open(src, 'rb') as fin, os.fdopen(fd, 'wb') as fout:
+            for chunk in iter(lambda: fin.read(chunk_size), b''):
+                checksum = zlib.adler32(chunk, checksum)
+                fout.write(chunk)
+        if file_checksum(tmp, chunk_size) != checksum:
+            raise IOError(f"The copy of {src} does not have the same checksum")
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+    return checksum
+
+def load_state(state_file):
+    """ Files already checked by --moveLimits, name -> {size, mtime, status, checksum}. """
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_state(state_file, state):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(state_file)), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp, state_file)
+
+def same_file(entry, stat):
+    return entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime
+
+def move_limit_file(remoteFile, limitDir, known=None):
+    """
+    This runs in a separate thread: checks the limit file, unless it was already found valid
+    in the same state (size, mtime), and copies it to limitDir if it is valid.
+    Returns the new state of the file.
+    """
+    stat = os.stat(remoteFile)
+    entry = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if same_file(known, stat) and known['status'] == 'valid':
+        entry['limits'] = known.get('limits')
+    else:
+        try:
+            entry['limits'] = [float(v) for v in read_limits(remoteFile)]
+        except Exception:
+            entry['status'] = 'corrupted'
+            return entry
+    entry['status'] = 'valid'
+    entry['checksum'] = copy_file(remoteFile, limitDir)
+    return entry
+
+def move_limits(remoteLimitDir, limitDir, jobs=8, dry=False, index=None, names=None):
+    """
+    Copy the valid limit files of remoteLimitDir that are not in limitDir yet, and mark the
+    corrupted ones (renamed to .corrupted.root, unless dry), using a pool of jobs threads.
+    The state of each file checked is kept in limitDir/.moveLimits.json, and the copies are
+    recorded as valid in the MonitorIndex index, if passed.
+    Only the files of remoteLimitDir in names are looked at, if passed.
+
+    Returns:
+        (number of files moved, number of corrupted files)
+    """
+    state_file = os.path.join(limitDir, '.moveLimits.json')
+    state = load_state(state_file)
+    localFiles = set(os.listdir(limitDir))
+
+    candidates = []
+    for entry in os.scandir(remoteLimitDir):
+        outFile = entry.name
+        # no need to check bad files
+        if ".corrupted.root" in outFile or ".badQuantile" in outFile: continue
+        if not outFile.endswith('.root') or not entry.is_file(): continue
+        if names is not None and outFile not in names: continue
+        # check if corresponding file is missing in outDir, if so, cp it there
+        if outFile in localFiles: continue
+        # already found corrupted, and left there by a dry run
+        known = state.get(outFile)
+        if same_file(known, entry.stat()) and known['status'] == 'corrupted': continue
+        candidates.append(outFile)
+
+    nMoved = 0
+    nDeleted = 0
+    try:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            futures = {executor.submit(move_limit_file, os.path.join(remoteLimitDir, outFile), limitDir, state.get(outFile)): outFile
+                       for outFile in candidates}
+            for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+                outFile = futures[future]
+                remoteFile = os.path.join(remoteLimitDir, outFile)
+                try:
+                    entry = future.result()
+                except OSError as e:
+                    logging.warning(f"\t --> Could not copy {remoteFile}: {e}")
+                    continue
+                state[outFile] = entry
+                if entry['status'] == 'valid':
+                    logging.debug(outFile)
+                    nMoved += 1
+                    if index is not None and entry['limits'] is not None:
+                        localFile = os.path.join(limitDir, outFile)
+                        index.record_limit(localFile, os.stat(localFile), 'valid', entry['limits'])
+                else:
+                    nDeleted += 1
+                    logging.debug("\t --> Limit not found in the file " +  remoteFile + " deleting...")
+                    if not dry: os.rename(remoteFile, remoteFile.replace('.root','.corrupted.root'))
+    finally:
+        # also keep what was done if interrupted
+        save_state(state_file, state)
+
+    return nMoved, nDeleted
+
+class DirectoryWatcher:
+    """
+    Files written in, or moved to, a set of directories, and new subdirectories.
+    Uses inotify events if inotify_simple is installed and poll is False. Otherwise the directories are
+    listed every interval seconds, and a file is only reported once its size and mtime did not change
+    between two listings, i.e. once it is done being written. Polling also works for network file systems,
+    where inotify does not see the files written by other machines.
+    """
+    def __init__(self, directories, interval=60, poll=False):
+        self.directories = list(directories)
+        self.interval = interval
+        self.inotify = None
+        if inotify_simple is not None and not poll:
+            self.inotify = inotify_simple.INotify()
+            flags = inotify_simple.flags
+            self.watches = {self.inotify.add_watch(d, flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE): d for d in self.directories}
+        else:
+            self.listings = {d: self.list(d) for d in self.directories}
+            self.pending = {d: set() for d in self.directories}
+
+    @staticmethod
+    def list(directory):
+        return {entry.name: (entry.is_dir(), entry.stat().st_size, entry.stat().st_mtime) for entry in os.scandir(directory)}
+
+    def wait(self):
+        """ Blocks until something changes, returns a dict of directory to the set of names of the new files and subdirectories. """
+        changes = {}
+        while len(changes) == 0:
+            if self.inotify is not None:
+                flags = inotify_simple.flags
+                overflow = False
+                for event in self.inotify.read(timeout=self.interval * 1000):
+                    # events were dropped, the directories are listed again below
+                    if event.mask & flags.Q_OVERFLOW:
+                        overflow = True
+                        continue
+                    # e.g. the directory was removed
+                    if event.mask & flags.IGNORED:
+                        self.watches.pop(event.wd, None)
+                        continue
+                    if event.wd not in self.watches: continue
+                    # files are only reported once they are closed, see CLOSE_WRITE
+                    if event.mask & flags.CREATE and not event.mask & flags.ISDIR: continue
+                    changes.setdefault(self.watches[event.wd], set()).add(event.name)
+                if overflow:
+                    logging.warning("Missed some file events, checking all the files again.")
+                    for d in self.watches.values():
+                        changes.setdefault(d, set()).update(os.listdir(d))
+            else:
+                time.sleep(self.interval)
+                for d in self.directories:
+                    listing = self.list(d)
+                    previous = self.listings[d]
+                    # stable since the previous listing, after having changed
+                    stable = {name for name in self.pending[d] if name in listing and listing[name] == previous.get(name)}
+                    new_dirs = {name for name, (is_dir, _, _) in listing.items() if is_dir and name not in previous}
+                    self.pending[d] = {name for name, stat in listing.items() if not stat[0] and stat != previous.get(name)}
+                    self.listings[d] = listing
+                    if len(stable | new_dirs) > 0:
+                        changes[d] = stable | new_dirs
+        return changes
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+
+def watch(limitDir, remoteLimitDir, index, method, moveLimits=False, deleteCorruptedLimits=False, dry=False,
+          jobs=8, interval=60, poll=False):
+    """
+    Check the limit files of all the samples of limitDir as they are written, moving them from
+    remoteLimitDir first if moveLimits, until they are all there and valid, or until interrupted.
+    Only the new files are opened, and their status is recorded in the MonitorIndex index.
+    """
+    watcher = DirectoryWatcher([limitDir] + ([remoteLimitDir] if moveLimits else []), interval=interval, poll=poll)
+    mode = "polling every {} s".format(interval) if watcher.inotify is None else "inotify"
+    logging.info(f"Watching {', '.join(watcher.directories)} ({mode}), stop with Ctrl-C")
+
+    def expected_files():
+        samples = [entry.name.replace("cards-", "") for entry in os.scandir(limitDir) if entry.is_dir() and "cards-" in entry.name]
+        return {f"higgsCombine{sample}.{method}.mH125{quant}.root" for sample in samples for quant in get_quantiles(method)}
+
+    def check(names):
+        """ Which of the limit files are there and valid, the corrupted ones are renamed if deleteCorruptedLimits. """
+        valid = set()
+        for f in names:
+            fname = os.path.join(limitDir, f)
+            if not os.path.isfile(fname): continue
+            status, _ = index.limit(fname, os.stat(fname))
+            if status == 'valid':
+                valid.add(f)
+                continue
+            logging.info("\t --> Limit not found in the file " + fname + (" deleting..." if deleteCorruptedLimits else ""))
+            if not dry and deleteCorruptedLimits:
+                os.rename(fname, fname.replace('.root', '.corrupted.root'))
+                index.forget_limit(fname)
+        index.db.commit()
+        return valid
+
+    expected = expected_files()
+    done = check(expected)
+    counts = None
+    try:
+        while True:
+            if counts != (len(done), len(expected)):
+                counts = (len(done), len(expected))
+                logging.info(f"{datetime.datetime.now().strftime('%H:%M:%S')} Done {len(done)} out of {len(expected)} limit files "
+                             f"({round(len(done)*100/max(len(expected), 1), 2)}%)")
+            if len(expected) > 0 and len(done) == len(expected):
+                logging.info("All the limits are done.")
+                break
+            changes = watcher.wait()
+            if moveLimits and remoteLimitDir in changes:
+                nMoved, nDeleted = move_limits(remoteLimitDir, limitDir, jobs=jobs, dry=dry, index=index, names=changes[remoteLimitDir])
+                if nMoved + nDeleted > 0: logging.info(f"Moved {nMoved} new limit files, found {nDeleted} bad ones.")
+            new = changes.get(limitDir, set())
+            if any(name.startswith("cards-") for name in new):
+                expected = expected_files()
+                new = new | (expected - done)
+            done |= check(new & expected)
+    except KeyboardInterrupt:
+        logging.info("Stopped watching.")
+    finally:
+        watcher.close()
+
 def main ():
 
     parser = argparse.ArgumentParser(description='Process some integers.')
@@ -47,6 +413,11 @@ def main ():
     parser.add_argument("-M", "--combineMethod", type=str, required=False, choices=["HybridNew", "AsymptoticLimits"], default='HybridNew', help="Which limit files to look for. Must be run with --checkMissingLimits.")
     parser.add_argument("-m", "--moveLimits", action='store_true')
     parser.add_argument("-r", "--remoteDir", type=str, required=False, default='', help="Where to move the limits from. Must be run with --move.")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="Number of threads checking and copying the limit files with --moveLimits.")
+    parser.add_argument("--rebuildIndex", action='store_true', help="Check all the cards and limit files again, instead of only those that changed since the last run.")
+    parser.add_argument("-w", "--watch", action='store_true', help="Keep running, and check (and move, with --moveLimits) the limit files as they are written, until all of them are done.")
+    parser.add_argument("--poll", action='store_true', help="With --watch, list the directories every --pollInterval seconds instead of using inotify, e.g. for network file systems.")
+    parser.add_argument("--pollInterval", type=float, default=60, help="Seconds between two listings of the directories with --watch --poll, or without inotify.")
     parser.add_argument("-t", "--tag", type=str, help="Production tag (and name of local directory) where the cards and limits are stored)", required=True, default='')
     parser.add_argument("-dry", "--dry", action='store_true', help="Don't delete any limit files.")
     parser.add_argument("-v", "--verbose", action='store_true', help="Increase output verbosity")
@@ -65,6 +436,8 @@ def main ():
         raise ValueError("Please specify remote directory with -r when asking to move files.")
     if args.deleteCorruptedLimits and not args.checkMissingLimits:
         raise ValueError("Please specify --checkMissingLimits when asking to delete corrupted limits.")
+    if args.watch and not args.checkMissingLimits and not args.moveLimits:
+        raise ValueError("Please specify --checkMissingLimits or --moveLimits when asking to watch.")
 
     # set directories
     remoteLimitDir = args.remoteDir
@@ -76,6 +449,12 @@ def main ():
     if args.moveLimits: logging.info("--moveLimits")
     if args.checkMissingLimits: logging.info("--checkMissingLimits")
 
+    # status of the files found by the previous runs
+    indexFile = os.path.join(limitDir, '.monitor.db')
+    if args.rebuildIndex and os.path.isfile(indexFile):
+        os.remove(indexFile)
+    index = MonitorIndex(indexFile if os.path.isdir(limitDir) else ':memory:')
+
     if args.checkMissingCards:
 
         logging.info('')
@@ -85,11 +464,7 @@ def main ():
         logging.info("Local directory: " + limitDir)
         logging.info('')
 
-        bins  = ['Bin1Sig','Bin2Sig',
-                'Bin3Sig','Bin4Sig',
-                'Bin0crF','Bin1crF','Bin2crF',
-                'Bin3crF','Bin4crF',
-                'cat_crA','cat_crB','cat_crC','cat_crD','cat_crE','cat_crG','cat_crH']
+        bins = get_bins()
         config_file = "config/SUEP_inputs_{}.yaml"
         years = ['2016', '2017', '2018']
         config_file = "config/SUEP_inputs_{}.yaml"
@@ -100,13 +475,28 @@ def main ():
                 inputs = yaml.safe_load(f.read())
             for sample in inputs.keys():
                 if "SUEP" not in sample: continue
+                # (size, mtime) of each card, None if it is missing
+                stamp = []
                 for bin_name in bins: 
                     for eof in ['dat','root']:
                         path = '{}/cards-{}/shapes-{}{}.{}'.format(limitDir, sample, bin_name, year, eof)
-                        if not os.path.exists(path) or os.path.getsize(path) == 0: 
-                            logging.debug("--missing:", path)
-                            missingCardsSamples.append(sample)
-                            continue
+                        try:
+                            st = os.stat(path)
+                            stamp.append([path, st.st_size, st.st_mtime])
+                        except FileNotFoundError:
+                            stamp.append([path, None, None])
+                # all the cards were there, and none of them changed since
+                if index.cards_complete(sample, year, stamp): continue
+                complete = True
+                for path, size, _ in stamp:
+                    if size is None or size == 0: 
+                        logging.debug("--missing: " + path)
+                        missingCardsSamples.append(sample)
+                        complete = False
+                if complete:
+                    index.set_cards_complete(sample, year, stamp)
+                else:
+                    index.forget_cards(sample, year)
         
         missingCardsSamples = list(set(missingCardsSamples))
 
@@ -136,30 +526,7 @@ def main ():
         logging.info("Local directory: " + limitDir)
         logging.info('')
 
-        nMoved = 0
-        nDeleted = 0
-
-        for outFile in os.listdir(remoteLimitDir):
-
-            # no need to check bad files
-            if ".corrupted.root" in outFile or ".badQuantile" in outFile: continue
-
-            # check if corresponding file is missing in outDir, if so, cp it there
-            if not os.path.isfile(os.path.join(limitDir,outFile)):
-                logging.debug(outFile)
-                remoteFile = os.path.join(remoteLimitDir,outFile)
-                try:
-                    f = uproot.open(remoteFile)
-                    if len(f['limit']['limit'].array()) == getExpectedLength(remoteFile):
-                        nMoved +=1 
-                        os.system('cp '+remoteFile+' '+limitDir)
-                    else:
-                        # raise error if we find empty limits!
-                        raise ValueError
-                except:
-                    nDeleted += 1
-                    logging.debug("\t --> Limit not found in the file " +  remoteFile + " deleting...")
-                    if not args.dry: os.system('mv '+remoteFile+ ' '+remoteFile.replace('.root','.corrupted.root'))
+        nMoved, nDeleted = move_limits(remoteLimitDir, limitDir, jobs=args.jobs, dry=args.dry, index=index)
 
         logging.info('')
         if nDeleted > 0: logging.info(f"Deleted {nDeleted} bad limit files from the remote directory.")
@@ -185,21 +552,20 @@ def main ():
         limit = args.combineMethod
 
         all_samples = []
+        localFiles = {}
         # list all subdirectories of the limitDir, these are the samples we will check
-        # for completion of the limits
-        for subdir in os.listdir(limitDir):
-            if os.path.isdir(os.path.join(limitDir,subdir)):
-                if "cards-" in subdir:
-                    all_samples.append(subdir.replace("cards-",""))
+        # for completion of the limits, and all the limit files there
+        for entry in os.scandir(limitDir):
+            if entry.is_dir():
+                if "cards-" in entry.name:
+                    all_samples.append(entry.name.replace("cards-",""))
+            elif entry.name.startswith("higgsCombine"):
+                localFiles[entry.name] = entry
 
         for sample in tqdm(all_samples):
 
-            # the quantiles are only needed for running toys with HybridNew
-            if limit == 'AsymptoticLimits':
-                quants = [""]
-            elif limit == 'HybridNew':
-                quants = ['', '.quant0.500', '.quant0.160', '.quant0.840', '.quant0.975', '.quant0.025']
-                quantsDict = {}
+            quants = get_quantiles(limit)
+            quantsDict = {}
                 
             # check if file higgsCombine{sample}.HybridNew.mH125.root exists
             for quant in quants:
@@ -207,31 +573,27 @@ def main ():
 
                 f = f"higgsCombine{sample}.{limit}.mH125{quant}.root"
                 fname = os.path.join(limitDir,f)
-                if not os.path.isfile(fname):
+                if f not in localFiles:
                     nMissingLimits +=1
                     missingLimits.append(fname)
+                    index.forget_limit(fname)
 
-                # if request, check corrupted files by loading them with uproot.
-                # deletes the file if it finds it corrupted
+                # if request, check corrupted files by loading them with uproot, unless they were
+                # already checked and did not change since. deletes the file if it finds it corrupted
                 elif args.deleteCorruptedLimits or args.checkQuantiles:
-                    f = uproot.open(fname)
-                    try:
-                        limitValue = f['limit']['limit'].array()
-                        if len(limitValue) == getExpectedLength(fname):
-                            if args.checkQuantiles:
-                                if len(limitValue) == 1 and 'quant' in quant:
-                                    quantsDict[quant.replace(".quant", "")] = limitValue[0]
-                            continue
-                        else:
-                            # raise error if we find empty limits!
-                            raise ValueError
-                    except:
-                        logging.debug("\t --> Limit not found in the file " + fname + " deleting...")
-                        if not args.dry and args.deleteCorruptedLimits: 
-                            os.system('mv '+fname+' '+fname.replace('.root','.corrupted.root'))
-                        nBadLimit += 1
-                        nMissingLimits += 1
-                        missingLimits.append(fname)
+                    status, limitValue = index.limit(fname, localFiles[f].stat())
+                    if status == 'valid':
+                        if args.checkQuantiles:
+                            if len(limitValue) == 1 and 'quant' in quant:
+                                quantsDict[quant.replace(".quant", "")] = limitValue[0]
+                        continue
+                    logging.debug("\t --> Limit not found in the file " + fname + " deleting...")
+                    if not args.dry and args.deleteCorruptedLimits: 
+                        os.rename(fname, fname.replace('.root','.corrupted.root'))
+                        index.forget_limit(fname)
+                    nBadLimit += 1
+                    nMissingLimits += 1
+                    missingLimits.append(fname)
                         
             if args.checkQuantiles:
                 sorted_dict = dict(sorted(quantsDict.items(), key=lambda item: float(item[0])))
@@ -271,5 +633,15 @@ def main ():
                         os.system('mv '+ args.remoteDir + fname+' ' + args.remoteDir + fname.replace('.root','.badQuantile.root'))
                     f.write(f"\n{fname}")
 
+    if args.watch:
+
+        logging.info('')
+        logging.info("-"*50)
+        logging.info("--watch")
+        watch(limitDir, remoteLimitDir, index, args.combineMethod, moveLimits=args.moveLimits, deleteCorruptedLimits=args.deleteCorruptedLimits,
+              dry=args.dry, jobs=args.jobs, interval=args.pollInterval, poll=args.poll)
+
+    index.close()
+
 if __name__ == "__main__":
     main()
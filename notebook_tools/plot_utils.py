@@ -14,6 +14,13 @@ from matplotlib.lines import Line2D
 from matplotlib.legend_handler import HandlerLine2D
 import mplhep as hep
 from scipy.ndimage import gaussian_filter1d
+import importlib.util
+
+# ftool/xsec.py is loaded on its own, without the ftool package and its dependencies
+_spec = importlib.util.spec_from_file_location(
+    "xsec_registry", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ftool", "xsec.py"))
+xsec_registry = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(xsec_registry)
 
 np.seterr(divide='ignore', invalid='ignore')
 
@@ -69,12 +76,7 @@ def get_SUEP_file(ms=125, mphi=2, temp=1, decay='generic', path="../", method='A
 
 
 def xs_scale(proc, file="../config/xsections_SUEP.json"):
-    xsec = -1.0
-    with open(file) as file:
-        MC_xsecs = json.load(file)
-    xsec  = MC_xsecs[proc]["xsec"]
-    # xsec *= MC_xsecs[proc]["kr"] # this is fine commented out!
-    # xsec *= MC_xsecs[proc]["br"] # this is fine commented out!
+    xsec = xsec_registry.get_xsec(proc, file, kr=False, br=False) # kr and br are fine left out!
     assert xsec > 0, "{} has a null cross section!".format(proc)
     return xsec
 
@@ -138,8 +140,7 @@ def filter_samples(ms=None, mphi=None, temp=None, decay=None, file='../config/xs
     """
     
     # load in all the samples that should exist
-    with open(file) as json_file:
-        samples = list(json.load(json_file).keys())
+    samples = list(xsec_registry.get_table(file).keys())
 
     # filter them by the parameters you want
     combinations = []
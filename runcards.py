@@ -5,23 +5,38 @@ this script will pull from there using:
     makeXYZDataCard.get_bins()        # list of bins to run over per sample
     makeXYZDataCard.get_commands()    # list of commands to run per sample, one per bin
     makeXYZDataCard.get_config_file() # .yaml file of samples
+If the script also defines them, all the bins of a sample are made in one process with:
+    makeXYZDataCard.build_cards()       # makes the cards of all the bins of a sample, called directly
+    makeXYZDataCard.get_build_command() # command calling build_cards, for slurm and slurm-array
+    makeXYZDataCard.stale_cards()       # bins of a sample whose inputs changed since they were made
+
+With -m processpool, each worker process makes the data-driven datagroups once, via
+    makeXYZDataCard.warm_up()           # optional, called once per era in each worker
+and then calls build_cards for chunks of samples.
 
 Example usage:
     python runcards.py -m multithread -c 1000 -channel ggf-offline
+    python runcards.py -m processpool -c 16 -channel ggf-offline
+    python runcards.py -m slurm-array --chunkSize 20 -channel ggf-offline
+    python runcards.py -m processpool -c 16 -channel ggf-offline --profile profile/
 
 Authors: Luca Lavezzo, Chad Freer, Pieter van Steenweghen
 """
 
 import argparse
+import importlib
 import yaml
 import glob
 import os
+import time
 import multiprocessing
+import concurrent.futures
 import subprocess
 import shlex
 import numpy as np
 from multiprocessing.pool import ThreadPool
 
+import ftool
 import makeOfflineDataCard
 import makeScoutingDataCard
 
@@ -32,6 +47,62 @@ def call_makeDataCard(cmd):
     out, err = p.communicate()
     return (out, err)
 
+def call_buildCards(module_name, sample, year, tag, cache_dir=None, store=None, profile=None, **build_options):
+    """ This runs in a separate process, making all the cards of a sample without launching any subprocess. """
+    print(" ---- [%] :", sample, year)
+    try:
+        ftool.cache.cache_dir = cache_dir
+        ftool.profiling.enabled = profile is not None
+        store = ftool.open_store(store) if store else None
+        importlib.import_module(module_name).build_cards(sample, year, tag=tag, store=store, **build_options)
+    except Exception as e:
+        return (b"", "{} {}: {!r}".format(sample, year, e).encode())
+    finally:
+        if profile is not None:
+            ftool.profiling.dump(profile)
+    return (b"", b"")
+
+# state of each worker process of -m processpool, set once by init_worker
+_worker = {}
+
+def init_worker(module_name, eras, cache_dir=None, store=None, profile=None):
+    """ This runs once in each worker process, loading the inputs and making the data-driven datagroups of the eras. """
+    ftool.cache.cache_dir = cache_dir
+    ftool.profiling.enabled = profile is not None
+    ftool.profiling.reset() # the records of the main process are not copied over to the workers
+    _worker["profile"] = profile
+    module = importlib.import_module(module_name)
+    _worker["module"] = module
+    _worker["store"] = ftool.open_store(store) if store else None
+    _worker["inputs"] = {}
+    for era in eras:
+        with open(module.get_config_file().format(era)) as f:
+            _worker["inputs"][era] = yaml.safe_load(f.read())
+        if hasattr(module, 'warm_up'):
+            module.warm_up(era, inputs=_worker["inputs"][era], store=_worker["store"])
+
+def call_buildChunk(chunk, tag, **build_options):
+    """ This runs in a worker process, making the cards of a chunk of (sample, era) with its warm state. """
+    errors = []
+    for sample, year in chunk:
+        print(" ---- [%] :", sample, year)
+        try:
+            _worker["module"].build_cards(sample, year, tag=tag, inputs=_worker["inputs"][year], store=_worker["store"], **build_options)
+        except Exception as e:
+            errors.append("{} {}: {!r}".format(sample, year, e))
+    if _worker["profile"] is not None:
+        # all the records of this worker so far, including its warm up
+        ftool.profiling.dump(_worker["profile"])
+    return (b"", "\n".join(errors).encode())
+
+def make_chunks(tasks, chunk_size):
+    """ Split the (sample, era) tasks into chunks of at most chunk_size, each of a single era. """
+    chunks = []
+    for year in sorted(set(year for _, year in tasks)):
+        era_tasks = [task for task in tasks if task[1] == year]
+        chunks += [era_tasks[i:i + chunk_size] for i in range(0, len(era_tasks), chunk_size)]
+    return chunks
+
 # SLURM script template
 slurm_script_template = '''#!/bin/bash
 #SBATCH --job-name={sample}
@@ -47,19 +118,40 @@ conda activate SUEP
 {cmd}
 '''
 
+# SLURM job array template, each task runs one line of the commands file
+slurm_array_script_template = '''#!/bin/bash
+#SBATCH --job-name={job_name}
+#SBATCH --output={log_dir}{job_name}_%a.out
+#SBATCH --error={log_dir}{job_name}_%a.err
+#SBATCH --time=05:00:00
+#SBATCH --mem=1GB
+#SBATCH --partition=submit
+#SBATCH --array=0-{last_task}
+
+source ~/.bashrc
+cd {work_dir}
+conda activate SUEP
+cmd=$(sed -n "$((SLURM_ARRAY_TASK_ID+1))p" {commands_file})
+echo "$cmd"
+eval "$cmd"
+'''
+
 def main():
     
     # script parameters
     parser = argparse.ArgumentParser(description="Famous Submitter")
     parser.add_argument(
-        "-m", "--method", type=str, default="slurm", choices=['slurm', 'multithread'], help="How to execute the code: either via multithread or slurm."
+        "-m", "--method", type=str, default="slurm", choices=['slurm', 'slurm-array', 'multithread', 'processpool'], help="How to execute the code: either via multithread (a pool of local processes), processpool (a pool of local processes, each making the data-driven datagroups once), slurm (one job per sample), or slurm-array (one job array, each task making a chunk of samples)."
     )
     parser.add_argument(
-        "-f", "--force",action="store_true", help="Recreate cards even if they already exist. By default, it will not re-run existing cards."
+        "-f", "--force",action="store_true", help="Recreate cards even if they already exist. By default, it will only re-run the cards that are missing or whose inputs changed."
     )
     parser.add_argument(
         "-c", "--cores", type=int, default=1000, help="Max number of CPUs to run on, if multithreading."
     )
+    parser.add_argument(
+        "--chunkSize", type=int, default=0, help="Number of samples made by each task, if processpool or slurm-array. Defaults to splitting the samples of each era evenly across the CPUs for processpool, and to 10 for slurm-array."
+    )
     parser.add_argument(
         "-t", "--tag", type=str, default='cards', help="Output tag for cards. Creates a subfolder and puts cards there."
     )
@@ -68,17 +160,46 @@ def main():
     parser.add_argument("-file"  , "--file", type=str, required=False, help='List of samples you want to make datacards for.')
     parser.add_argument("-channel"  , "--channel", type=str, required=True, choices=['ggf-offline', 'ggf-scouting'], help='Which channel to run on.')
     parser.add_argument("-v", "--verbose", action="store_true", help="Print out more information.")
+    parser.add_argument("--cacheDir", type=str, default=None, help="Directory where the data and expected datagroups are cached and shared across samples and jobs. Defaults to <tag>/.cache/.")
+    parser.add_argument("--noCache", action="store_true", help="Do not cache the data and expected datagroups on disk.")
+    parser.add_argument("--store", type=str, default=None, help="Read the histograms from this store, made with makeHistStore.py, instead of the ROOT files.")
+    parser.add_argument("--shapesPerSample", action="store_true", help="Write the shapes of all the bins of a sample and era in one file, with a directory per bin, instead of one file per card.")
+    parser.add_argument("--profile", type=str, default=None, help="Record the wall time, CPU time and peak memory of each stage of making the cards, per sample, era and bin, and write them to report.json and report.csv in this directory.")
     options = parser.parse_args()
 
+    if options.noCache:
+        options.cacheDir = None
+    elif options.cacheDir is None:
+        options.cacheDir = os.path.join(os.path.abspath(options.tag), '.cache')
+    if options.store:
+        options.store = os.path.abspath(options.store)
+    if options.profile:
+        options.profile = os.path.abspath(options.profile)
+        ftool.profiling.enabled = True
+        ftool.profiling.clear(options.profile)
+    store = ftool.open_store(options.store) if options.store else None
+    # passed to build_cards
+    build_options = {'force': options.force, 'shapes_per_sample': options.shapesPerSample}
+
     if options.file:
         with open(options.file) as f:
             samplesToRun = f.read().splitlines()
 
-    if options.method == 'multithread':
+    if options.channel == 'ggf-offline':
+        datacard_module = makeOfflineDataCard
+    elif options.channel == 'ggf-scouting':
+        datacard_module = makeScoutingDataCard
+    # build all the bins of a sample in one process, if the datacard script supports it
+    in_process = hasattr(datacard_module, 'build_cards')
+    if options.method in ['processpool', 'slurm-array'] and not in_process:
+        raise Exception("{} needs build_cards in {}, use multithread or slurm".format(options.method, datacard_module.__name__))
+
+    if options.method in ['multithread', 'processpool']:
         n_cpus = min(multiprocessing.cpu_count(), options.cores)
-        pool = ThreadPool(n_cpus)
+    if options.method == 'multithread':
+        pool = multiprocessing.Pool(n_cpus) if in_process else ThreadPool(n_cpus)
         print("Running on", n_cpus, "CPUs")
-    elif options.method == 'slurm':
+    elif options.method in ['slurm', 'slurm-array']:
         work_dir = os.getcwd()
         log_dir = '/work/submit/{}/SUEP/logs/{}/'.format(os.environ['USER'], 'slurm_runcards')
         if not os.path.isdir(log_dir): os.mkdir(log_dir)
@@ -90,13 +211,11 @@ def main():
     print("Writing out to", options.tag)
     
     results = []
+    tasks = [] # (sample, era) to run, if processpool or slurm-array
     years = ['2016', '2017', '2018']
     for year in years:
 
-        if options.channel == 'ggf-offline':
-            config_file = makeOfflineDataCard.get_config_file()
-        elif options.channel == 'ggf-scouting':
-            config_file = makeScoutingDataCard.get_config_file()
+        config_file = datacard_module.get_config_file()
 
         with open(config_file.format(year)) as f: 
             try:
@@ -121,16 +240,21 @@ def main():
                 if n not in samplesToRun: continue
 
             # grab the commands and bins for this sample
-            if options.channel == 'ggf-offline':
-                commands = makeOfflineDataCard.get_commands(options, n, year)
-                bins = makeOfflineDataCard.get_bins()
-            elif options.channel == 'ggf-scouting':
-                commands = makeScoutingDataCard.get_commands(options, n, year)
-                bins = makeScoutingDataCard.get_bins()
+            if in_process:
+                commands = [datacard_module.get_build_command(options, n, year)]
+            else:
+                commands = datacard_module.get_commands(options, n, year)
+            bins = datacard_module.get_bins()
 
             # either force the run, or check whether the file already exist before running
             run = False
             if options.force: run = True
+            elif hasattr(datacard_module, 'stale_cards'):
+                # run if any of the cards is missing, or was made from inputs that changed since
+                path = '{}/cards-{}'.format(options.tag, n)
+                with ftool.profiling.stage("stale_check", sample=n, era=year):
+                    run = len(datacard_module.stale_cards(n, year, bins, tag=options.tag, inputs=inputs, store=store,
+                                                          shapes_per_sample=options.shapesPerSample)) > 0
             else:
                 for bin_name in bins: 
                     for eof in ['dat','root']:
@@ -138,15 +262,21 @@ def main():
                         if not os.path.exists(path) or os.path.getsize(path) == 0: 
                             run = True
             if not run: 
-                print("File exists, skipping (use -f to overwrite):", path)
+                print("Up to date, skipping (use -f to overwrite):", path)
                 continue
             
             print(" ===== processing : ", n, year)
             if options.verbose: print(" ---- inputs : ", sam)
 
             if options.method == 'multithread':
-                for cmd in commands:
-                    results.append(pool.apply_async(call_makeDataCard, (cmd,)))
+                if in_process:
+                    results.append(pool.apply_async(call_buildCards, (datacard_module.__name__, n, year, options.tag, options.cacheDir, options.store, options.profile), build_options))
+                else:
+                    for cmd in commands:
+                        results.append(pool.apply_async(call_makeDataCard, (cmd,)))
+
+            elif options.method in ['processpool', 'slurm-array']:
+                tasks.append((n, year))
             
             elif options.method == 'slurm':
                 slurm_script_content = slurm_script_template.format(
@@ -169,11 +299,61 @@ def main():
         pool.join()
         for result in results:
             out, err = result.get()
-            if "No such file or directory" in str(err):
+            if "No such file or directory" in str(err) or (in_process and err):
                 print(str(err))
                 print(" ----------------- ")
                 print()
-            
-            
+
+    elif options.method == 'processpool' and len(tasks) > 0:
+        eras = sorted(set(year for _, year in tasks))
+        chunk_size = options.chunkSize
+        if chunk_size <= 0:
+            chunk_size = max(1, -(-len(tasks) // (len(eras) * n_cpus)))
+        chunks = make_chunks(tasks, chunk_size)
+        n_workers = min(n_cpus, len(chunks))
+        print("Running", len(tasks), "samples in", len(chunks), "chunks on", n_workers, "CPUs")
+        with concurrent.futures.ProcessPoolExecutor(n_workers, initializer=init_worker,
+                                                    initargs=(datacard_module.__name__, eras, options.cacheDir, options.store, options.profile)) as executor:
+            futures = [executor.submit(call_buildChunk, chunk, options.tag, **build_options) for chunk in chunks]
+            for future in concurrent.futures.as_completed(futures):
+                out, err = future.result()
+                if err:
+                    print(err.decode())
+                    print(" ----------------- ")
+                    print()
+
+    elif options.method == 'slurm-array' and len(tasks) > 0:
+        # one array task per chunk, making all of its samples in a single process
+        chunks = make_chunks(tasks, options.chunkSize if options.chunkSize > 0 else 10)
+        job_name = 'runcards_' + os.path.basename(os.path.abspath(options.tag))
+        # the files of each submission have their own names, such that submitting again does not change the pending tasks
+        submission = time.strftime('%Y%m%d-%H%M%S') + '-' + str(os.getpid())
+        commands_file = f'{log_dir}{job_name}_{submission}.txt'
+        with open(commands_file, 'w') as f:
+            for chunk in chunks:
+                f.write(datacard_module.get_build_command(options, [n for n, _ in chunk], chunk[0][1]) + '\n')
+
+        slurm_script_content = slurm_array_script_template.format(
+                                    job_name=job_name,
+                                    commands_file=commands_file,
+                                    work_dir=work_dir,
+                                    log_dir=log_dir,
+                                    last_task=len(chunks)-1)
+        slurm_script_file = f'{log_dir}{job_name}_{submission}.sh'
+        with open(slurm_script_file, 'w') as f:
+            f.write(slurm_script_content)
+
+        print("Submitting", len(tasks), "samples in an array of", len(chunks), "tasks")
+        subprocess.run(['sbatch', slurm_script_file])
+
+    if options.profile:
+        ftool.profiling.dump(options.profile)
+        if options.method in ['multithread', 'processpool']:
+            ftool.profiling.print_summary(ftool.profiling.write_report(options.profile))
+            print("Profile written to", options.profile)
+        else:
+            # each job adds its records to the report when it is done
+            print("The jobs write their profile to", options.profile)
+
 if __name__ == "__main__":
     main()
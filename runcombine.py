@@ -1,13 +1,30 @@
 import os
+import re
 import glob
+import json
+import math
+import shutil
+import hashlib
+import tempfile
+import threading
+import time
+import functools
 import multiprocessing
-from multiprocessing.pool import ThreadPool
+import concurrent.futures
 import subprocess
-import shlex
 import argparse
+import importlib.util
+from cardlayout import get_bins, get_manifest_path
 
-# HTCondor script template
-condor_script_template = '''
+# ftool/combinecards.py is loaded on its own, since the ftool package needs e.g. uproot and hist,
+# which are missing within cmsenv
+_spec = importlib.util.spec_from_file_location(
+    "combinecards", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ftool", "combinecards.py"))
+combinecards = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(combinecards)
+
+# HTCondor environment setup, building CMSSW and combine
+condor_setup_template = '''
 
 echo "Setting up environment"
 export VO_CMS_SW_DIR=/cvmfs/cms.cern.ch
@@ -33,7 +50,10 @@ scramv1 b clean; scramv1 b -j 10
 
 echo "pwd"
 pwd
+'''
 
+# HTCondor script template
+condor_script_template = condor_setup_template + '''
 echo "tar -xvf ../../cards.tar.gz -C ."
 tar -xvf ../../cards.tar.gz -C .
 
@@ -54,6 +74,21 @@ echo "{combine_command}"
 xrdcp *.root root://submit50.mit.edu/{condor_out_dir}/
 '''
 
+# HTCondor script template running many combine tasks after a single setup
+condor_packed_script_template = condor_setup_template + '''
+echo "mv ../../cards-* ."
+mv ../../cards-* .
+
+echo "ls"
+ls
+
+echo "cmsenv"
+cmsenv
+{commands}
+
+xrdcp *.root root://submit50.mit.edu/{condor_out_dir}/
+'''
+
 # HTCondor submission script
 condor_submission_script = '''
 universe              = vanilla
@@ -98,27 +133,342 @@ echo "cd {work_dir}"
 cd {work_dir}
 echo "cmsenv"
 cmsenv
-echo "{rm_command}"
-{rm_command}
-echo "{combine_card_command}"
-{combine_card_command}
-echo "{text2workspace_command}"
-{text2workspace_command}
-echo "{combine_command}"
-{combine_command}
+{commands}
 
 '''
 
+# SLURM job array template, each task sources its own script of commands
+slurm_array_script_template = '''#!/bin/bash
+#SBATCH --job-name={job_name}
+#SBATCH --output={log_dir}{job_name}_%a.out
+#SBATCH --error={log_dir}{job_name}_%a.err
+#SBATCH --time={time_limit}
+#SBATCH --mem={mem}
+#SBATCH --partition=submit
+#SBATCH --tasks-per-node {cpus}
+#SBATCH --oversubscribe
+#SBATCH --array=0-{last_task}
+
+source ~/.bashrc
+echo "cd {work_dir}"
+cd {work_dir}
+echo "cmsenv"
+cmsenv
+echo "source {log_dir}{job_name}_{submission}_$SLURM_ARRAY_TASK_ID.sh"
+source {log_dir}{job_name}_{submission}_$SLURM_ARRAY_TASK_ID.sh
+'''
+
+
+# rough wall time in hours of each combine command on one CPU, and of setting up each condor job,
+# used to pack the combine commands into condor jobs with -m condor-packed, and into tasks with -m slurm-array
+combine_hours = {
+    'AsymptoticLimits': 0.05,
+    'HybridNew': 2.0,
+    'HybridNewAuto': 2.05,
+}
+card_hours = 0.02  # combineCards.py and text2workspace.py, once per sample per job
+grid_job_hours = 0.25  # one job of toys at one point of the grid, with --grid
+setup_hours = 0.5  # cmsrel, cloning and building combine, once per job
+time_limit_factor = 3  # the time limits of the slurm-array tasks are their rough cost above times this, as it is only an estimate
+
+class ResultCache:
+    """
+    Content-addressed store of the higgsCombine*.root files. The result of a combine command is kept under the
+    hash of the combined card, of the content of the shapes files it reads and of the command itself (method,
+    quantile, options), such that the same fit is not run again, e.g. in another production or with -f.
+    """
+    # bump when what goes into the keys changes, so old entries are not picked up
+    version = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._digests = {} # (shapes file, mtime, size) -> hash of its content
+
+    def file_digest(self, path):
+        """ Hash of the content of the file, computed once per state of the file. """
+        st = os.stat(path)
+        stamp = (os.path.abspath(path), st.st_mtime, st.st_size)
+        if stamp not in self._digests:
+            digest = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+            self._digests[stamp] = digest.hexdigest()
+        return self._digests[stamp]
+
+    def card_digest(self, card):
+        """ Hash of the combined card and of the shapes files it reads, None if any of them is missing. """
+        if not os.path.isfile(card):
+            return None
+        with open(card, 'rb') as f:
+            text = f.read()
+        digest = hashlib.sha1(text)
+        # e.g. shapes * Bin1Sig2018 cards-<name>/shapes-Bin1Sig2018.root $PROCESS $PROCESS_$SYSTEMATIC
+        shapes = sorted(set(line.split()[3] for line in text.decode().splitlines() if line.startswith('shapes ')))
+        for shape in shapes:
+            if not os.path.isfile(shape):
+                return None
+            digest.update('{} {}'.format(shape, self.file_digest(shape)).encode())
+        return digest.hexdigest()
+
+    def key(self, card_digest, command):
+        """ Key of the result of running the combine command on the card. """
+        return hashlib.sha1(repr((self.version, card_digest, ' '.join(command.split()))).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.root')
+
+    def fetch(self, key, outFile):
+        """ Copy the cached result to outFile, if there is one. Returns whether there was. """
+        if not os.path.isfile(self.path(key)):
+            return False
+        fd, tmp = tempfile.mkstemp(dir='.', suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(self.path(key), tmp)
+        os.replace(tmp, outFile)
+        return True
+
+    def store_command(self, key, outFile):
+        """ Shell command storing outFile as the result of key, written under a temporary name such that it is always complete. """
+        path = self.path(key)
+        return "mkdir -p {dir} && cp {out} {path}.$$.tmp && mv {path}.$$.tmp {path}".format(dir=os.path.dirname(path), out=outFile, path=path)
+
 
-def call_combine(cmd):
-    p = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = p.communicate()
-    return (out, err)
+class RangeTable:
+    """
+    r range of each quantile of each sample, around its asymptotic limit, for -M HybridNewAuto. The limits are read
+    with uproot from higgsCombine<sample>.AsymptoticLimits.mH125.root, and the ranges kept in a small table, a .json
+    file, until that file changes.
+    """
+    def __init__(self, path, factor, remote_dir=None):
+        """
+        factor: the range of a quantile is from its asymptotic limit divided by factor to it multiplied by factor
+        remote_dir: where the jobs write the asymptotic limits, if not here, e.g. with condor
+        """
+        self.path = path
+        self.factor = factor
+        self.remote_dir = remote_dir
+        self.table = {} # sample -> {"stamp": state of its asymptotic limits, "ranges": {quantile: [rMin, rMax]}}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.table = json.load(f)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def asymptotic_file(name):
+        return "higgsCombine{}.AsymptoticLimits.mH125.root".format(name)
+
+    def find(self, name):
+        """ Path of the asymptotic limits of the sample, here or else in remote_dir, None if they are in neither. """
+        fname = self.asymptotic_file(name)
+        if os.path.isfile(fname):
+            return fname
+        if self.remote_dir is not None and os.path.isfile(os.path.join(self.remote_dir, fname)):
+            return os.path.join(self.remote_dir, fname)
+        return None
+
+    def get(self, name):
+        """ dict of quantile ('' for the observed, '0.025', ...) to [rMin, rMax], None if the sample has no asymptotic limits yet. """
+        fname = self.find(name)
+        if fname is None:
+            return None
+        stamp = [os.path.getmtime(fname), os.path.getsize(fname), self.factor]
+        with self._lock:
+            if name not in self.table or self.table[name]["stamp"] != stamp:
+                # only needed with HybridNewAuto, the rest of runcombine.py does not read ROOT files
+                import uproot
+                try:
+                    with uproot.open(fname) as f:
+                        limits = f['limit'].arrays(['limit', 'quantileExpected'], library='np')
+                except Exception as e:
+                    print(" -- could not read", fname, ":", e)
+                    return None
+                ranges = {}
+                for limit, quantile in zip(limits['limit'], limits['quantileExpected']):
+                    ranges['' if quantile < 0 else '{:.3f}'.format(quantile)] = [float(limit) / self.factor, float(limit) * self.factor]
+                self.table[name] = {"stamp": stamp, "ranges": ranges}
+                self.save()
+            return self.table[name]["ranges"]
+
+    def range(self, name, quant):
+        """
+        [rMin, rMax] of the quantile of the sample. If its asymptotic limit is missing, e.g. the fit failed,
+        the range covers those of all the other quantiles. None if there are none.
+        """
+        ranges = self.get(name)
+        if not ranges:
+            return None
+        if quant in ranges:
+            return ranges[quant]
+        return [min(r[0] for r in ranges.values()), max(r[1] for r in ranges.values())]
+
+    def save(self):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.table, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+eras = ['2016', '2017', '2018']
+
+
+def get_cards(name):
+    """
+    Label, path, manifest and bin of each card of a sample, one per bin of cardlayout.get_bins() and era, e.g.
+    ('catcrA2016', 'cards-<name>/shapes-cat_crA2016.dat', './cards-<name>/manifest-2016.json', 'cat_crA'),
+    as combined into cards-<name>/combined.dat, see ftool.combinecards.combine.
+    """
+    return [(b.replace('_', '') + era, "cards-{}/shapes-{}{}.dat".format(name, b, era), get_manifest_path(".", name, era), b)
+            for era in eras for b in get_bins()]
+
+
+def call_commands(commands, capture=True):
+    """
+    Run the shell commands in order, stopping at the first one that fails. The commands can also be
+    a function returning them, called only now, e.g. once the stages they depend on were run.
+
+    Returns:
+        (whether they all succeeded, stderr of the last command run, if captured)
+    """
+    if callable(commands):
+        try:
+            commands = commands()
+        except Exception as e:
+            return (False, str(e).encode())
+    if isinstance(commands, str):
+        commands = [commands]
+    for cmd in commands:
+        p = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE if capture else None, stderr=subprocess.PIPE if capture else None)
+        if p.returncode != 0:
+            return (False, p.stderr)
+    return (True, p.stderr if len(commands) > 0 else None)
+
+
+class StageGraph:
+    """
+    Stages to run, each a list of shell commands, or a function returning them, with the stages they depend
+    on, e.g. for each sample its combined.dat, then its combined.root, then combine for each quantile. Each stage is run once, in a pool
+    of threads, as soon as all the stages it depends on succeeded, and the stages depending on one that
+    failed are not run.
+    """
+    def __init__(self):
+        self.stages = {} # name -> (commands, names of the stages it depends on)
+
+    def __len__(self):
+        return len(self.stages)
+
+    def add(self, name, commands, deps=()):
+        """ Add a stage, after the stages it depends on, and return its name. """
+        if name in self.stages:
+            raise ValueError("Stage {} was already added".format(name))
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError("Stage {} depends on {}, which was not added before it".format(name, dep))
+        self.stages[name] = (commands if callable(commands) else list(commands), list(deps))
+        return name
+
+    def run(self, workers, capture=True):
+        """
+        Run all the stages, at most workers at a time. Their output is printed as they run unless capture,
+        in which case the errors of the stages that failed are printed.
+
+        Returns:
+            dict of each stage to 'done', 'failed', or 'skipped' if a stage it depends on did not succeed
+        """
+        status = {}
+        pending = list(self.stages)
+        running = {} # future -> stage
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            while len(pending) > 0 or len(running) > 0:
+                # the stages come after the ones they depend on, so one pass settles all that can be
+                waiting = []
+                for name in pending:
+                    commands, deps = self.stages[name]
+                    if any(status.get(dep) in ['failed', 'skipped'] for dep in deps):
+                        status[name] = 'skipped'
+                    elif all(status.get(dep) == 'done' for dep in deps):
+                        running[pool.submit(call_commands, commands, capture)] = name
+                    else:
+                        waiting.append(name)
+                pending = waiting
+                if len(running) == 0:
+                    continue
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    ok, err = future.result()
+                    status[name] = 'done' if ok else 'failed'
+                    if not ok and err:
+                        print(name, "failed:")
+                        print(err.decode(errors='replace'))
+                        print(" ----------------- ")
+                        print()
+        return status
+
+
+def submit_slurm(commands, outFile, dependency=None, **kwargs):
+    """
+    Write the slurm script running the commands, with the job settings of slurm_script_template
+    passed as keyword arguments, and submit it, to start only once the job dependency succeeded if passed.
+
+    Returns:
+        the id of the submitted job
+    """
+    slurm_script_content = slurm_script_template.format(commands='\n'.join(commands), outFile=outFile, **kwargs)
+
+    # Write the SLURM script to a file
+    slurm_script_file = '{}submit_{}.sh'.format(kwargs['log_dir'], outFile)
+    with open(slurm_script_file, 'w') as f:
+        f.write(slurm_script_content)
+
+    # Submit the SLURM job
+    sbatch = ['sbatch', '--parsable']
+    if dependency is not None:
+        sbatch.append('--dependency=afterok:{}'.format(dependency))
+    out = subprocess.run(sbatch + [slurm_script_file], stdout=subprocess.PIPE, check=True).stdout
+    return out.decode().strip().split(';')[0]
+
+
+def pack_jobs(costs, max_hours):
+    """
+    Pack the combine commands of the samples into as few jobs as possible of at most max_hours each,
+    first fit decreasing. The commands of a sample go to the same job, such that its cards are combined
+    once, unless they alone take longer than max_hours, in which case they are split across jobs.
+
+    Inputs:
+        costs: dict of sample to the list of hours of each of its combine commands
+        max_hours: target length of the jobs, excluding the setup
+
+    Returns:
+        list of jobs, each a list of (sample, indices of its combine commands)
+    """
+    items = []
+    for name, hours in costs.items():
+        current, current_hours = [], card_hours
+        for i, h in enumerate(hours):
+            if len(current) > 0 and current_hours + h > max_hours:
+                items.append((current_hours, name, current))
+                current, current_hours = [], card_hours
+            current.append(i)
+            current_hours += h
+        items.append((current_hours, name, current))
+
+    jobs, job_hours = [], []
+    for hours, name, indices in sorted(items, key=lambda item: -item[0]):
+        for j in range(len(jobs)):
+            if job_hours[j] + hours <= max_hours:
+                jobs[j].append((name, indices))
+                job_hours[j] += hours
+                break
+        else:
+            jobs.append([(name, indices)])
+            job_hours.append(hours)
+    return jobs
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
-        "-m", "--method", type=str, default="iterative", choices=['iterative', 'slurm', 'multithread', 'condor'], help="How to execute the code."
+        "-m", "--method", type=str, default="iterative", choices=['iterative', 'slurm', 'slurm-array', 'multithread', 'condor', 'condor-packed'], help="How to execute the code. slurm-array submits a single job array, each task running the combine commands of a chunk of samples. condor-packed packs the combine commands of many samples into each condor job, see --jobHours."
 )
 parser.add_argument("-p"  , "--print_commands"   , action='store_true', help='Print the executed combine commands.')
 parser.add_argument("-file"  , "--file", type=str, help='Rerun a list of samples stored in a file.')
@@ -130,8 +480,180 @@ parser.add_argument("-d"  , "--dry", action='store_true', help="Dry run, does no
 parser.add_argument("-includeAll", "--includeAll", type=str, default='', help="Pass a '-' separated list of strings you want all your samples to include. e.g. generic-mPhi300 will only run samples that contain 'generic' AND 'mPhi300' in the name.")
 parser.add_argument("-includeAny", "--includeAny", type=str, default='', help="Pass a '-' separated list of strings you want any of your samples to include. e.g. generic-mPhi300 will only run samples that contain 'generic' OR 'mPhi300' in the name.")
 parser.add_argument("-q", "--quantiles", action='store_true', default=False, help="When running '-M HybridNew' or '-M HybridNewAuto', use this option to run the following quantiles (0.025, 0.16, 0.5, 0.84, 0.975) as well as the observed limit, automatically. Equivalent to running this script with '-o '--expectedFromGrid <QUANTILE>'' for all quantiles.") 
+parser.add_argument("--cardCombiner", type=str, default="native", choices=['native', 'combineCards'], help="How to make the combined.dat cards. native combines the cards of all the samples here, on all the cores, before running or submitting anything; samples whose cards were made without the summaries this needs, by an older version, fall back to combineCards.py.")
+parser.add_argument("--resultCache", type=str, default=None, help="Directory of the cache of the higgsCombine*.root files, keyed by the hash of the combined card, its shapes files and the combine command, shared across productions. The fits found there are not run again, also with -f. Defaults to ~/.cache/SUEPLimits/results/.")
+parser.add_argument("--noResultCache", action='store_true', help="Neither use nor fill the cache of the higgsCombine*.root files, e.g. to rerun fits with -f.")
+parser.add_argument("--rangeFactor", type=float, default=2.0, help="With '-M HybridNewAuto', the toys of each quantile are run with --rMin and --rMax its asymptotic limit divided and multiplied by this factor.")
+parser.add_argument("--grid", action='store_true', help="With '-M HybridNew' or '-M HybridNewAuto', throw the toys at --gridPoints values of r, in --jobsPerPoint short jobs each, then merge them into grid-<sample>.root and compute the limits of all the quantiles from it with --readHybridResults. The range of r is --gridRange, or that of the asymptotic limits with HybridNewAuto.")
+parser.add_argument("--gridPoints", type=int, default=20, help="Number of values of r of the grid, with --grid.")
+parser.add_argument("--jobsPerPoint", type=int, default=1, help="Number of jobs throwing the toys at each point of the grid, with --grid.")
+parser.add_argument("--toysPerJob", type=int, default=500, help="Number of toys thrown by each job of the grid, with --grid.")
+parser.add_argument("--gridRange", type=str, default=None, help="rMin,rMax of the grid, with --grid, e.g. --gridRange 0.1,10. By default, with HybridNewAuto, from the asymptotic limits of each sample.")
+parser.add_argument("--jobHours", type=float, default=4, help="Target length in hours of each job, if condor-packed, or of each task, if slurm-array. The combine commands are packed into jobs using a rough cost per combine method and quantile.")
+parser.add_argument("--maxTaskHours", type=int, default=48, help="Longest time limit of the tasks, if slurm-array, i.e. the maximum of the partition.")
 options = parser.parse_args()
 
+if options.noResultCache:
+    resultCache = None
+else:
+    resultCache = ResultCache(os.path.abspath(os.path.expanduser(options.resultCache or '~/.cache/SUEPLimits/results')))
+
+if options.combineMethod == 'HybridNewAuto' and ('rMin' in options.combineOptions or 'rMax' in options.combineOptions):
+    raise Exception("The HybrdiNewAuto method sets rMin and rMax automatically, incomptible if rMin and rMax passed to the combine options via -o.")
+
+if options.grid and 'HybridNew' not in options.combineMethod:
+    raise Exception("--grid is only for '-M HybridNew' and '-M HybridNewAuto'.")
+if options.grid and options.gridRange is None and options.combineMethod != 'HybridNewAuto':
+    raise Exception("--grid needs the range of r, either via --gridRange or from the asymptotic limits with '-M HybridNewAuto'.")
+
+
+def get_combine_command(name, quant, r_range=None):
+    """ The command running combine on the workspace of the sample, for the quantile ('' for the observed), within r_range if passed. """
+    # this is the command running combine. Some options are passed through the parser
+    if 'HybridNew' in options.combineMethod:
+        combine_method = " -M HybridNew --LHCmode LHC-limits "
+        if options.quantiles and quant != '':
+             combine_method += f" --expectedFromGrid {quant} "
+    elif options.combineMethod == 'AsymptoticLimits':
+        combine_method = " -M AsymptoticLimits "
+    if r_range is not None:
+        combine_method += " --rMin {:.6g} --rMax {:.6g} ".format(*r_range)
+    return (
+        "combine "
+        " --datacard cards-{name}/combined.root "
+        " {combine_method}"
+        " -m 125 --cl 0.95 --name {name}"
+        " {options}"
+        " --rAbsAcc 0.00001 --rRelAcc 0.01 "
+        " --X-rtd MINIMIZER_analytic --X-rtd FAST_VERTICAL_MORPH ".format(
+            name=name,
+            combine_method=combine_method,
+            options=options.combineOptions
+        )
+    )
+
+
+def get_asymptotic_command(name):
+    """ The command running the asymptotic limits of the sample, whose r ranges are used by HybridNewAuto. """
+    return (
+        "combine "
+        " --datacard cards-{name}/combined.root "
+        " -M AsymptoticLimits "
+        " -m 125 --cl 0.95 --name {name}"
+        " --rAbsAcc 0.00001 --rRelAcc 0.01 "
+        " --X-rtd MINIMIZER_analytic --X-rtd FAST_VERTICAL_MORPH ".format(name=name)
+    )
+
+
+def get_auto_command(name, quant, strippedOutFile, card_digest=None):
+    """ The HybridNewAuto command of a quantile, once the asymptotic limits of the sample were run, added to the result cache if card_digest. """
+    r_range = rangeTable.range(name, quant)
+    if r_range is None:
+        raise RuntimeError("No asymptotic limits for {}, see {}".format(name, rangeTable.asymptotic_file(name)))
+    command = get_combine_command(name, quant, r_range)
+    if card_digest is not None:
+        command += " && " + resultCache.store_command(resultCache.key(card_digest, command), strippedOutFile + ".root")
+    return [command]
+
+
+# the options passed to the jobs of the grid and to the limits computed from it, the quantile is set for each limit
+grid_options = re.sub(r'--expectedFromGrid[ =]\S+', ' ', options.combineOptions)
+
+
+def get_grid_points(name):
+    """ The values of r of the grid of the sample, evenly spaced in log(r), or in r if the range is not positive. """
+    if options.gridRange is not None:
+        r_min, r_max = [float(r) for r in options.gridRange.split(',')]
+    else:
+        ranges = rangeTable.get(name)
+        if not ranges:
+            raise RuntimeError("No asymptotic limits for {}, see {}".format(name, rangeTable.asymptotic_file(name)))
+        r_min, r_max = min(r[0] for r in ranges.values()), max(r[1] for r in ranges.values())
+    n = options.gridPoints
+    if n == 1:
+        return [r_min]
+    if r_min > 0:
+        return [r_min * (r_max / r_min) ** (i / (n - 1)) for i in range(n)]
+    return [r_min + (r_max - r_min) * i / (n - 1) for i in range(n)]
+
+
+# hashes the cards of the grids, also without the result cache
+cardHasher = resultCache if resultCache is not None else ResultCache(None)
+grid_card_digests = {}
+
+
+def get_grid_card_digest(name):
+    """ Hash of the cards and shapes files of the sample, which its combined card is made from. """
+    if name not in grid_card_digests:
+        digest = hashlib.sha1()
+        for path in sorted(glob.glob("cards-{}/*".format(name))):
+            if os.path.basename(path).startswith('combined.') or not os.path.isfile(path):
+                continue
+            digest.update('{} {}'.format(path, cardHasher.file_digest(path)).encode())
+        grid_card_digests[name] = digest.hexdigest()
+    return grid_card_digests[name]
+
+
+def get_grid_name(name, i):
+    """
+    The --name of the toys of the i-th point of the grid of the sample, tagged with a short hash of its r,
+    the number of toys, the options and the cards, such that toys thrown on another grid or card are never reused.
+    """
+    tag = hashlib.sha1(repr((
+        "{:.6g}".format(get_grid_points(name)[i]),
+        options.toysPerJob,
+        ' '.join(grid_options.split()),
+        get_grid_card_digest(name)
+    )).encode()).hexdigest()[:8]
+    return "{}.grid{}.{}".format(name, i, tag)
+
+
+def get_grid_file(name, i, j):
+    """ The toys of the j-th job of the i-th point of the grid of the sample, each job having its own seed. """
+    return "higgsCombine{}.HybridNew.mH125.{}.root".format(get_grid_name(name, i), 1 + i * options.jobsPerPoint + j)
+
+
+def get_point_command(name, i, j):
+    """ The command throwing the toys of the j-th job of the i-th point of the grid of the sample. """
+    return (
+        "combine "
+        " --datacard cards-{name}/combined.root "
+        " -M HybridNew --LHCmode LHC-limits "
+        " --singlePoint {r:.6g} --saveToys --saveHybridResult --clsAcc 0 -T {toys} -s {seed} "
+        " -m 125 --cl 0.95 --name {grid_name}"
+        " {options}"
+        " --X-rtd MINIMIZER_analytic --X-rtd FAST_VERTICAL_MORPH ".format(
+            name=name,
+            r=get_grid_points(name)[i],
+            toys=options.toysPerJob,
+            seed=1 + i * options.jobsPerPoint + j,
+            grid_name=get_grid_name(name, i),
+            options=grid_options
+        )
+    )
+
+
+def get_merge_command(name, quants):
+    """ The command merging the toys of the grid of the sample into grid-<sample>.root, then computing from it the limits of the quantiles. """
+    files = [get_grid_file(name, i, j) for i in range(options.gridPoints) for j in range(options.jobsPerPoint)]
+    commands = ["hadd -f grid-{name}.root {files}".format(name=name, files=" ".join(files))]
+    for quant in quants:
+        commands.append(
+            "combine "
+            " --datacard cards-{name}/combined.root "
+            " -M HybridNew --LHCmode LHC-limits "
+            " --readHybridResults --grid=grid-{name}.root {quantile}"
+            " -m 125 --cl 0.95 --name {name}"
+            " {options}"
+            " --X-rtd MINIMIZER_analytic --X-rtd FAST_VERTICAL_MORPH ".format(
+                name=name,
+                quantile="--expectedFromGrid {}".format(quant) if quant != '' else '',
+                options=grid_options
+            )
+        )
+    return " && ".join(commands)
+
+
 # change cwd to the input tag: combine will read the cards from here and will make the higgsCombine file here
 os.chdir(options.input)
 print("Working in", options.input)
@@ -139,26 +661,23 @@ print("Running with", options.method, "method,")
 
 # define method-specific variables
 if options.method == 'multithread':
-    pool = ThreadPool(multiprocessing.cpu_count())
-    results = []
+    workers = multiprocessing.cpu_count()
 elif options.method == 'iterative':
     print("Make sure you have the correct CMSSW environment set up! i.e. run cmsenv before running this script.")
-elif options.method == 'slurm':
+elif options.method in ['slurm', 'slurm-array']:
     work_dir = os.getcwd()
     log_dir = '/work/submit/{}/SUEP/logs/{}_{}/'.format(os.environ['USER'], 'slurm_runcombine', options.input)
     if not os.path.isdir(log_dir): os.mkdir(log_dir)
-elif options.method == 'condor':
+elif options.method in ['condor', 'condor-packed']:
     work_dir =os.getcwd()
     log_dir = '/work/submit/{}/SUEP/logs/{}_{}/'.format(os.environ['USER'], 'condor_runcombine', options.input)
     condor_out_dir = "/store/user/{}/SUEP/{}_{}/".format(os.environ['USER'], 'condor_runcombine', options.input)
     out_dir = '/data/submit/cms/store/user/{}/SUEP/{}_{}/'.format(os.environ['USER'], 'condor_runcombine', options.input)
     if not os.path.isdir(log_dir): os.mkdir(log_dir)
     if not os.path.isdir(out_dir): os.mkdir(out_dir)
-    
-    # tar up the cards for transferring, if using condor
-    if not os.path.isfile('cards.tar.gz'):
-        os.system("find . -type d -name 'cards*' -exec tar -czvf cards.tar.gz {} +")
-    transfer_file = os.path.join(os.getcwd(), 'cards.tar.gz')
+
+# with condor, the asymptotic limits of HybridNewAuto are read where the jobs copy them, unless moved here
+rangeTable = RangeTable('asymptotic_ranges.json', options.rangeFactor, out_dir if options.method in ['condor', 'condor-packed'] else None)
     
 # Read in the datacards
 if options.file != None:
@@ -176,7 +695,27 @@ elif options.includeAll != '':
 elif options.includeAny != '':
     dcards = [dc for dc in dcards if any([i in dc for i in options.includeAny.split('-')])]
 
+# combine the cards of the samples in this process, from the summaries written next to them by ftool.datacard,
+# see ftool.combinecards. The others are combined with combineCards.py when running combine
+combined = set()
+if options.cardCombiner == 'native' and not options.dry:
+    names = [dc.replace("cards-", "") for dc in dcards if "SUEP" in dc]
+    done = combinecards.write_many([(get_cards(name), "cards-{}/combined.dat".format(name)) for name in names])
+    combined = set(name for name, ok in zip(names, done) if ok)
+    print("Combined the cards of", len(combined), "samples,", len(names) - len(combined), "left to combineCards.py")
+
+# tar up the cards for transferring, if using condor. With condor-packed, each job transfers only its cards
+if options.method == 'condor':
+    # made again whenever a card was combined or rewritten since, such that the jobs never run on stale cards
+    newest = max([os.path.getmtime(os.path.join(root, f)) for dc in glob.glob('cards*') if os.path.isdir(dc)
+                  for root, _, files in os.walk(dc) for f in files], default=0)
+    if not os.path.isfile('cards.tar.gz') or os.path.getmtime('cards.tar.gz') < newest:
+        os.system("find . -type d -name 'cards*' -exec tar -czvf cards.tar.gz {} +")
+    transfer_file = os.path.join(os.getcwd(), 'cards.tar.gz')
+
 toProcess = 0
+batched_commands = {} # sample -> commands to run, if slurm-array or condor-packed
+graph = StageGraph() # stages to run here, if multithread or iterative
 for dc in dcards:
 
     name= dc.replace("cards-", "")
@@ -199,7 +738,8 @@ for dc in dcards:
                 quant = quant + '0'*(3-len(quant.split('.')[1]))
                 #quant = '.quant' + quant
             quantilesToRun = [quant]
-                        
+
+    toRun = [] # (quantile, output file without .root) still to make for this sample
     for quant in quantilesToRun:
         
         # don't re run cards, unless running with --force
@@ -214,194 +754,186 @@ for dc in dcards:
             print(" --making:", name, quant)
         else:
             print(" --making:", name, quant)
-        strippedOutFile = outFile.split(".root")[0]
+        toRun.append((quant, outFile.split(".root")[0]))
         toProcess += 1
 
-        # Write combine commmands
-
-        # remove the old combined cards
-        rm_command = "rm -rf cards-{}/combined.dat".format(name)
-
-        # make the combined.dat cards
-        combine_card_command = ("combineCards.py -S "
-                "catcrA2016=cards-{name}/shapes-cat_crA2016.dat "
-                "catcrB2016=cards-{name}/shapes-cat_crB2016.dat "
-                "catcrC2016=cards-{name}/shapes-cat_crC2016.dat "
-                "catcrD2016=cards-{name}/shapes-cat_crD2016.dat "
-                "catcrE2016=cards-{name}/shapes-cat_crE2016.dat "
-                "Bin0crF2016=cards-{name}/shapes-Bin0crF2016.dat "
-                "Bin1crF2016=cards-{name}/shapes-Bin1crF2016.dat "
-                "Bin2crF2016=cards-{name}/shapes-Bin2crF2016.dat "
-                "Bin3crF2016=cards-{name}/shapes-Bin3crF2016.dat "
-                "Bin4crF2016=cards-{name}/shapes-Bin4crF2016.dat "
-                "catcrG2016=cards-{name}/shapes-cat_crG2016.dat "
-                "catcrH2016=cards-{name}/shapes-cat_crH2016.dat "
-                "Bin1Sig2016=cards-{name}/shapes-Bin1Sig2016.dat "
-                "Bin2Sig2016=cards-{name}/shapes-Bin2Sig2016.dat "
-                "Bin3Sig2016=cards-{name}/shapes-Bin3Sig2016.dat "
-                "Bin4Sig2016=cards-{name}/shapes-Bin4Sig2016.dat "
-                "catcrA2017=cards-{name}/shapes-cat_crA2017.dat "
-                "catcrB2017=cards-{name}/shapes-cat_crB2017.dat "
-                "catcrC2017=cards-{name}/shapes-cat_crC2017.dat "
-                "catcrD2017=cards-{name}/shapes-cat_crD2017.dat "
-                "catcrE2017=cards-{name}/shapes-cat_crE2017.dat "
-                "Bin0crF2017=cards-{name}/shapes-Bin0crF2017.dat "
-                "Bin1crF2017=cards-{name}/shapes-Bin1crF2017.dat "
-                "Bin2crF2017=cards-{name}/shapes-Bin2crF2017.dat "
-                "Bin3crF2017=cards-{name}/shapes-Bin3crF2017.dat "
-                "Bin4crF2017=cards-{name}/shapes-Bin4crF2017.dat "
-                "catcrG2017=cards-{name}/shapes-cat_crG2017.dat "
-                "catcrH2017=cards-{name}/shapes-cat_crH2017.dat "
-                "Bin1Sig2017=cards-{name}/shapes-Bin1Sig2017.dat "
-                "Bin2Sig2017=cards-{name}/shapes-Bin2Sig2017.dat "
-                "Bin3Sig2017=cards-{name}/shapes-Bin3Sig2017.dat "
-                "Bin4Sig2017=cards-{name}/shapes-Bin4Sig2017.dat "
-                "catcrA2018=cards-{name}/shapes-cat_crA2018.dat "
-                "catcrB2018=cards-{name}/shapes-cat_crB2018.dat "
-                "catcrC2018=cards-{name}/shapes-cat_crC2018.dat "
-                "catcrD2018=cards-{name}/shapes-cat_crD2018.dat "
-                "catcrE2018=cards-{name}/shapes-cat_crE2018.dat "
-                "Bin0crF2018=cards-{name}/shapes-Bin0crF2018.dat "
-                "Bin1crF2018=cards-{name}/shapes-Bin1crF2018.dat "
-                "Bin2crF2018=cards-{name}/shapes-Bin2crF2018.dat "
-                "Bin3crF2018=cards-{name}/shapes-Bin3crF2018.dat "
-                "Bin4crF2018=cards-{name}/shapes-Bin4crF2018.dat "
-                "catcrG2018=cards-{name}/shapes-cat_crG2018.dat "
-                "catcrH2018=cards-{name}/shapes-cat_crH2018.dat "
-                "Bin1Sig2018=cards-{name}/shapes-Bin1Sig2018.dat "
-                "Bin2Sig2018=cards-{name}/shapes-Bin2Sig2018.dat "
-                "Bin3Sig2018=cards-{name}/shapes-Bin3Sig2018.dat "
-                "Bin4Sig2018=cards-{name}/shapes-Bin4Sig2018.dat "        
-                "> cards-{name}/combined.dat").format(name=name)
-
-        # converts .dat to .root
-        text2workspace_command = "text2workspace.py -m 125 cards-{name}/combined.dat -o cards-{name}/combined.root".format(name=name)
-
-        # this is the command running combine. Some options are passed through the parser
-        if 'HybridNew' in options.combineMethod:
-            combine_method = " -M HybridNew --LHCmode LHC-limits "
-            if options.quantiles and quant != '':
-                 combine_method += f" --expectedFromGrid {quant} "
-        elif options.combineMethod == 'AsymptoticLimits':
-            combine_method = " -M AsymptoticLimits "
-        combine_command = (
-            "combine "
-            " --datacard cards-{name}/combined.root "
-            " {combine_method}"
-            " -m 125 --cl 0.95 --name {name}"
-            " {options}"
-            " --rAbsAcc 0.00001 --rRelAcc 0.01 "
-            " --X-rtd MINIMIZER_analytic --X-rtd FAST_VERTICAL_MORPH ".format(
-                name=name,
-                combine_method=combine_method,
-                options=options.combineOptions
-            )
+    if len(toRun) == 0:
+        continue
+
+    # Write combine commmands: the combined card and its workspace are made once per sample,
+    # then combine is run on the workspace for each quantile
+
+    # remove the old combined cards
+    rm_command = "rm -rf cards-{}/combined.dat".format(name)
+
+    # make the combined.dat cards, unless they were combined above
+    if name in combined:
+        rm_command = ": cards-{}/combined.dat was combined by runcombine.py".format(name)
+        combine_card_command = rm_command
+    else:
+        combine_card_command = "combineCards.py -S {cards} > cards-{name}/combined.dat".format(
+            cards=" ".join("{}={}".format(label, card) for label, card, _, _ in get_cards(name)),
+            name=name
         )
-        
-        if options.combineMethod == 'HybridNewAuto':
-            if 'rMin' in options.combineOptions or 'rMax' in options.combineOptions:
-                raise Exception("The HybrdiNewAuto method sets rMin and rMax automatically, incomptible if rMin and rMax passed to the combine options via -o.")
-        
-            # run the asymptotic command
-            pre_combine_command = (
-                "combine "
-                " --datacard cards-{name}/combined.root "
-                " -M AsymptoticLimits "
-                " -m 125 --cl 0.95 --name {name}"
-                " --rAbsAcc 0.00001 --rRelAcc 0.01 "
-                " --X-rtd MINIMIZER_analytic --X-rtd FAST_VERTICAL_MORPH > asymptotic_output-{name}.txt ".format(
-                    name=name,
-                    options=options.combineOptions
-                )
-            ) 
-            # grab the output from asymptotic 
-            grab_boundaries_command = (
-                " min_r=$(grep -oP 'r < \K[0-9.]*' asymptotic_output-{name}.txt | sort -n | head -n 1); "
-                " max_r=$(grep -oP 'r < \K[0-9.]*' asymptotic_output-{name}.txt | sort -n | tail -n 1); "
-                " echo Minimum r value from asymptotic limits: $min_r; "
-                " echo Maximum r value from asymptotic limits: $max_r; "
-                " min_r=$(echo \"$min_r / 2\" | bc -l); "
-                " max_r=$(echo \"$max_r * 2\" | bc -l); "
-                " echo \"Using r lower bound: $min_r \"; "
-                " echo \"Using r upper bound: $max_r \"".format(name=name)
-            )
-            # and use those as boundaries for the toys
-            combine_command += " --rMin $min_r --rMax $max_r "
-            
-            # the command that gets executed is the combination of all the above
-            combine_command = pre_combine_command + " ;\n " + grab_boundaries_command + " ;\n " + combine_command
-
-        # Execute and optionally print the commands   
-        if options.print_commands:
-            print('--- removing old combined datacard:', rm_command)
-            print('--- combining datacards:', combine_card_command)
-            print('--- text2workspace:', text2workspace_command)
+
+    # converts .dat to .root
+    text2workspace_command = "text2workspace.py -m 125 cards-{name}/combined.dat -o cards-{name}/combined.root".format(name=name)
+
+    # hash of the combined card and its shapes, for the result cache, only known for the cards combined above
+    card_digest = None
+    if resultCache is not None and name in combined and not options.dry:
+        card_digest = resultCache.card_digest("cards-{}/combined.dat".format(name))
+
+    # with HybridNewAuto, the r range of each quantile comes from the asymptotic limits of the sample,
+    # run once as a stage of their own here or, if submitting, in a first round of jobs
+    after_asymptotic = False
+    if options.combineMethod == 'HybridNewAuto' and rangeTable.get(name) is None:
+        if options.method in ['multithread', 'iterative']:
+            after_asymptotic = True
+        else:
+            print(" -- running the asymptotic limits of", name, "first, run again once they are done to submit the toys")
+            toProcess -= len(toRun) - 1
+            toRun = [('asymptotic', rangeTable.asymptotic_file(name).split(".root")[0])]
+
+    if after_asymptotic:
+        combine_commands = [functools.partial(get_auto_command, name, quant, strippedOutFile, card_digest) for quant, strippedOutFile in toRun]
+    else:
+        combine_commands = []
+        for quant, strippedOutFile in toRun:
+            if quant == 'asymptotic':
+                combine_commands.append(get_asymptotic_command(name))
+            elif options.combineMethod == 'HybridNewAuto':
+                combine_commands.append(get_combine_command(name, quant, rangeTable.range(name, quant)))
+            else:
+                combine_commands.append(get_combine_command(name, quant))
+
+    # with --grid, the toys are thrown at each point of r by many short jobs, then merged to compute the limits of all the quantiles
+    grid_merge = None
+    if options.grid and toRun[0][0] != 'asymptotic':
+        quants = [quant for quant, _ in toRun]
+        # the toys already thrown on the same grid and cards are kept, unless running with --force
+        if options.force and not options.dry:
+            for gridFile in glob.glob("higgsCombine{}.grid*.HybridNew.mH125.*.root".format(name)):
+                os.remove(gridFile)
+        points = [(i, j) for i in range(options.gridPoints) for j in range(options.jobsPerPoint)]
+        get_grid_card_digest(name)
+        if after_asymptotic:
+            # the grid, hence its files, is only known once the asymptotic limits are
+            combine_commands = [functools.partial(get_point_command, name, i, j) for i, j in points]
+            grid_merge = functools.partial(get_merge_command, name, quants)
+        else:
+            points = [(i, j) for i, j in points if not os.path.isfile(get_grid_file(name, i, j))]
+            combine_commands = [get_point_command(name, i, j) for i, j in points]
+            grid_merge = get_merge_command(name, quants)
+        toRun = [('grid point {} job {}'.format(i, j), 'grid-{}.{}.{}'.format(name, i, j)) for i, j in points]
+        if options.method not in ['multithread', 'iterative', 'slurm']:
+            # these jobs can't wait for each other: first the points then, when run again, the merging
+            if len(points) > 0:
+                print(" -- running", len(points), "jobs of the grid of", name, "first, run again once they are done to merge them and compute the limits")
+            else:
+                toRun = [('grid', 'grid-' + name)]
+                combine_commands = [grid_merge]
+            grid_merge = None
+        toProcess += len(toRun) + (grid_merge is not None) - len(quants)
+        card_digest = None
+
+    # reuse the results of the same fits. The results made here or on slurm, which share this directory, are added to the cache
+    if card_digest is not None and not after_asymptotic:
+        remaining = []
+        for (quant, strippedOutFile), combine_command in zip(toRun, combine_commands):
+            key = resultCache.key(card_digest, combine_command)
+            if resultCache.fetch(key, strippedOutFile + ".root"):
+                print(" -- from the result cache:", name, quant)
+                toProcess -= 1
+                continue
+            if options.method in ['multithread', 'iterative', 'slurm', 'slurm-array']:
+                combine_command += " && " + resultCache.store_command(key, strippedOutFile + ".root")
+            remaining.append(((quant, strippedOutFile), combine_command))
+        toRun = [quant for quant, _ in remaining]
+        combine_commands = [command for _, command in remaining]
+        if len(toRun) == 0:
+            continue
+
+    # Execute and optionally print the commands   
+    if options.print_commands:
+        print('--- removing old combined datacard:', rm_command)
+        print('--- combining datacards:', combine_card_command)
+        print('--- text2workspace:', text2workspace_command)
+        if after_asymptotic:
+            print('--- running combine:', get_asymptotic_command(name))
+        for (quant, _), combine_command in zip(toRun, combine_commands):
+            if callable(combine_command):
+                combine_command = "{} of {}, once its asymptotic limits are known".format(quant or 'observed', name)
             print('--- running combine:', combine_command)
+        if grid_merge is not None:
+            print('--- merging the grid:', "grid of {}, once its asymptotic limits are known".format(name) if callable(grid_merge) else grid_merge)
 
-        # if dry run, skip the rest
-        if options.dry: continue
+    # if dry run, skip the rest
+    if options.dry: continue
 
-        # run the commands!
-        if options.method == 'multithread':
-            os.system(rm_command)
-            os.system(combine_card_command)
-            os.system(text2workspace_command)
-            results.append(pool.apply_async(call_combine, (combine_command,)))
+    # run the commands!
+    if options.method in ['multithread', 'iterative']:
+        # cards -> combined.dat -> combined.root -> combine for each quantile
+        workspace_deps = []
+        if name not in combined:
+            workspace_deps = [graph.add(name + ' combined.dat', [rm_command, combine_card_command])]
+        workspace = graph.add(name + ' combined.root', [text2workspace_command], workspace_deps)
+        combine_deps = [workspace]
+        if after_asymptotic:
+            combine_deps = [graph.add(name + ' asymptotic', [get_asymptotic_command(name)], [workspace])]
+        for (quant, strippedOutFile), combine_command in zip(toRun, combine_commands):
+            graph.add(strippedOutFile, combine_command if callable(combine_command) else [combine_command], combine_deps)
+        if grid_merge is not None:
+            graph.add('grid-' + name, grid_merge if callable(grid_merge) else [grid_merge], [strippedOutFile for _, strippedOutFile in toRun] or combine_deps)
 
-        elif options.method == 'slurm':
+    elif options.method == 'slurm':
 
-            cpus = 1 # default value
-            if '--fork' in options.combineOptions: # grab it from fork
-                cpus = int(options.combineOptions.split('--fork ')[1].split(' ')[0])
+        cpus = 1 # default value
+        if '--fork' in options.combineOptions: # grab it from fork
+            cpus = int(options.combineOptions.split('--fork ')[1].split(' ')[0])
 
-            if options.combineMethod == 'AsymptoticLimits':
-                mem_per_cpu = 1
-                time_limit = '1:0:0'
-            elif 'HybridNew' in options.combineMethod:
-                mem_per_cpu = 4
-                time_limit = '12:0:0'
-            mem = str(mem_per_cpu*cpus)+'GB'
+        if options.combineMethod == 'AsymptoticLimits':
+            mem_per_cpu = 1
+            time_limit = '1:0:0'
+        elif 'HybridNew' in options.combineMethod:
+            mem_per_cpu = 4
+            time_limit = '12:0:0'
+        if options.grid:
+            time_limit = '2:0:0'
+        mem = str(mem_per_cpu*cpus)+'GB'
 
-            slurm_script_content = slurm_script_template.format(
-                                        rm_command=rm_command,
-                                        combine_card_command=combine_card_command,
-                                        text2workspace_command=text2workspace_command,
-                                        combine_command=combine_command,
-                                        work_dir=work_dir,
-                                        log_dir=log_dir,
-                                        mem=mem,
-                                        cpus=cpus,
-                                        time_limit=time_limit,
-                                        sample=name,
-                                        outFile=strippedOutFile)
-
-            # Write the SLURM script to a file
-            slurm_script_file = f'{log_dir}submit_{strippedOutFile}.sh'
-            with open(slurm_script_file, 'w') as f:
-                f.write(slurm_script_content)
-
-            # Submit the SLURM job
-            subprocess.run(['sbatch', slurm_script_file])
-
-        elif options.method == 'iterative':
-            subprocess.run('cmsenv', shell=True)
-            subprocess.run(rm_command, shell=True)
-            subprocess.run(combine_card_command, shell=True)
-            subprocess.run(text2workspace_command, shell=True)
-            subprocess.run(combine_command, shell=True)
-
-        elif options.method == 'condor':
-
-            cpus = 1 # default value
-            if '--fork' in options.combineOptions: # grab it from fork
-                cpus = int(options.combineOptions.split('--fork ')[1].split(' ')[0])
-
-            # set the memory
-            if options.combineMethod == 'AsymptoticLimits':
-                mem_per_cpu = 1
-            elif 'HybridNew' in options.combineMethod:
-                mem_per_cpu = 2
-            mem = str(mem_per_cpu*cpus)+'GB'
+        # one job making the workspace, then one job per quantile once it succeeded
+        workspace_job = submit_slurm([rm_command, combine_card_command, text2workspace_command],
+                                     work_dir=work_dir, log_dir=log_dir, mem='2GB', cpus=1,
+                                     time_limit='1:0:0', outFile='workspace_' + name)
+        job_ids = []
+        for (quant, strippedOutFile), combine_command in zip(toRun, combine_commands):
+            job_ids.append(submit_slurm([combine_command], work_dir=work_dir, log_dir=log_dir, mem=mem, cpus=cpus,
+                                        time_limit=time_limit, outFile=strippedOutFile, dependency=workspace_job))
+        # the grid is merged once all its points succeeded
+        if grid_merge is not None:
+            submit_slurm([grid_merge], work_dir=work_dir, log_dir=log_dir, mem=mem, cpus=1,
+                         time_limit=time_limit, outFile='grid-' + name, dependency=':'.join(job_ids) or workspace_job)
+
+    elif options.method in ['slurm-array', 'condor-packed']:
+        # the combined card is made once per sample, then combine is run for each quantile
+        batched_commands[name] = [rm_command, combine_card_command, text2workspace_command] + combine_commands
+
+    elif options.method == 'condor':
+
+        cpus = 1 # default value
+        if '--fork' in options.combineOptions: # grab it from fork
+            cpus = int(options.combineOptions.split('--fork ')[1].split(' ')[0])
+
+        # set the memory
+        if options.combineMethod == 'AsymptoticLimits':
+            mem_per_cpu = 1
+        elif 'HybridNew' in options.combineMethod:
+            mem_per_cpu = 2
+        mem = str(mem_per_cpu*cpus)+'GB'
+
+        # each job makes the workspace in its own sandbox, from the transferred cards
+        for (quant, strippedOutFile), combine_command in zip(toRun, combine_commands):
 
             # Write the condor script to a file
             condor_script_content = condor_script_template.format(
@@ -432,15 +964,124 @@ for dc in dcards:
             # Submit the condor job
             subprocess.run(['condor_submit', condor_submission_file])
                 
-if options.method == 'multithread':
-    pool.close()
-    pool.join()
-
-    for result in results:
-        out, err = result.get()
-        if "error" in str(err).lower():
-            print(str(err))
-            print(" ----------------- ")
-            print()
+if options.method in ['multithread', 'iterative'] and len(graph) > 0:
+    status = graph.run(workers if options.method == 'multithread' else 1, capture=options.method == 'multithread')
+    failed = [stage for stage, s in status.items() if s == 'failed']
+    skipped = [stage for stage, s in status.items() if s == 'skipped']
+    if len(failed) > 0:
+        print("Failed:", ", ".join(failed))
+    if len(skipped) > 0:
+        print("Not run, as a stage they depend on failed:", ", ".join(skipped))
+
+if options.method == 'slurm-array' and len(batched_commands) > 0:
+
+    cpus = 1 # default value
+    if '--fork' in options.combineOptions: # grab it from fork
+        cpus = int(options.combineOptions.split('--fork ')[1].split(' ')[0])
+
+    if options.combineMethod == 'AsymptoticLimits':
+        mem_per_cpu = 1
+    elif 'HybridNew' in options.combineMethod:
+        mem_per_cpu = 4
+    mem = str(mem_per_cpu*cpus)+'GB'
+
+    # the samples are packed into tasks of about --jobHours each, using the rough cost of their combine commands, and
+    # within --maxTaskHours once the margin is added. A sample is never split across tasks, as they share its workspace
+    hours = combine_hours[options.combineMethod] / (cpus if 'HybridNew' in options.combineMethod else 1)
+    if options.grid:
+        hours = grid_job_hours
+    sample_hours = {name: card_hours + hours*(len(commands)-3) for name, commands in sorted(batched_commands.items())}
+    chunks = pack_jobs({name: [h - card_hours] for name, h in sample_hours.items()}, min(options.jobHours, options.maxTaskHours / time_limit_factor))
+    job_name = 'runcombine_' + options.combineMethod
+    # the scripts of each submission have their own names, such that submitting again does not change those of pending tasks
+    submission = time.strftime('%Y%m%d-%H%M%S') + '-' + str(os.getpid())
+    for i, chunk in enumerate(chunks):
+        with open(f'{log_dir}{job_name}_{submission}_{i}.sh', 'w') as f:
+            # combine only runs if the workspace of the sample was made, and the task fails if any command did
+            f.write('failed=0\n')
+            for name, _ in chunk:
+                f.write('echo "---- {}"\n'.format(name))
+                f.write('if ' + ' && '.join(batched_commands[name][:3]) + '; then\n')
+                for command in batched_commands[name][3:]:
+                    f.write('    ' + command + ' || failed=1\n')
+                f.write('else\n    failed=1\nfi\n')
+            f.write('exit $failed\n')
+
+    # the time limit of the tasks is the same cost as used to pack them, with a margin, capped at the maximum of the partition
+    task_hours = time_limit_factor * max(sum(sample_hours[name] for name, _ in chunk) for chunk in chunks)
+    too_long = [name for name, h in sample_hours.items() if time_limit_factor * h > options.maxTaskHours]
+    if len(too_long) > 0:
+        print("WARNING: the combine commands of", len(too_long), "samples, e.g.", too_long[0], "could take longer than --maxTaskHours",
+              options.maxTaskHours, "even alone in a task, and time out: use more cpus with --fork, --grid, or -m slurm")
+    task_minutes = int(math.ceil(60 * min(task_hours, options.maxTaskHours)))
+
+    slurm_script_content = slurm_array_script_template.format(
+                                job_name=job_name,
+                                work_dir=work_dir,
+                                log_dir=log_dir,
+                                mem=mem,
+                                cpus=cpus,
+                                time_limit='{}:{:02d}:0'.format(task_minutes // 60, task_minutes % 60),
+                                submission=submission,
+                                last_task=len(chunks)-1)
+    slurm_script_file = f'{log_dir}submit_{job_name}_{submission}.sh'
+    with open(slurm_script_file, 'w') as f:
+        f.write(slurm_script_content)
+
+    print("Submitting an array of", len(chunks), "tasks")
+    subprocess.run(['sbatch', slurm_script_file])
+
+if options.method == 'condor-packed' and len(batched_commands) > 0:
+
+    cpus = 1 # default value
+    if '--fork' in options.combineOptions: # grab it from fork
+        cpus = int(options.combineOptions.split('--fork ')[1].split(' ')[0])
+
+    # set the memory
+    if options.combineMethod == 'AsymptoticLimits':
+        mem_per_cpu = 1
+    elif 'HybridNew' in options.combineMethod:
+        mem_per_cpu = 2
+    mem = str(mem_per_cpu*cpus)+'GB'
+
+    # toys are split across the cpus with --fork
+    hours = combine_hours[options.combineMethod] / (cpus if 'HybridNew' in options.combineMethod else 1)
+    if options.grid:
+        hours = grid_job_hours
+    jobs = pack_jobs({name: [hours]*(len(commands)-3) for name, commands in batched_commands.items()}, options.jobHours)
+
+    for i, job in enumerate(jobs):
+        commands = []
+        for name, indices in job:
+            commands += batched_commands[name][:3] + [batched_commands[name][3+j] for j in indices]
+        samples = sorted(set(name for name, _ in job))
+
+        # Write the condor script to a file
+        condor_script_content = condor_packed_script_template.format(
+                                    commands='\n'.join(commands),
+                                    condor_out_dir=condor_out_dir)
+        condor_script_file = f'{log_dir}submit_packed_{i}.sh'
+        with open(condor_script_file, 'w') as f:
+            f.write(condor_script_content)
+
+        # Write the condor submission script to a file, transferring only the cards of the samples of this job
+        condor_submission_content = condor_submission_script.format(
+                                        jobdir=log_dir,
+                                        script=f'submit_packed_{i}',
+                                        transfer_file=','.join(os.path.join(os.getcwd(), 'cards-'+name) for name in samples),
+                                        user=os.environ['USER'],
+                                        proxy=f"x509up_u{os.getuid()}",
+                                        queue='workday' if options.jobHours + setup_hours <= 8 else 'tomorrow',
+                                        cpus=cpus,
+                                        mem=mem,
+                                        outFile=f'packed_{i}')
+        condor_submission_file = f'{log_dir}submit_packed_{i}.sub'
+        with open(condor_submission_file, 'w') as f:
+            f.write(condor_submission_content)
+
+        # Submit the condor job
+        subprocess.run(['condor_submit', condor_submission_file])
+
+    print("Submitted", len(jobs), "condor jobs")
 
 print("Processed jobs for", toProcess, "samples.")